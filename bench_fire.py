@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import gc
+import os
+import runpy
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+# Keep the player's settings, saves and AI data out of the benchmark.
+_tmpdir = tempfile.TemporaryDirectory()
+os.environ["XDG_CONFIG_HOME"] = os.path.join(_tmpdir.name, "config")
+os.environ["XDG_DATA_HOME"] = os.path.join(_tmpdir.name, "data")
+
+import sge
+
+import hlib
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Frames to run before measuring, so that the pools have filled up.
+WARMUP = 120
+
+
+def percentile(data, p):
+    return data[min(len(data) - 1, len(data) * p // 100)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fire Anneroy's gun as fast as possible and time it.")
+    parser.add_argument("--frames", type=int, default=10000)
+    parser.add_argument("--room", default="0.json")
+    parser.add_argument("--spawn", default="save")
+    parser.add_argument("--life-force-interval", type=int, default=30,
+                        help="Frames between life force drops (0 for none).")
+    parser.add_argument("--no-pools", action="store_true",
+                        help="Create every object anew, for comparison.")
+    parser.add_argument("--trace-malloc", action="store_true",
+                        help=("Also measure the bytes allocated by each "
+                              "shot (makes frame times meaningless)."))
+    args = parser.parse_args()
+
+    sys.argv = [os.path.join(ROOT, "hexoshi.py"), "-q", "--nodelta", "-d",
+                os.path.join(ROOT, "data")]
+    game = runpy.run_path(sys.argv[0], run_name="hexoshi")
+
+    pooled = [game["AnneroyBullet"], game["Smoke"], game["LifeForce"]]
+    if args.no_pools:
+        for cls in pooled:
+            cls.pool.limit = 0
+
+    game["set_new_game"]()
+    hlib.current_level = args.room
+    hlib.spawn_point = args.spawn
+    hlib.progress_flags = {"life_orb"}
+    hlib.artifacts = max(1, hlib.num_artifacts)
+
+    frame_times = []
+    state = {"frame": 0, "last": None, "gc": None, "blocks": None,
+             "counts": None, "shot_blocks": 0, "shot_bytes": 0,
+             "shot_peak": 0}
+
+    if args.trace_malloc:
+        tracemalloc.start()
+
+    class Trigger(sge.dsp.Object):
+
+        def event_step(self, time_passed, delta_mult):
+            now = time.perf_counter()
+            frame = state["frame"]
+            state["frame"] += 1
+            if frame == WARMUP:
+                state["gc"] = [s["collections"] for s in gc.get_stats()]
+                state["blocks"] = sys.getallocatedblocks()
+                state["counts"] = {cls: (cls.pool.created, cls.pool.reused)
+                                   for cls in pooled}
+            elif frame > WARMUP:
+                frame_times.append((now - state["last"]) * 1000)
+            state["last"] = now
+
+            # Measure what is allocated while the objects of a shot are
+            # made, whether they are created or taken from a pool.
+            blocks = sys.getallocatedblocks()
+            if args.trace_malloc:
+                size = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+
+            player = hlib.player
+            player.shoot()
+            interval = args.life_force_interval
+            if interval and frame % interval == 0:
+                game["LifeForce"].create(player.x, player.y - 32,
+                                         z=player.z - 0.1)
+
+            if frame > WARMUP:
+                state["shot_blocks"] += sys.getallocatedblocks() - blocks
+                if args.trace_malloc:
+                    current, peak = tracemalloc.get_traced_memory()
+                    state["shot_bytes"] += current - size
+                    state["shot_peak"] = max(state["shot_peak"], peak - size)
+
+            if frame >= WARMUP + args.frames:
+                sge.game.end()
+
+    level_start = game["Level"].event_room_start
+
+    def event_room_start(room):
+        level_start(room)
+        Trigger.create(0, 0, visible=False, tangible=False)
+
+    game["Level"].event_room_start = event_room_start
+
+    # Run as fast as possible; with --nodelta, every frame still counts
+    # as 1/FPS seconds of game time.
+    game_cls = type(sge.game)
+    sge.game.regulate_speed = (
+        lambda fps=None: game_cls.regulate_speed(sge.game, 0))
+    hlib.player = game["Anneroy"](0, 0)
+    sge.game.start_room = game["Level"].load(args.room)
+    sge.game.start()
+
+    frame_times.sort()
+    print(f"{len(frame_times)} frames in {args.room}, pools "
+          f"{'disabled' if args.no_pools else 'enabled'}")
+    print("frame time: mean {:.3f} ms, p50 {:.3f} ms, p95 {:.3f} ms, "
+          "p99 {:.3f} ms, max {:.3f} ms".format(
+              sum(frame_times) / len(frame_times),
+              *(percentile(frame_times, p) for p in (50, 95, 99)),
+              frame_times[-1]))
+    for cls in pooled:
+        created, reused = state["counts"][cls]
+        print(f"{cls.__name__}: {cls.pool.created - created} created, "
+              f"{cls.pool.reused - reused} reused")
+    bullets = game["AnneroyBullet"]
+    created, reused = state["counts"][bullets]
+    shots = max(1, bullets.pool.created - created + bullets.pool.reused
+                - reused)
+    print("allocated blocks per shot: {:+.1f}".format(
+        state["shot_blocks"] / shots))
+    if args.trace_malloc:
+        print("allocated bytes per shot: {:+.1f}, largest peak {} bytes".format(
+            state["shot_bytes"] / shots, state["shot_peak"]))
+    collections = [s["collections"] - n
+                   for s, n in zip(gc.get_stats(), state["gc"])]
+    print(f"garbage collections by generation: {collections}")
+    print("allocated blocks: {:+d}".format(
+        sys.getallocatedblocks() - state["blocks"]))
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import sge
+
+import hlib
+
+
+ROOM_WIDTH = 5
+ROOM_HEIGHT = 4
+
+
+def make_sprites():
+    for name in ["wall_left", "wall_right", "wall_top", "wall_bottom",
+                 "door_left", "door_right", "door_top", "door_bottom",
+                 "powerup", "warp_pad", "player"]:
+        sprite = sge.gfx.Sprite(width=hlib.MAP_CELL_WIDTH,
+                                height=hlib.MAP_CELL_HEIGHT)
+        sprite.draw_rectangle(1, 1, 2, 2, fill=sge.gfx.Color("white"))
+        setattr(hlib, f"map_{name}_sprite", sprite)
+
+
+def make_map(size, rng):
+    """
+    Fill the map with a synthetic ``size`` by ``size`` cell world made
+    of rooms joined by doors, with some powerups already collected.
+    """
+    hlib.map_rooms = {}
+    hlib.map_objects = {}
+    hlib.map_removed = set()
+    for rm_y in range(0, size, ROOM_HEIGHT):
+        for rm_x in range(0, size, ROOM_WIDTH):
+            fname = f"{rm_x},{rm_y}.json"
+            hlib.map_rooms[fname] = (rm_x, rm_y)
+            for y in range(rm_y, min(rm_y + ROOM_HEIGHT, size)):
+                for x in range(rm_x, min(rm_x + ROOM_WIDTH, size)):
+                    objects = []
+                    if x == rm_x:
+                        objects.append(rng.choice(["wall_left", "door_left"]))
+                    if x == rm_x + ROOM_WIDTH - 1:
+                        objects.append(
+                            rng.choice(["wall_right", "door_right"]))
+                    if y == rm_y:
+                        objects.append(rng.choice(["wall_top", "door_top"]))
+                    if y == rm_y + ROOM_HEIGHT - 1:
+                        objects.append(
+                            rng.choice(["wall_bottom", "door_bottom"]))
+
+                    r = rng.random()
+                    if r < 0.02:
+                        objects.append("powerup")
+                        if r < 0.01:
+                            hlib.map_removed.add(
+                                ("powerup", fname, x - rm_x, y - rm_y))
+                    elif r < 0.025:
+                        objects.append("warp_pad")
+
+                    if objects:
+                        hlib.map_objects[(x, y)] = objects
+
+    hlib.map_revealed = {(x, y) for y in range(size) for x in range(size)}
+    hlib.map_explored = {(x, y) for x, y in hlib.map_revealed
+                         if rng.random() < 0.5}
+
+
+def bench(name, function, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        function()
+    t = (time.perf_counter() - start) / repeat
+    print(f"{name}: {t * 1000:.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time drawing a large synthetic map.")
+    parser.add_argument("--size", type=int, default=500,
+                        help="Width and height of the map in cells.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    sge.dsp.Game(320, 240)
+    make_sprites()
+    make_map(args.size, random.Random(args.seed))
+    print(f"{args.size}x{args.size} cells, {len(hlib.map_objects)} with "
+          f"objects, {len(hlib.map_removed)} removed")
+
+    center = args.size // 2
+    bench("MapGrid.from_map", hlib.maps.MapGrid.from_map, 1)
+    grid = hlib.maps.get_grid()
+    bench("MapGrid.find (all visible cells)",
+          lambda: grid.find(hlib.maps.VISIBLE), 5)
+    bench("MapGrid.count (explored cells)",
+          lambda: grid.count(hlib.maps.EXPLORED), 20)
+    bench("draw_map (full map)", hlib.maps.draw_map, 1)
+    bench("draw_map (7x5 window)",
+          lambda: hlib.maps.draw_map(center - 3, center - 2, 7, 5,
+                                     center, center), 20)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bench("export_map (full map)",
+              lambda: hlib.maps.export_map(os.path.join(tmpdir, "map.png")),
+              1)
+
+    surface = hlib.maps.MapSurface()
+    bench("MapSurface.rebuild", surface.rebuild, 1)
+    bench("MapSurface.draw_window (7x5)",
+          lambda: surface.draw_window(center - 3, center - 2, 7, 5,
+                                      center, center), 1000)
+
+    hlib.map_explored = set()
+    surface.rebuild()
+    cells = iter(sorted(hlib.map_revealed))
+    bench("MapSurface.explore", lambda: surface.explore(next(cells)), 1000)
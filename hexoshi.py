@@ -20,11 +20,14 @@ __version__ = "0.3a0"
 
 
 import argparse
+import collections
 import datetime
 import gettext
+import hashlib
 import itertools
 import json
 import math
+import multiprocessing
 import os
 import random
 import sys
@@ -99,6 +102,17 @@ parser.add_argument(
 parser.add_argument(
     "-s", "--save-map", help=_('Save an image of the full map as "map.png".'),
     action="store_true")
+parser.add_argument(
+    "--map-scale", type=int, default=1,
+    help=_("Scale factor for the image saved with -s (Default: 1)."))
+parser.add_argument(
+    "--map-labels", help=_("Label each room in the image saved with -s."),
+    action="store_true")
+parser.add_argument(
+    "--profile", metavar="DIR",
+    help=_("Time each part of every frame, and save a report of the timings "
+           "in each room to DIR as JSON. Press F9 in the game to show the "
+           "timings on screen."))
 parser.add_argument(
     "--dist-ai", help=_("Write the AI data to the game data directory instead "
                         "of the user data directory (for distribution)."),
@@ -122,7 +136,10 @@ NO_BACKGROUNDS = args.no_backgrounds
 hlib.no_hud = args.no_hud
 GEN_MAP = args.gen_map
 SAVE_MAP = args.save_map
+MAP_SCALE = max(1, args.map_scale)
+MAP_LABELS = args.map_labels
 DIST_AI = args.dist_ai
+PROFILE_DIR = args.profile
 QUIT = args.quit
 hlib.god = (args.god and args.god.lower() == "inbailey")
 
@@ -132,8 +149,9 @@ if args.lang:
                                [args.lang])
     lang.install()
 
+ai_table = hlib.ai.ActionTable()
 with open(os.path.join(hlib.datadir, "ai_data.json"), 'r') as f:
-    ai_data = json.load(f)
+    ai_table.update_json(json.load(f))
 
 
 class Game(sge.dsp.Game):
@@ -142,9 +160,27 @@ class Game(sge.dsp.Game):
     fps_time = 0
     fps_frames = 0
     fps_text = ""
+    profile_overlay = False
+    profile_text = ""
     cheatcode = ""
 
+    def regulate_speed(self, fps=None):
+        profiler.switch("wait")
+        r = super().regulate_speed(fps)
+        profiler.switch("other")
+        return r
+
+    def refresh(self):
+        profiler.switch("draw")
+        super().refresh()
+        if self.current_room is not None:
+            profiler.end_frame(self.current_room.objects)
+        profiler.switch("input")
+
     def event_step(self, time_passed, delta_mult):
+        sound_engine.new_frame()
+        hlib.pools.new_frame()
+
         self.fps_time += time_passed
         self.fps_frames += 1
         if self.fps_time >= 250:
@@ -152,6 +188,14 @@ class Game(sge.dsp.Game):
             self.fps_text = '{:.2f}'.format(self.fps_real)
             self.fps_time = 0
             self.fps_frames = 0
+            if self.profile_overlay:
+                self.profile_text = profiler.get_overlay_text()
+
+        if self.profile_overlay:
+            self.project_text(hlib.font_small, self.profile_text, 8, 8,
+                              z=1000000, color=sge.gfx.Color("yellow"),
+                              outline=sge.gfx.Color("black"),
+                              outline_thickness=1)
 
         if hlib.fps_enabled:
             self.project_text(hlib.font_small, self.fps_text, self.width - 8,
@@ -160,6 +204,9 @@ class Game(sge.dsp.Game):
                               valign="bottom", outline=sge.gfx.Color("black"),
                               outline_thickness=1)
 
+    def event_paused_step(self, time_passed, delta_mult):
+        sound_engine.new_frame()
+
     def event_key_press(self, key, char):
         if key == "f7":
             self.cheatcode = ""
@@ -169,6 +216,13 @@ class Game(sge.dsp.Game):
             self.cheatcode += char
             print(char, end='')
             sys.stdout.flush()
+        elif key == "f9":
+            self.profile_overlay = not self.profile_overlay
+            self.profile_text = ""
+            if self.profile_overlay:
+                profiler.enable()
+            elif not PROFILE_DIR:
+                profiler.disable()
 
     def event_key_release(self, key):
         if key == "f7":
@@ -176,9 +230,10 @@ class Game(sge.dsp.Game):
                 print()
 
                 if self.cheatcode.lower() == "knowitall":
-                    hlib.map_revealed = set(hlib.map_objects.keys())
+                    map_surface.reveal_cells(hlib.map_objects)
                 elif self.cheatcode.lower() == "seenitall":
-                    hlib.map_explored = hlib.map_revealed
+                    # Copied since the sets are changed in place.
+                    hlib.map_explored = hlib.map_revealed.copy()
                 elif self.cheatcode.startswith("tele"):
                     warp(self.cheatcode[4:] + ".json")
                 else:
@@ -206,6 +261,8 @@ class Level(sge.dsp.Room):
         self.music = music
         self.music_noloop = music_noloop
         self.timeline_objects = {}
+        self.players = []
+        self.frame = 0
         self.shake_queue = 0
         self.death_time = None
         self.status_text = None
@@ -227,43 +284,191 @@ class Level(sge.dsp.Room):
 
         self.disable_lights = disable_lights or self.ambient_light is None
 
+        objects = merge_walls(objects)
+        self.lights = hlib.lights.LightRegistry()
+        self.occupancy = hlib.occupancy.OccupancyGrid(
+            kwargs.get("width") or sge.game.width,
+            kwargs.get("height") or sge.game.height)
+        self.particles = hlib.particles.ParticlePool()
+        self.ai = hlib.ai.ThinkScheduler()
+
         super().__init__(objects, background=background,
                          object_area_width=object_area_width,
                          object_area_height=object_area_height, **kwargs)
         self.add(gui_handler)
 
+    def add(self, obj):
+        super().add(obj)
+        # Only objects which actually project light are worth finding
+        # every frame.
+        if (isinstance(obj, InteractiveObject) and
+                (type(obj).project_light
+                 is not InteractiveObject.project_light)):
+            self.lights.add(obj)
+        if isinstance(obj, InteractiveObject) and obj.think_cost:
+            self.ai.add(obj)
+        if isinstance(obj, xsge_physics.Wall):
+            static = not isinstance(obj, (xsge_physics.MobileWall,
+                                          InteractiveObject))
+            self.occupancy.add(obj, static=static)
+
+    def remove(self, obj):
+        self.lights.remove(obj)
+        self.ai.remove(obj)
+        self.occupancy.remove(obj)
+        super().remove(obj)
+
+    def project_lights(self):
+        # Objects seen by more than one view should only have their
+        # lights projected once.
+        lights = {}
+        for view in self.views:
+            lights.update(dict.fromkeys(self.lights.get_objects_at(
+                view.x - hlib.LIGHT_RANGE, view.y - hlib.LIGHT_RANGE,
+                view.width + hlib.LIGHT_RANGE*2,
+                view.height + hlib.LIGHT_RANGE*2)))
+
+        for obj in lights:
+            obj.project_light()
+
     def load_timeline(self, timeline):
-        self.timeline = {}
+        self.timeline = collections.deque()
+        self.timeline_index = 0
         self.timeline_name = ""
         self.timeline_step = 0
         self.timeline_skip_target = None
         if timeline:
             self.timeline_name = timeline
             fname = os.path.join(hlib.datadir, "timelines", timeline)
-            with open(fname, 'r') as f:
-                jt = json.load(f)
-
-            for i in jt:
-                self.timeline[eval(i)] = jt[i]
+            self.timeline.extend(hlib.timeline.load(fname))
 
     def add_timeline_object(self, obj):
         if obj.ID is not None:
             self.timeline_objects[obj.ID] = weakref.ref(obj)
 
     def timeline_skipto(self, step):
-        t_keys = sorted(self.timeline.keys())
         self.timeline_step = step
-        while t_keys and t_keys[0] < step:
-            i = t_keys.pop(0)
-            self.timeline[i] = []
+        while self.timeline and self.timeline[0][0] < step:
+            self.timeline_next()
+
+    def timeline_next(self):
+        self.timeline.popleft()
+        self.timeline_index = 0
+
+    def update_timeline(self, delta_mult):
+        """
+        Run the commands of the timeline which are due and advance the
+        timeline by ``delta_mult`` steps.
+        """
+        loc = {"self": self}
+        while self.timeline and self.timeline[0][0] <= self.timeline_step:
+            step, commands = self.timeline[0]
+            loop_start = None
+            while self.timeline_index < len(commands):
+                command = commands[self.timeline_index]
+                self.timeline_index += 1
+                name = command[0]
+
+                if name == "setattr":
+                    obj, attr, value = command[1:]
+                    try:
+                        value = eval(value, globals(), loc)
+                    except Exception as e:
+                        m = _("An error occurred in a timeline "
+                              "'setattr' command:\n\n{}").format(
+                                  traceback.format_exc())
+                        show_error(m)
+                    else:
+                        if obj in self.timeline_objects:
+                            obj = self.timeline_objects[obj]()
+                            if obj is not None:
+                                setattr(obj, attr, value)
+                        elif obj == "__level__":
+                            setattr(self, attr, value)
+                elif name == "call":
+                    obj, method, args = command[1:]
+                    fa = [eval(a, globals(), loc) for a in args]
+
+                    if obj in self.timeline_objects:
+                        obj = self.timeline_objects[obj]()
+                        if obj is not None:
+                            getattr(obj, method, lambda: None)(*fa)
+                    elif obj == "__level__":
+                        getattr(self, method, lambda: None)(*fa)
+                elif name == "dialog":
+                    DialogBox(gui_handler, _(command[1])).show()
+                elif name == "play_music":
+                    self.music = command[1]
+                    play_music(command[1])
+                elif name == "timeline":
+                    if self.timeline_name not in hlib.watched_timelines:
+                        hlib.watched_timelines = hlib.watched_timelines[:]
+                        hlib.watched_timelines.append(self.timeline_name)
+                    self.load_timeline(command[1])
+                    break
+                elif name == "skip_to":
+                    self.timeline_skipto(command[1])
+                    break
+                elif name == "exec":
+                    try:
+                        exec(command[1], globals(), loc)
+                    except Exception as e:
+                        m = _("An error occurred in a timeline 'exec' "
+                              "command:\n\n{}").format(
+                                  traceback.format_exc())
+                        show_error(m)
+                elif name in {"if", "while"}:
+                    try:
+                        r = eval(command[1], globals(), loc)
+                    except Exception as e:
+                        if name == "if":
+                            m = _("An error occurred in a timeline 'if' "
+                                  "statement:\n\n{}")
+                        else:
+                            m = _("An error occurred in a timeline "
+                                  "'while' statement:\n\n{}")
+                        show_error(m.format(traceback.format_exc()))
+                        r = False
+
+                    if not r:
+                        self.timeline_next()
+                        break
+                    elif name == "while":
+                        loop_start = self.timeline_index - 1
+                elif name == "if_watched":
+                    if self.timeline_name not in hlib.watched_timelines:
+                        self.timeline_next()
+                        break
+                elif name == "if_not_watched":
+                    if self.timeline_name in hlib.watched_timelines:
+                        self.timeline_next()
+                        break
+            else:
+                if loop_start is not None:
+                    # Go back to the loop's condition next frame, with
+                    # the timeline held where it is until then.
+                    self.timeline_index = loop_start
+                    return
+
+                self.timeline_next()
+
+        if (not self.timeline and self.timeline_name and
+                self.timeline_name not in hlib.watched_timelines):
+            hlib.watched_timelines = hlib.watched_timelines[:]
+            hlib.watched_timelines.append(self.timeline_name)
+            self.timeline_name = ""
+
+        self.timeline_step += delta_mult
 
     def show_hud(self):
         # Show darkness
-        if self.ambient_light:
-            xsge_lighting.project_darkness(ambient_light=self.ambient_light,
-                                           buffer=hlib.TILE_SIZE * 2)
-        else:
-            xsge_lighting.clear_lights()
+        with profiler.section("lighting"):
+            if self.ambient_light:
+                xsge_lighting.project_darkness(
+                    ambient_light=self.ambient_light,
+                    buffer=hlib.TILE_SIZE * 2)
+            else:
+                xsge_lighting.clear_lights()
 
         if not hlib.no_hud:
             if self.status_text:
@@ -302,7 +507,31 @@ class Level(sge.dsp.Room):
                                                        "credits.json"))
         credits_room.start()
 
+    def prefetch_neighbors(self):
+        # Start parsing the rooms this room's doors lead to (nearest
+        # first) so they're ready by the time the player gets there.
+        dests = []
+        for obj in self.objects:
+            if isinstance(obj, (Door, Tunnel)) and obj.dest:
+                level_f = obj.dest.split(':', 1)[0]
+                if level_f and level_f != self.fname:
+                    if hlib.player is not None:
+                        d = math.hypot(obj.x - hlib.player.x,
+                                       obj.y - hlib.player.y)
+                    else:
+                        d = 0
+                    dests.append((d, level_f))
+
+        fnames = []
+        for d, level_f in sorted(dests):
+            fname = os.path.join(hlib.datadir, "rooms", level_f)
+            if fname not in fnames:
+                fnames.append(fname)
+
+        hlib.rooms.prefetch(fnames)
+
     def event_room_start(self):
+        profiler.set_room(self.fname)
         if hlib.player is not None:
             self.add(hlib.player)
 
@@ -310,166 +539,37 @@ class Level(sge.dsp.Room):
 
         play_music(self.music, noloop=self.music_noloop)
 
+        self.prefetch_neighbors()
+
     def event_room_resume(self):
         play_music(self.music, noloop=self.music_noloop)
 
     def event_step(self, time_passed, delta_mult):
+        self.frame += 1
         hlib.time_taken += time_passed / 1000
+        self.ai.new_frame()
 
-        for view in self.views:
-            for obj in self.get_objects_at(
-                    view.x - hlib.LIGHT_RANGE, view.y - hlib.LIGHT_RANGE,
-                    view.width + hlib.LIGHT_RANGE * 2,
-                    view.height + hlib.LIGHT_RANGE * 2):
-                if isinstance(obj, InteractiveObject):
-                    if not self.disable_lights:
-                        obj.project_light()
+        with profiler.section("physics"):
+            self.particles.update(time_passed, delta_mult, self.occupancy)
+        self.particles.draw(self)
 
-        # Show HUD
-        self.show_hud()
+        if not self.disable_lights:
+            with profiler.section("lighting"):
+                self.project_lights()
 
-        # Timeline events
-        t_keys = sorted(self.timeline.keys())
-        while t_keys:
-            i = t_keys.pop(0)
-            if i <= self.timeline_step:
-                while i in self.timeline and self.timeline[i]:
-                    command = self.timeline[i].pop(0)
-                    command = command.split(None, 1)
-                    if command:
-                        if len(command) >= 2:
-                            command, arg = command[:2]
-                        else:
-                            command = command[0]
-                            arg = ""
-
-                        if command.startswith("#"):
-                            # Comment; do nothing
-                            pass
-                        elif command == "setattr":
-                            args = arg.split(None, 2)
-                            if len(args) >= 3:
-                                obj, name, value = args[:3]
-
-                                try:
-                                    value = eval(value)
-                                except Exception as e:
-                                    m = _("An error occurred in a timeline "
-                                          "'setattr' command:\n\n{}").format(
-                                              traceback.format_exc())
-                                    show_error(m)
-                                else:
-                                    if obj in self.timeline_objects:
-                                        obj = self.timeline_objects[obj]()
-                                        if obj is not None:
-                                            setattr(obj, name, value)
-                                    elif obj == "__level__":
-                                        setattr(self, name, value)
-                        elif command == "call":
-                            args = arg.split()
-                            if len(args) >= 2:
-                                obj, method = args[:2]
-                                fa = [eval(s) for s in args[2:]]
-
-                                if obj in self.timeline_objects:
-                                    obj = self.timeline_objects[obj]()
-                                    if obj is not None:
-                                        getattr(obj, method, lambda: None)(*fa)
-                                elif obj == "__level__":
-                                    getattr(self, method, lambda: None)(*fa)
-                        elif command == "dialog":
-                            DialogBox(gui_handler, _(arg)).show()
-                        elif command == "play_music":
-                            self.music = arg
-                            play_music(arg)
-                        elif command == "timeline":
-                            if self.timeline_name not in hlib.watched_timelines:
-                                hlib.watched_timelines = hlib.watched_timelines[:]
-                                hlib.watched_timelines.append(self.timeline_name)
-                            self.load_timeline(arg)
-                            break
-                        elif command == "skip_to":
-                            try:
-                                arg = float(arg)
-                            except ValueError:
-                                pass
-                            else:
-                                self.timeline_skipto(arg)
-                                break
-                        elif command == "exec":
-                            try:
-                                exec(arg)
-                            except Exception as e:
-                                m = _("An error occurred in a timeline 'exec' "
-                                      "command:\n\n{}").format(
-                                          traceback.format_exc())
-                                show_error(m)
-                        elif command == "if":
-                            try:
-                                r = eval(arg)
-                            except Exception as e:
-                                m = _("An error occurred in a timeline 'if' "
-                                      "statement:\n\n{}").format(
-                                          traceback.format_exc())
-                                show_error(m)
-                                r = False
-                            finally:
-                                if not r:
-                                    self.timeline[i] = []
-                                    break
-                        elif command == "if_watched":
-                            if self.timeline_name not in hlib.watched_timelines:
-                                self.timeline[i] = []
-                                break
-                        elif command == "if_not_watched":
-                            if self.timeline_name in hlib.watched_timelines:
-                                self.timeline[i] = []
-                                break
-                        elif command == "while":
-                            try:
-                                r = eval(arg)
-                            except Exception as e:
-                                m = _("An error occurred in a timeline "
-                                      "'while' statement:\n\n{}").format(
-                                          traceback.format_exc())
-                                show_error(m)
-                                r = False
-                            finally:
-                                if r:
-                                    cur_timeline = self.timeline[i][:]
-                                    while_command = "while {}".format(arg)
-                                    self.timeline[i].insert(0, while_command)
-                                    t_keys.insert(0, i)
-                                    self.timeline[i - 1] = cur_timeline
-                                    self.timeline[i] = loop_timeline
-                                    i -= 1
-                                    self.timeline_step -= 1
-                                else:
-                                    self.timeline[i] = []
-                                    break
-                else:
-                    del self.timeline[i]
-            else:
-                break
-        else:
-            if (self.timeline_name and
-                    self.timeline_name not in hlib.watched_timelines):
-                hlib.watched_timelines = hlib.watched_timelines[:]
-                hlib.watched_timelines.append(self.timeline_name)
-                self.timeline_name = ""
+        # Show HUD
+        with profiler.section("hud"):
+            self.show_hud()
 
-        self.timeline_step += delta_mult
+        with profiler.section("timeline"):
+            self.update_timeline(delta_mult)
 
     def event_paused_step(self, time_passed, delta_mult):
+        self.particles.draw(self)
+
         # Handle lighting
-        for view in self.views:
-            for obj in self.get_objects_at(
-                    view.x - hlib.LIGHT_RANGE, view.y - hlib.LIGHT_RANGE,
-                    view.width + hlib.LIGHT_RANGE*2,
-                    view.height + hlib.LIGHT_RANGE*2):
-                if isinstance(obj, InteractiveObject):
-                    if not self.disable_lights:
-                        obj.project_light()
+        if not self.disable_lights:
+            self.project_lights()
 
         self.show_hud()
 
@@ -508,8 +608,8 @@ class Level(sge.dsp.Room):
                 print(_("Loading \"{}\"…").format(fname))
 
         try:
-            r = xsge_tiled.load(os.path.join(hlib.datadir, "rooms", fname), cls=cls,
-                                types=TYPES)
+            r = hlib.rooms.load(os.path.join(hlib.datadir, "rooms", fname),
+                                cls=cls, types=TYPES)
         except Exception as e:
             m = _("An error occurred when trying to load the level:\n\n"
                   "{}").format(traceback.format_exc())
@@ -781,6 +881,61 @@ class Death(sge.dsp.Object):
         super().__init__(*args, **kwargs)
 
 
+class BulletGuide(xsge_physics.Collider):
+
+    """
+    Collider which Anneroy pushes through walls to find where her
+    bullets start.  It is never added to the room, so one can be kept
+    and reused for every shot; :meth:`collision` checks against the
+    room's objects without needing it to be in the room.
+    """
+
+    def collision(self, other=None, x=None, y=None):
+        if not self.tangible:
+            return []
+
+        x = 0 if x is None else x - self.x
+        y = 0 if y is None else y - self.y
+        if self.collision_precise:
+            ax = self.mask_x + x
+            ay = self.mask_y + y
+            w = len(self.mask)
+            h = len(self.mask[0]) if self.mask else 0
+        else:
+            ax = self.bbox_left + x
+            ay = self.bbox_top + y
+            w = self.bbox_width
+            h = self.bbox_height
+
+        collisions = []
+        for obj in sge.game.current_room.get_objects_at(ax, ay, w, h):
+            if not obj.tangible:
+                continue
+            if other is not None:
+                if isinstance(other, sge.dsp.Object):
+                    if obj is not other:
+                        continue
+                elif isinstance(other, (list, tuple, set)):
+                    if obj not in other:
+                        continue
+                elif not isinstance(obj, other):
+                    continue
+
+            if (self.collision_precise or self.collision_ellipse
+                    or obj.collision_precise or obj.collision_ellipse):
+                if sge.collision.masks_collide(
+                        self.mask_x + x, self.mask_y + y, self.mask,
+                        obj.mask_x, obj.mask_y, obj.mask):
+                    collisions.append(obj)
+            elif sge.collision.rectangles_collide(
+                    self.bbox_left + x, self.bbox_top + y, self.bbox_width,
+                    self.bbox_height, obj.bbox_left, obj.bbox_top,
+                    obj.bbox_width, obj.bbox_height):
+                collisions.append(obj)
+
+        return collisions
+
+
 class Player(xsge_physics.Collider):
 
     name = "Ian C."
@@ -880,8 +1035,8 @@ class Player(xsge_physics.Collider):
         self.input_lock = False
         self.warp_dest = None
 
-        self.hud_sprite = sge.gfx.Sprite(width=hlib.SCREEN_SIZE[0],
-                                         height=hlib.SCREEN_SIZE[1])
+        self.hud_layers = {}
+        self.healthbar_strip = None
 
         self.reset_input()
         self.etanks_used = 0
@@ -992,7 +1147,8 @@ class Player(xsge_physics.Collider):
 
     def hurt(self, damage=1, touching=False):
         if not self.hitstun and not self.invincible:
-            play_sound(hlib.hurt_sound, self.x, self.y)
+            play_sound(hlib.hurt_sound, self.x, self.y,
+                       priority=hlib.SOUND_PRIORITY_PLAYER)
             if not hlib.god:
                 self.hp -= damage
 
@@ -1009,7 +1165,8 @@ class Player(xsge_physics.Collider):
             sge.snd.Music.stop()
             sge.game.current_room.alarms["death"] = hlib.DEATH_TIME
 
-        play_sound(hlib.death_sound, self.x, self.y)
+        play_sound(hlib.death_sound, self.x, self.y,
+                   priority=hlib.SOUND_PRIORITY_PLAYER)
         self.destroy()
 
     def refresh(self):
@@ -1031,55 +1188,119 @@ class Player(xsge_physics.Collider):
         self.xvelocity = 0
         self.yvelocity = 0
 
+    def update_hud_layer(self, name, key, draw):
+        """
+        Redraw the HUD layer ``name`` by calling ``draw`` if it was last
+        drawn with a different ``key``.  ``draw`` is passed the layer's
+        old sprite, or :const:`None`, and returns a tuple
+        ``(sprite, x, y)``, where ``sprite`` may be :const:`None` to
+        show nothing.
+        """
+        layer = self.hud_layers.get(name)
+        if layer is None:
+            self.hud_layers[name] = (key,) + draw(None)
+        elif layer[0] != key:
+            self.hud_layers[name] = (key,) + draw(layer[1])
+
+    def get_healthbar_strip(self):
+        # Full health bar drawn once, so that any amount of health can
+        # be shown by cutting it off.  The overlapping edges of the
+        # segments are the same, so this looks the same as drawing
+        # just the segments needed.
+        front = hlib.healthbar_sprite
+        w = front.width - front.origin_x
+        width = w*(self.max_hp-1) + front.width
+        if (self.healthbar_strip is None
+                or self.healthbar_strip.width != width):
+            strip = sge.gfx.Sprite(width=width, height=front.height)
+            strip.draw_lock()
+            for i in range(self.max_hp):
+                strip.draw_sprite(front, 0, front.origin_x + i*w, 0)
+            strip.draw_unlock()
+            self.healthbar_strip = strip
+
+        return self.healthbar_strip
+
     def update_hud(self):
-        self.hud_sprite.draw_clear()
         if hlib.no_hud:
+            self.hud_layers = {}
             return
 
-        self.hud_sprite.draw_lock()
         start_x = 8
         start_y = 8
-
-        x = start_x
-        y = start_y
         back_left = hlib.healthbar_back_left_sprite
         back_center = hlib.healthbar_back_center_sprite
         back_right = hlib.healthbar_back_right_sprite
         front = hlib.healthbar_sprite
-
-        self.hud_sprite.draw_sprite(back_left, 0, x, y)
-        x += back_left.width - back_left.origin_x
-        bar_xstart = x
-
-        w = back_center.width - back_center.origin_x
-        for i in range(self.max_hp):
-            self.hud_sprite.draw_sprite(back_center, 0, x, y)
-            x += w
-
-        self.hud_sprite.draw_sprite(back_right, 0, x, y)
-        bar_xend = x + back_right.width - back_right.origin_x
-
-        x = bar_xstart 
-        w = front.width - front.origin_x
-        for i in range(self.hp):
-            self.hud_sprite.draw_sprite(front, 0, x, y)
-            x += w
-
-        x = start_x
-        y += 4 + back_center.height
-        w = hlib.etank_empty_sprite.width
-        h = hlib.etank_empty_sprite.height
-        for i in range(hlib.etanks):
-            if x + w >= bar_xend:
-                x = start_x
-                y += h
-
-            if i < hlib.etanks - self.etanks_used:
-                self.hud_sprite.draw_sprite(hlib.etank_full_sprite, 0, x, y)
+        bar_xstart = start_x + back_left.width - back_left.origin_x
+        bar_xend = (bar_xstart
+                    + self.max_hp * (back_center.width - back_center.origin_x)
+                    + back_right.width - back_right.origin_x)
+
+        def draw_back(sprite):
+            sprite = sge.gfx.Sprite(width=(bar_xend - start_x),
+                                    height=back_center.height)
+            sprite.draw_lock()
+            sprite.draw_sprite(back_left, 0, 0, 0)
+            x = bar_xstart - start_x
+            w = back_center.width - back_center.origin_x
+            for i in range(self.max_hp):
+                sprite.draw_sprite(back_center, 0, x, 0)
+                x += w
+            sprite.draw_sprite(back_right, 0, x, 0)
+            sprite.draw_unlock()
+            return (sprite, start_x, start_y)
+
+        def draw_fill(sprite):
+            strip = self.get_healthbar_strip()
+            if sprite is None or sprite.width != strip.width:
+                sprite = sge.gfx.Sprite(width=strip.width,
+                                        height=strip.height)
+            hp = max(0, min(self.hp, self.max_hp))
+            if hp:
+                end = (front.width - front.origin_x) * (hp-1) + front.width
             else:
-                self.hud_sprite.draw_sprite(hlib.etank_empty_sprite, 0, x, y)
+                end = 0
+            sprite.draw_clear()
+            sprite.draw_sprite(strip, 0, 0, 0)
+            sprite.draw_erase(end, 0, sprite.width - end, sprite.height)
+            return (sprite, bar_xstart - front.origin_x, start_y)
+
+        etanks_y = start_y + 4 + back_center.height
+
+        def draw_etanks(sprite):
+            w = hlib.etank_empty_sprite.width
+            h = hlib.etank_empty_sprite.height
+            positions = []
+            x = start_x
+            y = etanks_y
+            for i in range(hlib.etanks):
+                if x + w >= bar_xend:
+                    x = start_x
+                    y += h
+                positions.append((x - start_x, y - etanks_y))
+                x += w
+
+            if not positions:
+                return (None, start_x, etanks_y)
+
+            sprite = sge.gfx.Sprite(
+                width=max(x for x, y in positions) + w,
+                height=max(y for x, y in positions) + h)
+            sprite.draw_lock()
+            for i, (x, y) in enumerate(positions):
+                if i < hlib.etanks - self.etanks_used:
+                    sprite.draw_sprite(hlib.etank_full_sprite, 0, x, y)
+                else:
+                    sprite.draw_sprite(hlib.etank_empty_sprite, 0, x, y)
+            sprite.draw_unlock()
+            return (sprite, start_x, etanks_y)
 
-            x += w
+        self.update_hud_layer("back", (self.max_hp,), draw_back)
+        self.update_hud_layer("fill", (self.max_hp, self.hp), draw_fill)
+        self.update_hud_layer(
+            "etanks", (self.max_hp, hlib.etanks, self.etanks_used),
+            draw_etanks)
 
         if hlib.god or "map" in hlib.progress_flags:
             w = 7
@@ -1097,23 +1318,38 @@ class Player(xsge_physics.Collider):
                 pl_x = None
                 pl_y = None
 
-            map_s = draw_map(x, y, w, h, pl_x, pl_y)
-            c = sge.gfx.Color((255, 255, 255, 192))
-            map_s.draw_rectangle(0, 0, map_s.width, map_s.height, fill=c,
-                                 blend_mode=sge.BLEND_RGBA_MULTIPLY)
-
-            x = hlib.SCREEN_SIZE[0] - start_x - w*hlib.MAP_CELL_WIDTH
-            y = start_y
-            self.hud_sprite.draw_sprite(map_s, 0, x, y)
-            self.hud_sprite.draw_rectangle(x, y, map_s.width, map_s.height,
-                                           outline=sge.gfx.Color("white"))
-
-        self.hud_sprite.draw_unlock()
-                
+            def draw_map(sprite):
+                map_s = map_surface.draw_window(x, y, w, h, pl_x, pl_y)
+                c = sge.gfx.Color((255, 255, 255, 192))
+                map_s.draw_rectangle(0, 0, map_s.width, map_s.height, fill=c,
+                                     blend_mode=sge.BLEND_RGBA_MULTIPLY)
+
+                # One pixel of margin on each side for the outline.
+                if (sprite is None or sprite.width != map_s.width + 2
+                        or sprite.height != map_s.height + 2):
+                    sprite = sge.gfx.Sprite(width=(map_s.width + 2),
+                                            height=(map_s.height + 2))
+                sprite.draw_lock()
+                sprite.draw_clear()
+                sprite.draw_sprite(map_s, 0, 1, 1)
+                sprite.draw_rectangle(1, 1, map_s.width, map_s.height,
+                                      outline=sge.gfx.Color("white"))
+                sprite.draw_unlock()
+                map_x = hlib.SCREEN_SIZE[0] - start_x - w*hlib.MAP_CELL_WIDTH
+                return (sprite, map_x - 1, start_y - 1)
+
+            map_surface.update()
+            self.update_hud_layer("map", (x, y, pl_x, pl_y, map_surface.state),
+                                  draw_map)
+        else:
+            self.hud_layers.pop("map", None)
 
     def show_hud(self):
         if not hlib.no_hud:
-            sge.game.project_sprite(self.hud_sprite, 0, 0, 0)
+            with profiler.section("hud"):
+                for key, sprite, x, y in self.hud_layers.values():
+                    if sprite is not None:
+                        sge.game.project_sprite(sprite, 0, x, y, 0)
 
             if not self.human:
                 room = sge.game.current_room
@@ -1137,6 +1373,8 @@ class Player(xsge_physics.Collider):
         self.view.y = self.camera_target_y
 
     def event_create(self):
+        if self not in sge.game.current_room.players:
+            sge.game.current_room.players.append(self)
         self.z = sge.game.current_room.player_z
         sge.game.current_room.add_timeline_object(self)
         self.view = sge.game.current_room.views[self.player]
@@ -1147,6 +1385,10 @@ class Player(xsge_physics.Collider):
         self.init_position()
         self.update_hud()
 
+    def event_destroy(self):
+        if self in sge.game.current_room.players:
+            sge.game.current_room.players.remove(self)
+
     def event_begin_step(self, time_passed, delta_mult):
         self.refresh_input()
 
@@ -1301,13 +1543,7 @@ class Player(xsge_physics.Collider):
             xr += get_xregion(self.x)
             yr += get_yregion(self.y)
             if xr != self.last_xr or yr != self.last_yr:
-                pos = (xr, yr)
-                if pos not in hlib.map_explored:
-                    hlib.map_explored = hlib.map_explored.copy()
-                    hlib.map_explored.add(pos)
-                if pos not in hlib.map_revealed:
-                    hlib.map_revealed = hlib.map_revealed.copy()
-                    hlib.map_revealed.add(pos)
+                map_surface.explore((xr, yr))
                 self.update_hud()
             self.last_xr = xr
             self.last_yr = yr
@@ -1491,6 +1727,7 @@ class Anneroy(Player):
 
         self.torso = None
         self.hedgehog_spikes = None
+        self.bullet_guide = None
         self.fixed_sprite = False
         self.crouching = False
         self.ball = False
@@ -1503,6 +1740,13 @@ class Anneroy(Player):
 
     def get_up_obstructed(self, x, y, w, h, lax=0):
         def _get_up_obstructed(self=self, x=x, y=y, w=w, h=h):
+            flags = sge.game.current_room.occupancy.rect(self.x + x,
+                                                         self.y + y, w, h)
+            if not flags & (hlib.occupancy.BOTTOM
+                            | hlib.occupancy.SLOPE_BOTTOM_LEFT
+                            | hlib.occupancy.SLOPE_BOTTOM_RIGHT):
+                return False
+
             for other in sge.collision.rectangle(self.x + x, self.y + y, w, h):
                 if isinstance(other, xsge_physics.SolidBottom):
                     if not self.collision(other):
@@ -1725,6 +1969,84 @@ class Anneroy(Player):
             if self.yvelocity < -hlib.ANNEROY_YRECOIL_MAX:
                 self.yvelocity = -hlib.ANNEROY_YRECOIL_MAX
 
+    def get_bullet_position(self, x, y):
+        """
+        Return the position a new bullet aimed at the offset ``(x, y)``
+        from the torso should start at, as a tuple ``(x, y)``.
+
+        The bullet starts at Anneroy's edge and is pushed towards the
+        offset with physics, using a :class:`BulletGuide` kept for every
+        shot, so that it can't be shot through walls.  If there are no
+        walls anywhere near its path, the result of this is worked out
+        directly instead.
+        """
+        if x:
+            m = y / x
+        else:
+            m = None
+
+        sprite = anneroy_bullet_sprite
+        if self.facing > 0:
+            start_x = self.bbox_right - sprite.bbox_width - sprite.bbox_x
+        else:
+            start_x = self.bbox_left - sprite.bbox_x
+        if self.aim_direction < 0:
+            start_y = self.bbox_bottom - sprite.bbox_height - sprite.bbox_y
+        else:
+            start_y = self.bbox_top - sprite.bbox_y
+        x += self.torso.x - start_x
+        y += self.torso.y - start_y
+        xsteps = int(abs(x) / sprite.bbox_width)
+        ysteps = int(abs(y) / sprite.bbox_height)
+        xfinal = math.copysign(abs(x) - xsteps * sprite.bbox_width, x)
+        yfinal = math.copysign(abs(y) - ysteps * sprite.bbox_height, y)
+
+        # Slopes can pull a collider up to a pixel away from them, so
+        # the path is widened by a pixel on every side.
+        occupancy = sge.game.current_room.occupancy
+        if not occupancy.rect(start_x + sprite.bbox_x + min(x, 0) - 1,
+                              start_y + sprite.bbox_y + min(y, 0) - 1,
+                              sprite.bbox_width + abs(x) + 2,
+                              sprite.bbox_height + abs(y) + 2):
+            # Nothing can stop the guide, so just add up its movements
+            # in the same order it would make them.
+            for i in range(xsteps):
+                start_x += math.copysign(sprite.bbox_width, x)
+            for i in range(ysteps):
+                start_y += math.copysign(sprite.bbox_height, y)
+            guide_x = start_x + xfinal
+            guide_y = start_y + yfinal
+        else:
+            guide = self.bullet_guide
+            if guide is None:
+                guide = self.bullet_guide = BulletGuide(start_x, start_y,
+                                                        sprite=sprite)
+            else:
+                guide.x = start_x
+                guide.y = start_y
+            for i in range(xsteps):
+                guide.move_x(math.copysign(guide.bbox_width, x))
+            for i in range(ysteps):
+                guide.move_y(math.copysign(guide.bbox_height, y))
+            guide.move_x(xfinal)
+            guide.move_y(yfinal)
+            guide_x = guide.x
+            guide_y = guide.y
+
+        # Keep diagonal shots on their line if the guide was stopped
+        # short.
+        if abs(self.aim_direction) == 1 and m:
+            target_x = self.torso.x + x
+            target_y = self.torso.y + y
+            xdiff = guide_x - self.torso.x
+            ydiff = guide_y - self.torso.y
+            if abs(guide_x - target_x) >= 1:
+                guide_y = self.torso.y + m*xdiff
+            elif abs(guide_y - target_y) >= 1:
+                guide_x = self.torso.x + ydiff/m
+
+        return guide_x, guide_y
+
     def shoot_default(self):
         if "shoot_lock" in self.alarms:
             return
@@ -1736,7 +2058,8 @@ class Anneroy(Player):
             self.alarms["shoot_lock"] = 60
             self.last_aim_direction = self.aim_direction
 
-            play_sound(hlib.cancel_sound, self.image_xcenter, self.image_ycenter)
+            play_sound(hlib.cancel_sound, self.image_xcenter,
+                       self.image_ycenter, priority=hlib.SOUND_PRIORITY_PLAYER)
 
             return
 
@@ -1755,7 +2078,7 @@ class Anneroy(Player):
             self.fixed_sprite = "hedgehog"
             self.alarms["hedgehog_extend"] = hlib.ANNEROY_HEDGEHOG_FRAME_TIME
             play_sound(hlib.hedgehog_spikes_sound, self.image_xcenter,
-                       self.image_ycenter)
+                       self.image_ycenter, priority=hlib.SOUND_PRIORITY_PLAYER)
             self.rolling = False
 
             if hlib.god or "sloth_ball" in hlib.progress_flags:
@@ -1849,62 +2172,25 @@ class Anneroy(Player):
 
             self.recoil(image_rotation)
 
-            if x:
-                m = y / x
-            else:
-                m = None
-
             xdest = self.torso.x + x
             ydest = self.torso.y + y
-            guide = xsge_physics.Collider.create(
-                self.torso.x, self.torso.y, sprite=anneroy_bullet_sprite)
-            if self.facing > 0:
-                guide.bbox_right = self.bbox_right
-            else:
-                guide.bbox_left = self.bbox_left
-            if self.aim_direction < 0:
-                guide.bbox_bottom = self.bbox_bottom
-            else:
-                guide.bbox_top = self.bbox_top
-            x += self.torso.x - guide.x
-            y += self.torso.y - guide.y
-            xsteps = int(abs(x) / guide.bbox_width)
-            ysteps = int(abs(y) / guide.bbox_height)
-            xfinal = math.copysign(abs(x) - xsteps * guide.bbox_width, x)
-            yfinal = math.copysign(abs(y) - ysteps * guide.bbox_height, y)
-            for i in range(xsteps):
-                guide.move_x(math.copysign(guide.bbox_width, x))
-            for i in range(ysteps):
-                guide.move_y(math.copysign(guide.bbox_height, y))
-            guide.move_x(xfinal)
-            guide.move_y(yfinal)
-
-            if abs(self.aim_direction) == 1 and m:
-                target_x = self.torso.x + x
-                target_y = self.torso.y + y
-                xdiff = guide.x - self.torso.x
-                ydiff = guide.y - self.torso.y
-                if abs(guide.x - target_x) >= 1:
-                    guide.y = self.torso.y + m*xdiff
-                elif abs(guide.y - target_y) >= 1:
-                    guide.x = self.torso.x + ydiff/m
+            bullet_x, bullet_y = self.get_bullet_position(x, y)
 
             bs = AnneroyBullet.create(
-                guide.x, guide.y, self.z - 0.2, sprite=anneroy_bullet_sprite,
+                bullet_x, bullet_y, self.z - 0.2, sprite=anneroy_bullet_sprite,
                 xvelocity=xv, yvelocity=yv, regulate_origin=True,
                 image_xscale=abs(self.image_xscale),
                 image_yscale=self.image_yscale, image_rotation=image_rotation,
                 image_blend=self.image_blend)
 
-            guide.destroy()
-
             Smoke.create(
                 xdest, ydest, self.torso.z, sprite=anneroy_bullet_dust_sprite,
                 #xvelocity=self.xvelocity, yvelocity=self.yvelocity,
                 regulate_origin=True, image_xscale=abs(self.image_xscale),
                 image_yscale=self.image_yscale, image_rotation=image_rotation,
                 image_blend=self.image_blend)
-            play_sound(hlib.shoot_sound, xdest, ydest)
+            play_sound(hlib.shoot_sound, xdest, ydest,
+                       priority=hlib.SOUND_PRIORITY_PLAYER)
 
     def shoot(self):
         self.shoot_default()
@@ -1951,7 +2237,8 @@ class Anneroy(Player):
             sge.snd.Music.stop()
             sge.game.current_room.alarms["death"] = hlib.DEATH_TIME
 
-        play_sound(hlib.death_sound, self.x, self.y)
+        play_sound(hlib.death_sound, self.x, self.y,
+                   priority=hlib.SOUND_PRIORITY_PLAYER)
         self.ball = False
         self.hedgehog = False
         self.rolling = False
@@ -2234,13 +2521,12 @@ class Anneroy(Player):
             Smoke.create(self.x, self.y, z=(self.z + 0.1),
                          sprite=anneroy_explode_sprite, tangible=False)
             for i in range(12):
-                shard = Shard.create(
-                    self.x, self.y, self.z, sprite=anneroy_explode_fragments,
-                    image_index=random.randrange(
-                        anneroy_explode_fragments.frames),
+                image_index = random.randrange(
+                    anneroy_explode_fragments.frames)
+                sge.game.current_room.particles.add_debris(
+                    self.x, self.y, self.z, anneroy_explode_fragments, 5,
+                    random.randrange(360), image_index=image_index,
                     image_fps=0)
-                shard.speed = 5
-                shard.move_direction = random.randrange(360)
             self.destroy()
 
     def event_physics_collision_top(self, other, move_loss):
@@ -2255,7 +2541,8 @@ class Anneroy(Player):
             return
 
         if self.hedgehog:
-            play_sound(hlib.ball_land_sound, self.x, self.y)
+            play_sound(hlib.ball_land_sound, self.x, self.y,
+                       priority=hlib.SOUND_PRIORITY_PLAYER)
         elif self.ball:
             if (not self.bouncing
                     or yv >= hlib.ANNEROY_BALL_FORCE_BOUNCE_SPEED):
@@ -2264,14 +2551,16 @@ class Anneroy(Player):
                     hlib.ANNEROY_BALL_BOUNCE_HEIGHT, self.gravity)
             else:
                 self.bouncing = False
-            play_sound(hlib.ball_land_sound, self.x, self.y)
+            play_sound(hlib.ball_land_sound, self.x, self.y,
+                       priority=hlib.SOUND_PRIORITY_PLAYER)
         else:
             self.reset_image()
             self.sprite = anneroy_legs_land_sprite
             self.image_speed = None
             self.image_index = 0
             self.fixed_sprite = "anim"
-            play_sound(hlib.land_sound, self.x, self.y)
+            play_sound(hlib.land_sound, self.x, self.y,
+                       priority=hlib.SOUND_PRIORITY_PLAYER)
 
     def event_jump(self):
         if not self.ball:
@@ -2282,6 +2571,7 @@ class Anneroy(Player):
             self.fixed_sprite = "anim"
 
     def event_destroy(self):
+        super().event_destroy()
         if self.torso is not None:
             self.torso.destroy()
 
@@ -2330,7 +2620,18 @@ class Corpse(xsge_physics.Collider):
             self.destroy()
 
 
-class Smoke(sge.dsp.Object):
+class Smoke(hlib.pools.Pooled, sge.dsp.Object):
+
+    def reset(self, x, y, z=0, *, sprite=None, tangible=True,
+              regulate_origin=False, image_xscale=1, image_yscale=1,
+              image_rotation=0, image_blend=None):
+        self.reset_object(x, y, z, sprite)
+        self.tangible = tangible
+        self.regulate_origin = regulate_origin
+        self.image_xscale = image_xscale
+        self.image_yscale = image_yscale
+        self.image_rotation = image_rotation
+        self.image_blend = image_blend
 
     def event_animation_end(self):
         self.destroy()
@@ -2342,15 +2643,28 @@ class InteractiveObject(sge.dsp.Object):
     spikeable = False
     freezable = False
 
+    # Cost of the decisions made by the object, for the room's
+    # ThinkScheduler; 0 if it doesn't make any.
+    think_cost = 0
+
+    nearest_player = None
+    nearest_player_frame = None
+
     def get_nearest_player(self):
+        room = sge.game.current_room
+        if self.nearest_player_frame == (room, room.frame):
+            return self.nearest_player
+
         player = None
         dist = 0
-        for obj in sge.game.current_room.objects:
-            if isinstance(obj, Player):
-                ndist = math.hypot(self.x - obj.x, self.y - obj.y)
-                if player is None or ndist < dist:
-                    player = obj
-                    dist = ndist
+        for obj in room.players:
+            ndist = math.hypot(self.x - obj.x, self.y - obj.y)
+            if player is None or ndist < dist:
+                player = obj
+                dist = ndist
+
+        self.nearest_player = player
+        self.nearest_player_frame = (room, room.frame)
         return player
 
     def set_direction(self, direction):
@@ -2553,60 +2867,6 @@ class CrowdObject(CrowdBlockingObject):
             super().event_collision(other, xdirection, ydirection)
 
 
-class Shard(FallingObject):
-
-    """Like Corpse, but bounces around a bit before disappearing."""
-
-    fall_speed = 99
-    bounce = 0.5
-    friction = 0.99
-    life = 45
-
-    def stop_left(self):
-        self.xvelocity *= -self.bounce
-
-    def stop_right(self):
-        self.xvelocity *= -self.bounce
-
-    def stop_up(self):
-        self.yvelocity *= -self.bounce
-
-    def stop_down(self):
-        self.yvelocity *= -self.bounce
-
-    def event_create(self):
-        self.alarms["die"] = self.life
-
-    def move(self):
-        super().move()
-        self.speed *= self.friction
-
-    def event_alarm(self, alarm_id):
-        if alarm_id == "die":
-            blend = sge.gfx.Color((255, 255, 255, 0))
-            base_sprite = sge.gfx.Sprite(width=self.sprite.width,
-                                         height=self.sprite.height,
-                                         origin_x=self.sprite.origin_x,
-                                         origin_y=self.sprite.origin_y)
-            base_sprite.draw_sprite(self.sprite, self.image_index,
-                                    self.sprite.origin_x, self.sprite.origin_y)
-            spr = sge.gfx.Sprite.from_tween(
-                base_sprite, int(hlib.FPS / 4), fps=hlib.FPS, blend=blend,
-                blend_mode=sge.BLEND_RGBA_MULTIPLY)
-            Smoke.create(self.x, self.y, z=self.z, sprite=spr, tangible=False,
-                         xvelocity=self.xvelocity, yvelocity=self.yvelocity,
-                         image_origin_x=self.image_origin_x,
-                         image_origin_y=self.image_origin_y,
-                         image_xscale=self.image_xscale,
-                         image_yscale=self.image_yscale,
-                         image_rotation=self.image_rotation,
-                         image_alpha=self.image_alpha,
-                         image_blend=self.image_blend,
-                         image_blend_mode=self.image_blend_mode)
-
-            self.destroy()
-
-
 class Enemy(InteractiveObject):
 
     classname = None
@@ -2646,12 +2906,12 @@ class Enemy(InteractiveObject):
         else:
             shard_num = self.shard_num_min
 
+        particles = sge.game.current_room.particles
         for i in range(shard_num):
-            shard = Shard.create(self.x, self.y, self.z,
-                                 sprite=hlib.enemy_fragment_sprite)
-            shard.speed = random.randint(self.shard_speed_min,
-                                         self.shard_speed_max)
-            shard.move_direction = random.randrange(360)
+            speed = random.randint(self.shard_speed_min, self.shard_speed_max)
+            particles.add_debris(
+                self.x, self.y, self.z, hlib.enemy_fragment_sprite, speed,
+                random.randrange(360))
 
         if random.random() < hlib.LIFE_FORCE_CHANCE:
             LifeForce.create(self.image_xcenter, self.image_ycenter,
@@ -2757,6 +3017,7 @@ class Frog(Enemy, FallingObject, CrowdObject):
     jump_height = 2*hlib.TILE_SIZE + 1
     jump_speed = 3
     jump_interval = hlib.FPS / 2
+    think_cost = 1
 
     def stop_left(self):
         if self.yvelocity >= 0:
@@ -2802,6 +3063,10 @@ class Frog(Enemy, FallingObject, CrowdObject):
 
     def event_alarm(self, alarm_id):
         if alarm_id == "jump":
+            if not sge.game.current_room.ai.may_think(self):
+                self.alarms["jump"] = 1
+                return
+
             target = self.get_nearest_player()
             if target is not None:
                 xvec = target.x - self.image_xcenter
@@ -2830,6 +3095,7 @@ class Hedgehog(Enemy, FallingObject, CrowdBlockingObject):
     roll_friction = 0.05
     walk_frames_per_pixel = 1 / 4
     roll_frames_per_pixel = 1 / 5
+    think_cost = 1
 
     @property
     def slope_acceleration(self):
@@ -2852,26 +3118,37 @@ class Hedgehog(Enemy, FallingObject, CrowdBlockingObject):
         self.bbox_height = 14
         self.rolling = False
         self.anim_lock = False
+        self.charge_xvec = None
         self.sprite = hlib.hedgehog_stand_sprite
 
+    def update_charge(self):
+        # Decide whether to charge at the nearest player, remembering
+        # the horizontal distance to them if so.
+        self.charge_xvec = None
+        target = self.get_nearest_player()
+        if target is not None:
+            xvec = target.x - self.image_xcenter
+            yvec = target.y - self.image_ycenter
+            if math.hypot(xvec, yvec) <= self.charge_distance:
+                self.charge_xvec = xvec
+
     def event_step(self, time_passed, delta_mult):
         self.xacceleration = 0
+        if self.was_on_floor and sge.game.current_room.ai.may_think(self):
+            self.update_charge()
+
         if self.rolling:
             if self.was_on_floor:
                 self.xdeceleration = self.roll_friction
-                target = self.get_nearest_player()
-                if target is not None:
-                    xvec = target.x - self.image_xcenter
+                xvec = self.charge_xvec
+                if xvec is not None:
                     tdir = (xvec > 0) - (xvec < 0)
                     vdir = (self.xvelocity > 0) - (self.xvelocity < 0)
-                    yvec = target.y - self.image_ycenter
-                    dist = math.hypot(xvec, yvec)
-                    if dist <= self.charge_distance and tdir == vdir:
+                    if tdir == vdir:
                         if abs(self.xvelocity) < self.max_speed:
                             self.xacceleration = math.copysign(
                                 self.acceleration, xvec)
                             self.xdeceleration = 0
-                            
             else:
                 self.xdeceleration = 0
 
@@ -2893,23 +3170,19 @@ class Hedgehog(Enemy, FallingObject, CrowdBlockingObject):
         else:
             if self.was_on_floor:
                 self.xdeceleration = self.friction
-                target = self.get_nearest_player()
-                if target is not None:
-                    xvec = target.x - self.image_xcenter
-                    yvec = target.y - self.image_ycenter
-                    dist = math.hypot(xvec, yvec)
-                    if dist <= self.charge_distance:
-                        self.xacceleration = math.copysign(self.acceleration,
-                                                           xvec)
-                        self.xdeceleration = 0
-                        if abs(self.xvelocity) >= self.max_speed:
-                            self.xvelocity = math.copysign(self.max_speed,
-                                                           self.xvelocity)
-                            self.rolling = True
-                            self.anim_lock = True
-                            self.sprite = hlib.hedgehog_compress_sprite
-                            self.image_index = 0
-                            self.image_speed = None
+                xvec = self.charge_xvec
+                if xvec is not None:
+                    self.xacceleration = math.copysign(self.acceleration,
+                                                       xvec)
+                    self.xdeceleration = 0
+                    if abs(self.xvelocity) >= self.max_speed:
+                        self.xvelocity = math.copysign(self.max_speed,
+                                                       self.xvelocity)
+                        self.rolling = True
+                        self.anim_lock = True
+                        self.sprite = hlib.hedgehog_compress_sprite
+                        self.image_index = 0
+                        self.image_speed = None
             else:
                 self.xdeceleration = 0
 
@@ -2933,6 +3206,7 @@ class Worm(Enemy, InteractiveCollider, CrowdBlockingObject):
     touch_damage = 10
     extend_distance = 96
     repeat_delay = 90
+    think_cost = 1
 
     def __init__(self, x, y, **kwargs):
         kwargs["sprite"] = hlib.worm_sprite
@@ -2953,7 +3227,8 @@ class Worm(Enemy, InteractiveCollider, CrowdBlockingObject):
     def event_step(self, time_passed, delta_mult):
         super().event_step(time_passed, delta_mult)
 
-        if self.tangible or "extend_wait" in self.alarms:
+        if (self.tangible or "extend_wait" in self.alarms
+                or not sge.game.current_room.ai.may_think(self)):
             return
 
         target = self.get_nearest_player()
@@ -3198,6 +3473,7 @@ class Mantanoid(Enemy, FallingObject, CrowdBlockingObject):
     sight_distance = 300
     shard_num_min = 8
     shard_num_max = 16
+    think_cost = 3
 
     def __init__(self, x, y, hiding=False, wander_x=None, **kwargs):
         x += hlib.mantanoid_stand_sprite.origin_x
@@ -3296,9 +3572,7 @@ class Mantanoid(Enemy, FallingObject, CrowdBlockingObject):
             self.alarms["move_lock"] = hlib.MANTANOID_WANDER_INTERVAL
 
     def log_action_result(self, action, success):
-        ai_data.setdefault(action, [0, 0])
-        i = 0 if success else 1
-        ai_data[action][i] += 1
+        ai_journal.log(action, success)
 
         # Record the spitballs as a success. Note: we do NOT log
         # failures here since the same spitballs might actually lead to
@@ -3307,8 +3581,7 @@ class Mantanoid(Enemy, FallingObject, CrowdBlockingObject):
         # time.
         if success:
             for spitball in self.spitball_check_ids:
-                ai_data.setdefault(spitball, [0, 0])
-                ai_data[spitball][0] += 1
+                ai_journal.log(spitball, True)
 
     def perform_action(self, action):
         if not self.action and self.can_act:
@@ -3339,15 +3612,12 @@ class Mantanoid(Enemy, FallingObject, CrowdBlockingObject):
         if check_y is None:
             check_y = target_y
 
-        action_id = "{}; {}: ({},{};{}+{})->({},{})|({},{})!{}".format(
+        action_id = ai_table.get_key(
             self.__class__.__name__, sge.game.current_room.fname,
             rough(self.x), rough(self.y), self.image_xscale,
             self.movement_speed, rough(target_x), rough(target_y),
             rough(check_x), rough(check_y), action.__name__)
-
-        ai_data.setdefault(action_id, [0, 0])
-        successes = ai_data[action_id][0]
-        fails = ai_data[action_id][1]
+        successes, fails = ai_table.get(action_id)
 
         if successes >= 3 and successes > fails:
             if target_x is not None:
@@ -3380,7 +3650,7 @@ class Mantanoid(Enemy, FallingObject, CrowdBlockingObject):
 
             self.spitball_check_ids = []
             for s_action, s_x, s_y, s_ixs, s_spd in self.spitball_checks:
-                sid = "{}; {}: ({},{};{}+{})->({},{})|({},{})!{}".format(
+                sid = ai_table.get_key(
                     self.__class__.__name__, sge.game.current_room.fname,
                     rough(s_x), rough(s_y), s_ixs, s_spd, rough(target_x),
                     rough(target_y), rough(check_x), rough(check_y),
@@ -3573,7 +3843,8 @@ class Mantanoid(Enemy, FallingObject, CrowdBlockingObject):
                     + self.get_bottom_touching_slope())
         self.can_act = (self.was_on_floor and on_floor and self.yvelocity >= 0)
 
-        if not self.action and self.can_act:
+        if (not self.action and self.can_act
+                and sge.game.current_room.ai.may_think(self)):
             self.target = self.get_nearest_player()
             dist = 0
             if self.target is not None:
@@ -3765,14 +4036,24 @@ class Boss(InteractiveObject):
                 sge.game.current_room.load_timeline(self.death_timeline)
 
 
-class LifeForce(InteractiveObject):
+class LifeForce(hlib.pools.Pooled, InteractiveObject):
+
+    think_cost = 1
 
     def __init__(self, *args, **kwargs):
         kwargs["sprite"] = hlib.life_force_sprite
         super().__init__(*args, **kwargs)
 
+    def reset(self, x, y, z=0):
+        self.reset_object(x, y, z, hlib.life_force_sprite)
+        self.move_direction = 0
+        self.speed = 0
+        self.nearest_player = None
+        self.nearest_player_frame = None
+
     def move(self):
-        if "set_direction" not in self.alarms:
+        if ("set_direction" not in self.alarms
+                and sge.game.current_room.ai.may_think(self)):
             self.alarms["set_direction"] = hlib.FPS / 4
             target = self.get_nearest_player()
             if target is not None:
@@ -3785,7 +4066,8 @@ class LifeForce(InteractiveObject):
 
     def touch(self, other):
         other.hp += hlib.LIFE_FORCE_HEAL
-        play_sound(hlib.heal_sound, other.x, other.y)
+        play_sound(hlib.heal_sound, other.x, other.y,
+                   priority=hlib.SOUND_PRIORITY_PLAYER)
         self.destroy()
 
 
@@ -3807,6 +4089,28 @@ class Bullet(InteractiveObject):
         """
         self.destroy()
 
+    def get_wall_mask(self):
+        """
+        Return the occupancy flags of the walls the bullet can hit given
+        the direction it's moving in.
+        """
+        mask = 0
+        if self.xvelocity > 0:
+            mask |= (hlib.occupancy.LEFT | hlib.occupancy.SLOPE_TOP_LEFT
+                     | hlib.occupancy.SLOPE_BOTTOM_LEFT)
+        elif self.xvelocity < 0:
+            mask |= (hlib.occupancy.RIGHT | hlib.occupancy.SLOPE_TOP_RIGHT
+                     | hlib.occupancy.SLOPE_BOTTOM_RIGHT)
+
+        if self.yvelocity > 0:
+            mask |= (hlib.occupancy.TOP | hlib.occupancy.SLOPE_TOP_LEFT
+                     | hlib.occupancy.SLOPE_TOP_RIGHT)
+        elif self.yvelocity < 0:
+            mask |= (hlib.occupancy.BOTTOM | hlib.occupancy.SLOPE_BOTTOM_LEFT
+                     | hlib.occupancy.SLOPE_BOTTOM_RIGHT)
+
+        return mask
+
     def shoot_player(self, other):
         other.hurt(self.player_damage)
 
@@ -3844,7 +4148,17 @@ class Bullet(InteractiveObject):
         elif isinstance(other, xsge_physics.Wall) and self.attacks_wall:
             point_x = self.x
             point_y = self.y
-            if ((self.xvelocity > 0 and self.yvelocity > 0)
+            # The checks below can find walls up to a pixel outside of
+            # the bullet, since sge rounds positions and draws lines a
+            # pixel longer, so the area ruled out is widened to match.
+            mask = self.get_wall_mask()
+            if mask and not sge.game.current_room.occupancy.rect(
+                    self.bbox_left - 1, self.bbox_top - 1,
+                    self.bbox_width + 2, self.bbox_height + 2) & mask:
+                # No wall the bullet could hit from this direction is
+                # anywhere near it.
+                collisions = []
+            elif ((self.xvelocity > 0 and self.yvelocity > 0)
                     or (self.xvelocity < 0 and self.yvelocity < 0)):
                 collisions = sge.collision.line(
                     self.bbox_left, self.bbox_top, self.bbox_right,
@@ -3937,13 +4251,26 @@ class Bullet(InteractiveObject):
             self.destroy()
 
 
-class AnneroyBullet(Bullet):
+class AnneroyBullet(hlib.pools.Pooled, Bullet):
 
     attacks_enemy = True
     attacks_bullet = False
     breaks_stone = True
     life = hlib.ANNEROY_BULLET_LIFE
 
+    def reset(self, x, y, z=0, *, sprite=None, xvelocity=0, yvelocity=0,
+              regulate_origin=False, image_xscale=1, image_yscale=1,
+              image_rotation=0, image_blend=None):
+        # The "die" alarm is set again by event_create.
+        self.reset_object(x, y, z, sprite)
+        self.xvelocity = xvelocity
+        self.yvelocity = yvelocity
+        self.regulate_origin = regulate_origin
+        self.image_xscale = image_xscale
+        self.image_yscale = image_yscale
+        self.image_rotation = image_rotation
+        self.image_blend = image_blend
+
     def dissipate(self, xdirection=0, ydirection=0):
         if self not in sge.game.current_room.objects:
             return
@@ -3992,17 +4319,15 @@ class ScorpionBullet(Bullet):
         play_sound(hlib.scorpion_projectile_break_sound, self.image_xcenter,
                    self.image_ycenter)
 
+        particles = sge.game.current_room.particles
         for i in range(self.shard_num):
             life = random.uniform(hlib.FPS / 8, hlib.FPS / 2)
             image_index = random.randrange(
                 0, hlib.scorpion_projectile_shard_sprite.frames)
-            shard = xsge_particle.TimedParticle.create(
-                self.x, self.y, self.z, life=life,
-                sprite=hlib.scorpion_projectile_shard_sprite,
-                image_index=image_index)
-            shard.speed = random.randint(self.shard_speed_min,
-                                         self.shard_speed_max)
-            shard.move_direction = random.randrange(360)
+            speed = random.randint(self.shard_speed_min, self.shard_speed_max)
+            particles.add_spark(
+                self.x, self.y, self.z, hlib.scorpion_projectile_shard_sprite,
+                speed, random.randrange(360), life, image_index)
 
 
 class HedgehogSpikes(InteractiveObject):
@@ -4063,12 +4388,12 @@ class Stone(xsge_physics.Solid):
         else:
             shard_num = self.shard_num_min
 
+        particles = sge.game.current_room.particles
         for i in range(shard_num):
-            shard = Shard.create(self.x, self.y, self.z,
-                                 sprite=hlib.stone_fragment_sprite)
-            shard.speed = random.randint(self.shard_speed_min,
-                                         self.shard_speed_max)
-            shard.move_direction = random.randrange(360)
+            speed = random.randint(self.shard_speed_min, self.shard_speed_max)
+            particles.add_debris(
+                self.x, self.y, self.z, hlib.stone_fragment_sprite, speed,
+                random.randrange(360))
 
 
 class WeakStone(Stone):
@@ -4128,13 +4453,12 @@ class Powerup(InteractiveObject):
         # Remove the powerup from the map
         px = get_xregion(self.image_xcenter)
         py = get_yregion(self.image_ycenter)
-        hlib.map_removed.add(("powerup", sge.game.current_room.fname, px, py))
+        map_surface.remove("powerup", sge.game.current_room.fname, px, py)
 
         self.collect(other)
 
-        for obj in sge.game.current_room.objects:
-            if isinstance(obj, Player):
-                obj.update_hud()
+        for obj in sge.game.current_room.players:
+            obj.update_hud()
 
         DialogBox(gui_handler, self.message, self.sprite).show()
 
@@ -4228,37 +4552,17 @@ class MapDisk(Powerup):
         super().__init__(x, y, **kwargs)
 
     def collect(self, other):
+        cells = set()
         for fname in self.rooms:
-            sge.game.pump_input()
-            if fname in hlib.map_rooms:
-                room = Level.load(fname, True)
+            if fname in hlib.map_rooms and fname in hlib.map_room_info:
                 rm_x, rm_y = hlib.map_rooms[fname]
-                rm_w = int(math.ceil(room.width / hlib.SCREEN_SIZE[0]))
-                rm_h = int(math.ceil(room.height / hlib.SCREEN_SIZE[1]))
+                rm_w, rm_h, ignore_regions = hlib.map_room_info[fname]
+                for y in range(rm_h):
+                    for x in range(rm_w):
+                        if (x, y) not in ignore_regions:
+                            cells.add((rm_x + x, rm_y + y))
 
-                ignore_regions = set()
-                for obj in room.objects:
-                    sge.game.pump_input()
-                    if isinstance(obj, IgnoreRegion):
-                        rx1 = rm_x + get_xregion(obj.bbox_left)
-                        rx2 = rm_x + get_xregion(obj.bbox_right - 1)
-                        ry1 = rm_y + get_yregion(obj.bbox_top)
-                        ry2 = rm_y + get_yregion(obj.bbox_bottom - 1)
-                        for ry in range(ry1, ry2 + 1):
-                            for rx in range(rx1, rx2 + 1):
-                                ignore_regions.add((rx, ry))
-
-                for y in range(rm_y, rm_y + rm_h):
-                    for x in range(rm_x, rm_x + rm_w):
-                        sge.game.pump_input()
-                        if ((x, y) not in ignore_regions
-                                and (x, y) not in hlib.map_revealed):
-                            hlib.map_revealed = hlib.map_revealed.copy()
-                            hlib.map_revealed.add((x, y))
-
-        sge.game.regulate_speed()
-        sge.game.pump_input()
-        sge.game.input_events = []
+        map_surface.reveal_cells(cells)
 
 
 class AtomicCompressor(Powerup):
@@ -4384,9 +4688,8 @@ class SpawnPoint(sge.dsp.Object):
 
     def event_create(self):
         if hlib.spawn_point == self.spawn_id:
-            for obj in sge.game.current_room.objects:
-                if isinstance(obj, Player):
-                    self.spawn(obj)
+            for obj in sge.game.current_room.players:
+                self.spawn(obj)
 
             if self.barrier is not None:
                 self.barrier.image_index = self.barrier.sprite.frames - 1
@@ -4761,9 +5064,8 @@ class PlayerLayer(sge.dsp.Object):
 
     def event_create(self):
         sge.game.current_room.player_z = self.z
-        for obj in sge.game.current_room.objects:
-            if isinstance(obj, Player):
-                obj.z = self.z
+        for obj in sge.game.current_room.players:
+            obj.z = self.z
         self.destroy()
 
 
@@ -5562,6 +5864,80 @@ class LoseProgressMenu(ModalMenu):
             play_sound(hlib.select_sound)
 
 
+class MapView(xsge_gui.Widget):
+
+    """
+    Widget showing the map as seen from :attr:`view_x` and
+    :attr:`view_y`, the cell at its top left, zoomed out by
+    :attr:`zoom` levels.  It is drawn from the chunks of
+    :data:`map_surface`, so drawing it costs the same however large
+    the map is, and it is only redrawn when the view or the map
+    changes.
+    """
+
+    tab_focus = False
+
+    def __init__(self, parent, x, y, z, width, height, player_x=None,
+                 player_y=None):
+        super().__init__(parent, x, y, z,
+                         sprite=sge.gfx.Sprite(width=width, height=height))
+        self.player_x = player_x
+        self.player_y = player_y
+        self.view_x = 0
+        self.view_y = 0
+        self.zoom = 0
+        self.drawn = None
+
+    def get_cells(self):
+        scale = 2 ** self.zoom
+        return (int(self.sprite.width * scale / hlib.MAP_CELL_WIDTH),
+                int(self.sprite.height * scale / hlib.MAP_CELL_HEIGHT))
+
+    def center(self, x, y):
+        """Move the view so that the cell ``(x, y)`` is in the middle."""
+        xcells, ycells = self.get_cells()
+        self.view_x = x - xcells//2
+        self.view_y = y - ycells//2
+
+    def pan(self, xsteps, ysteps):
+        """
+        Move the view by the given number of steps, each of which is
+        the width or height of a cell at the current zoom level.
+        """
+        self.view_x += xsteps * 2**self.zoom
+        self.view_y += ysteps * 2**self.zoom
+
+    def set_zoom(self, zoom):
+        """
+        Change the zoom level, keeping the same cell in the middle.
+        Return whether or not the zoom level changed.
+        """
+        zoom = max(0, min(zoom, hlib.MAP_ZOOM_LEVELS - 1))
+        if zoom == self.zoom:
+            return False
+
+        xcells, ycells = self.get_cells()
+        x = self.view_x + xcells//2
+        y = self.view_y + ycells//2
+        self.zoom = zoom
+        self.center(x, y)
+        return True
+
+    def redraw(self):
+        map_surface.draw_view(self.sprite, self.view_x, self.view_y,
+                              self.zoom, self.player_x, self.player_y)
+        self.drawn = (self.view_x, self.view_y, self.zoom, self.player_x,
+                      self.player_y)
+
+    def refresh(self):
+        if (self.drawn != (self.view_x, self.view_y, self.zoom,
+                           self.player_x, self.player_y)
+                or not map_surface.is_current()):
+            self.redraw()
+
+        super().refresh()
+
+
 class MapDialog(xsge_gui.Dialog):
 
     def __init__(self, player_x, player_y):
@@ -5570,41 +5946,30 @@ class MapDialog(xsge_gui.Dialog):
         if player_y is None:
             player_y = 0
 
-        xcells = int(sge.game.width / hlib.MAP_CELL_WIDTH)
-        ycells = int(sge.game.height / hlib.MAP_CELL_HEIGHT)
         w = sge.game.width
         h = sge.game.height
         super().__init__(
             gui_handler, 0, 0, w, h, background_color=sge.gfx.Color("black"),
             border=False)
-        self.map = xsge_gui.Widget(self, 0, 0, 0)
-        self.map.sprite = draw_map(player_x=player_x, player_y=player_y)
-        self.map.tab_focus = False
-        self.left = 0
-        self.top = 0
-        for rx, ry in hlib.map_revealed | hlib.map_explored:
-            self.left = min(self.left, rx)
-            self.top = min(self.top, ry)
-        player_x -= self.left
-        player_y -= self.top
-        self.map.x = (xcells // 2 - player_x) * hlib.MAP_CELL_WIDTH
-        self.map.y = (ycells // 2 - player_y) * hlib.MAP_CELL_HEIGHT
+        self.map = MapView(self, 0, 0, 0, w, h, player_x, player_y)
+        self.map.center(player_x, player_y)
+        self.joystick_prev = {}
 
     def event_press_left(self):
         play_sound(hlib.select_sound)
-        self.map.x += hlib.MAP_CELL_WIDTH
+        self.map.pan(-1, 0)
 
     def event_press_right(self):
         play_sound(hlib.select_sound)
-        self.map.x -= hlib.MAP_CELL_WIDTH
+        self.map.pan(1, 0)
 
     def event_press_up(self):
         play_sound(hlib.select_sound)
-        self.map.y += hlib.MAP_CELL_HEIGHT
+        self.map.pan(0, -1)
 
     def event_press_down(self):
         play_sound(hlib.select_sound)
-        self.map.y -= hlib.MAP_CELL_HEIGHT
+        self.map.pan(0, 1)
 
     def event_press_enter(self):
         play_sound(hlib.select_sound)
@@ -5614,6 +5979,34 @@ class MapDialog(xsge_gui.Dialog):
         play_sound(hlib.select_sound)
         self.destroy()
 
+    def zoom_in(self):
+        if self.map.set_zoom(self.map.zoom - 1):
+            play_sound(hlib.select_sound)
+
+    def zoom_out(self):
+        if self.map.set_zoom(self.map.zoom + 1):
+            play_sound(hlib.select_sound)
+
+    def event_key_press(self, key, char):
+        super().event_key_press(key, char)
+        if key in hlib.aim_up_key:
+            self.zoom_in()
+        elif key in hlib.aim_down_key:
+            self.zoom_out()
+
+    def event_joystick(self, js_name, js_id, input_type, input_id, value):
+        super().event_joystick(js_name, js_id, input_type, input_id, value)
+        js = (js_id, input_type, input_id)
+        # Axes send events for as long as they're held, so only zoom
+        # when the threshold is crossed.
+        prev = self.joystick_prev.get(js, 0)
+        self.joystick_prev[js] = value
+        if value >= hlib.joystick_threshold > prev:
+            if js in hlib.aim_up_js:
+                self.zoom_in()
+            elif js in hlib.aim_down_js:
+                self.zoom_out()
+
 
 class TeleportDialog(MapDialog):
 
@@ -5624,9 +6017,8 @@ class TeleportDialog(MapDialog):
         xsge_gui.Dialog.__init__(
             self, gui_handler, 0, 0, w, h,
             background_color=sge.gfx.Color("black"), border=False)
-        self.map = xsge_gui.Widget(self, 0, 0, 0)
-        self.map.sprite = draw_map()
-        self.map.tab_focus = False
+        self.map = MapView(self, 0, 0, 0, w, h)
+        self.joystick_prev = {}
         self.location_indicator = xsge_gui.Widget(self, 0, 0, 1)
         self.location_indicator.sprite = hlib.map_player_sprite
         self.location_indicator.tab_focus = False
@@ -5634,12 +6026,6 @@ class TeleportDialog(MapDialog):
         # Sorted copy of available warp pads for cycling through.
         self.warp_pads = sorted(hlib.warp_pads)
 
-        self.left = 0
-        self.top = 0
-        for rx, ry in hlib.map_revealed | hlib.map_explored:
-            self.left = min(self.left, rx)
-            self.top = min(self.top, ry)
-
         xcells = int(sge.game.width / hlib.MAP_CELL_WIDTH)
         ycells = int(sge.game.height / hlib.MAP_CELL_HEIGHT)
         self.location_indicator.x = (xcells//2) * hlib.MAP_CELL_WIDTH
@@ -5649,13 +6035,8 @@ class TeleportDialog(MapDialog):
 
     def update_selection(self):
         if self.selection[0] in hlib.map_rooms:
-            xcells = int(sge.game.width / hlib.MAP_CELL_WIDTH)
-            ycells = int(sge.game.height / hlib.MAP_CELL_HEIGHT)
             x, y = hlib.map_rooms[self.selection[0]]
-            x += self.selection[2] - self.left
-            y += self.selection[3] - self.top
-            self.map.x = (xcells//2 - x) * hlib.MAP_CELL_WIDTH
-            self.map.y = (ycells//2 - y) * hlib.MAP_CELL_HEIGHT
+            self.map.center(x + self.selection[2], y + self.selection[3])
 
     def event_press_left(self):
         play_sound(hlib.select_sound)
@@ -5754,6 +6135,75 @@ def get_object(x, y, cls=None, **kwargs):
     return cls(x, y, **kwargs)
 
 
+def _merge_wall_runs(rects, vertical):
+    # Merge rectangles which line up along one axis and touch or overlap
+    # along the other.  Each rectangle is [left, top, right, bottom, obj].
+    if vertical:
+        a, b = 1, 3
+        c, d = 0, 2
+    else:
+        a, b = 0, 2
+        c, d = 1, 3
+
+    rects.sort(key=lambda rect: (rect[c], rect[d], rect[a]))
+    merged = []
+    for rect in rects:
+        prev = merged[-1] if merged else None
+        if (prev is not None and prev[c] == rect[c] and prev[d] == rect[d]
+                and rect[a] <= prev[b]):
+            prev[b] = max(prev[b], rect[b])
+        else:
+            merged.append(rect)
+
+    return merged
+
+
+def merge_walls(objects):
+    """
+    Return a copy of the list ``objects`` with adjacent walls of the
+    same class combined into as few rectangles as possible.  Walls
+    which are only solid on one side are only merged along that side,
+    and slopes and spikes are left alone.
+    """
+    # Class: (merge horizontally, merge vertically)
+    axes = {
+        Solid: (True, True), SolidLeft: (False, True),
+        SolidRight: (False, True), SolidTop: (True, False),
+        SolidBottom: (True, False), HurtLeft: (False, True),
+        HurtRight: (False, True), HurtTop: (True, False),
+        HurtBottom: (True, False)}
+
+    walls = {}
+    new_objects = []
+    for obj in objects:
+        if (type(obj) in axes and not obj.collision_precise
+                and not obj.collision_ellipse):
+            walls.setdefault(type(obj), []).append(
+                [obj.bbox_left, obj.bbox_top, obj.bbox_right,
+                 obj.bbox_bottom, obj])
+        else:
+            new_objects.append(obj)
+
+    for cls, rects in walls.items():
+        horizontal, vertical = axes[cls]
+        n = None
+        while n != len(rects):
+            n = len(rects)
+            if horizontal:
+                rects = _merge_wall_runs(rects, False)
+            if vertical:
+                rects = _merge_wall_runs(rects, True)
+
+        for left, top, right, bottom, obj in rects:
+            obj.bbox_x += left - obj.bbox_left
+            obj.bbox_y += top - obj.bbox_top
+            obj.bbox_width = right - left
+            obj.bbox_height = bottom - top
+            new_objects.append(obj)
+
+    return new_objects
+
+
 def get_scaled_copy(obj):
     s = obj.sprite.copy()
     if obj.image_xscale < 0:
@@ -5899,62 +6349,17 @@ def show_error(message):
     raise
 
 
-def play_sound(sound, x=None, y=None, force=True):
-    if not hlib.sound_volume or not sound:
-        return
+def get_sound_listeners():
+    room = sge.game.current_room
+    listeners = [(view.x + view.width/2, view.y + view.height/2)
+                 for view in room.views]
+    listeners.extend((obj.x, obj.y)
+                     for obj in getattr(room, "players", ()))
+    return listeners
 
-    if x is None or y is None:
-        sound.play(volume=hlib.sound_volume, force=force)
-    else:
-        current_view = None
-        view_x = 0
-        view_y = 0
-        dist = 0
-        for view in sge.game.current_room.views:
-            vx = view.x + view.width/2
-            vy = view.y + view.height/2
-            new_dist = math.hypot(vx - x, vy - y)
-            if current_view is None or new_dist < dist:
-                current_view = view
-                view_x = vx
-                view_y = vy
-                dist = new_dist
-
-        bl = min(x, view_x)
-        bw = abs(x - view_x)
-        bt = min(y, view_y)
-        bh = abs(y - view_y)
-        for obj in sge.game.current_room.get_objects_at(bl, bt, bw, bh):
-            if isinstance(obj, Player):
-                new_dist = math.hypot(obj.x - x, obj.y - y)
-                if new_dist < dist:
-                    view_x = obj.x
-                    view_y = obj.y
-                    dist = new_dist
-
-        if dist <= hlib.SOUND_MAX_RADIUS:
-            volume = 1
-        elif dist < hlib.SOUND_ZERO_RADIUS:
-            rng = hlib.SOUND_ZERO_RADIUS - hlib.SOUND_MAX_RADIUS
-            reldist = rng - (dist-hlib.SOUND_MAX_RADIUS)
-            volume = min(1, abs(reldist / rng))
-        else:
-            # No point in continuing; it's too far away
-            return
 
-        if hlib.stereo_enabled:
-            hdist = x - view_x
-            if abs(hdist) < hlib.SOUND_CENTERED_RADIUS:
-                balance = 0
-            else:
-                rng = hlib.SOUND_TILTED_RADIUS - hlib.SOUND_CENTERED_RADIUS
-                balance = max(-hlib.SOUND_TILT_LIMIT,
-                              min(hdist / rng, hlib.SOUND_TILT_LIMIT))
-        else:
-            balance = 0
-
-        sound.play(volume=(volume * hlib.sound_volume), balance=balance,
-                   force=force)
+def play_sound(sound, x=None, y=None, force=True, priority=None):
+    sound_engine.play(sound, x, y, force=force, priority=priority)
 
 
 def play_music(music, force_restart=False, noloop=False):
@@ -6044,6 +6449,7 @@ def write_to_disk():
            "sound_volume": hlib.sound_volume,
            "music_volume": hlib.music_volume,
            "stereo_enabled": hlib.stereo_enabled,
+           "sound_voices": hlib.sound_voices,
            "fps_enabled": hlib.fps_enabled,
            "metroid_controls": hlib.metroid_controls,
            "joystick_threshold": hlib.joystick_threshold, "keys": keys_cfg,
@@ -6052,21 +6458,38 @@ def write_to_disk():
     with open(os.path.join(hlib.configdir, "config.json"), 'w') as f:
         json.dump(cfg, f, indent=4)
 
+    # AI data is only written to the journal here; the whole table is
+    # written out by write_ai_data when the journal is compacted.
+    ai_journal.flush()
+
+    with open(os.path.join(hlib.localdir, "save_slots.json"), 'w') as f:
+        json.dump(hlib.save_slots, f, indent=4)
+
+
+def write_ai_data(table):
+    # Called from the AI journal's thread with a copy of ai_table.
     if DIST_AI:
         # Save to hlib.datadir instead.
-        with open(os.path.join(hlib.datadir, "ai_data.json"), 'w') as f:
-            json.dump(ai_data, f, indent=4)
+        fname = os.path.join(hlib.datadir, "ai_data.json")
+        with open(f"{fname}.tmp", 'w') as f:
+            json.dump(table.to_json(), f, indent=4)
+        os.replace(f"{fname}.tmp", fname)
+
+        # Remove the local files since they're now redundant.
+        for fname in ["ai_data.bin", "ai_data.json"]:
+            fd = os.path.join(hlib.localdir, fname)
+            if os.path.exists(fd):
+                os.remove(fd)
+    else:
+        fname = os.path.join(hlib.localdir, "ai_data.bin")
+        with open(f"{fname}.tmp", 'wb') as f:
+            table.save(f)
+        os.replace(f"{fname}.tmp", fname)
 
-        # Remove the local file since it's now redundant.
+        # The binary file replaces the JSON file older versions wrote.
         fd = os.path.join(hlib.localdir, "ai_data.json")
         if os.path.exists(fd):
             os.remove(fd)
-    else:
-        with open(os.path.join(hlib.localdir, "ai_data.json"), 'w') as f:
-            json.dump(ai_data, f)
-
-    with open(os.path.join(hlib.localdir, "save_slots.json"), 'w') as f:
-        json.dump(hlib.save_slots, f, indent=4)
 
 
 def save_game():
@@ -6134,167 +6557,331 @@ def start_game():
     return True
 
 
+# Increase this whenever the facts recorded by get_map_facts change.
+MAP_MANIFEST_VERSION = 1
+
+_map_hint_kinds = [
+    (MapLeftWall, "wall_left", "left"), (MapRightWall, "wall_right", "right"),
+    (MapTopWall, "wall_top", "top"), (MapBottomWall, "wall_bottom", "bottom"),
+    (MapLeftDoor, "door_left", "left"), (MapRightDoor, "door_right", "right"),
+    (MapTopDoor, "door_top", "top"), (MapBottomDoor, "door_bottom", "bottom")]
+
+
+def get_map_facts(fname):
+    """
+    Return what :func:`generate_map` needs to know about the room
+    ``fname`` and the files it was built from as a tuple
+    ``(facts, deps)``.  ``facts`` is a tuple
+    ``(width, height, objects, ignore_regions)``, and ``deps`` is a
+    list of ``(fname, hash)`` tuples as returned by
+    :func:`hlib.rooms.compile_room`.
+
+    ``width`` and ``height`` are the size of the room in screens.
+    ``objects`` is a list of tuples describing the room's doors, warp
+    pads, powerups and map hints in the order they are in the room,
+    with positions given in screens relative to the room.
+    ``ignore_regions`` is a list of ``(x1, x2, y1, y2)`` tuples giving
+    the (inclusive) ranges of screens covered by each ignore region.
+
+    Only the room's object layers are loaded, and everything returned
+    is plain data, so this can be run in another process.
+    """
+    width, height, room_objects, deps = hlib.rooms.load_objects(
+        os.path.join(hlib.datadir, "rooms", fname), types=TYPES)
+    rm_w = int(math.ceil(width / hlib.SCREEN_SIZE[0]))
+    rm_h = int(math.ceil(height / hlib.SCREEN_SIZE[1]))
+
+    objects = []
+    ignore_regions = []
+    for obj in room_objects:
+        if isinstance(obj, IgnoreRegion):
+            ignore_regions.append((get_xregion(obj.bbox_left),
+                                   get_xregion(obj.bbox_right - 1),
+                                   get_yregion(obj.bbox_top),
+                                   get_yregion(obj.bbox_bottom - 1)))
+
+        x = get_xregion(obj.image_xcenter)
+        y = get_yregion(obj.image_ycenter)
+        if isinstance(obj, Door):
+            if isinstance(obj, LeftDoor):
+                kind = "door_left"
+            elif isinstance(obj, RightDoor):
+                kind = "door_right"
+            elif isinstance(obj, UpDoor):
+                kind = "door_top"
+            elif isinstance(obj, DownDoor):
+                kind = "door_bottom"
+            else:
+                kind = None
+            objects.append(("door", kind, obj.dest, obj.spawn_id, x, y))
+        elif isinstance(obj, WarpPad):
+            objects.append(("warp_pad", x, y))
+        elif isinstance(obj, Powerup):
+            objects.append(("powerup", isinstance(obj, Artifact), x, y))
+        else:
+            for cls, kind, side in _map_hint_kinds:
+                if isinstance(obj, cls):
+                    x1 = get_xregion(obj.bbox_left)
+                    x2 = get_xregion(obj.bbox_right - 1)
+                    y1 = get_yregion(obj.bbox_top)
+                    y2 = get_yregion(obj.bbox_bottom - 1)
+                    if side == "left":
+                        x2 = x1
+                    elif side == "right":
+                        x1 = x2
+                    elif side == "top":
+                        y2 = y1
+                    else:
+                        y1 = y2
+                    objects.append(("hint", kind, x1, x2, y1, y2))
+                    break
+
+    return (rm_w, rm_h, objects, ignore_regions), deps
+
+
+def get_door_dest(dest, fname):
+    if ":" in dest:
+        return tuple(dest.split(':', 1))
+    else:
+        return dest, fname
+
+
+def get_map_pool():
+    """
+    Return a pool of processes to examine rooms with, or
+    :const:`None` if rooms should be examined in this process.
+    """
+    if (os.cpu_count() or 1) > 1:
+        try:
+            # Forked processes start with everything already loaded,
+            # which makes them much cheaper to start.
+            context = multiprocessing.get_context("fork")
+        except ValueError:
+            pass
+        else:
+            return context.Pool()
+
+    return None
+
+
+def get_game_hash():
+    """
+    Return a hash of everything besides the rooms themselves which
+    :func:`get_map_facts` depends on: the code of the game and of
+    :mod:`hlib`, and the sizes, origins and bounding boxes of the
+    loaded sprites.  Must be called after the sprites are loaded.
+    """
+    fnames = [os.path.abspath(__file__)]
+    hlib_dir = os.path.dirname(os.path.abspath(hlib.__file__))
+    try:
+        fnames.extend(sorted(
+            os.path.join(hlib_dir, fname) for fname in os.listdir(hlib_dir)
+            if fname.endswith(".py")))
+        h = hashlib.sha1()
+        for fname in fnames:
+            h.update("{} {}\n".format(
+                os.path.basename(fname),
+                hlib.rooms.hash_file(fname)).encode("utf-8"))
+    except OSError:
+        return None
+
+    for name, sprite in sorted(vars(hlib).items()):
+        if isinstance(sprite, sge.gfx.Sprite):
+            h.update("{} {} {} {} {} {} {} {} {}\n".format(
+                name, sprite.width, sprite.height, sprite.origin_x,
+                sprite.origin_y, sprite.bbox_x, sprite.bbox_y,
+                sprite.bbox_width, sprite.bbox_height).encode("utf-8"))
+
+    return h.hexdigest()
+
+
+def read_map_manifest():
+    """
+    Return the room facts recorded by the last map generation as a
+    dictionary mapping room file names to ``(facts, deps)`` tuples, as
+    returned by :func:`get_map_facts`.  If there is no manifest, or it
+    was written by a different version of the game, an empty
+    dictionary is returned.
+    """
+    try:
+        with open(os.path.join(hlib.datadir, "map", "manifest.json")) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    rooms = {}
+    try:
+        if (manifest["version"] != MAP_MANIFEST_VERSION
+                or manifest["game"] != get_game_hash()):
+            return {}
+
+        for fname, entry in manifest["rooms"].items():
+            rm_w, rm_h, objects, ignore_regions = entry["facts"]
+            facts = (rm_w, rm_h, [tuple(fact) for fact in objects],
+                     [tuple(region) for region in ignore_regions])
+            deps = [(os.path.join(hlib.datadir, dep_fname), dep_hash)
+                    for dep_fname, dep_hash in entry["deps"]]
+            rooms[fname] = (facts, deps)
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return {}
+
+    return rooms
+
+
+def write_map_manifest(rooms):
+    """
+    Write ``rooms``, a dictionary as returned by
+    :func:`collect_map_facts`, to the map manifest.
+    """
+    manifest = {"version": MAP_MANIFEST_VERSION, "game": get_game_hash(),
+                "rooms": {}}
+    for fname, (facts, deps) in rooms.items():
+        deps = [(os.path.relpath(dep_fname, hlib.datadir), dep_hash)
+                for dep_fname, dep_hash in deps]
+        manifest["rooms"][fname] = {"facts": facts, "deps": deps}
+
+    with open(os.path.join(hlib.datadir, "map", "manifest.json"), 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+
+
+def collect_map_facts(manifest=None):
+    """
+    Return a dictionary mapping the file name of every room reachable
+    from the first room to :func:`get_map_facts` for that room.
+
+    Rooms are taken from ``manifest``, a dictionary as returned by
+    :func:`read_map_manifest`, if the files they were built from have
+    not changed since.  Other rooms are examined in parallel by a pool
+    of processes when possible.
+    """
+    if manifest is None:
+        manifest = {}
+
+    rooms = {}
+    fnames = ["0.json"]
+    pool = None
+    try:
+        while fnames:
+            changed = []
+            for fname in fnames:
+                entry = manifest.get(fname)
+                if entry is not None and hlib.rooms.check_deps(entry[1]):
+                    rooms[fname] = entry
+                else:
+                    changed.append(fname)
+
+            if len(changed) > 1 and pool is None:
+                pool = get_map_pool()
+
+            if len(changed) > 1 and pool is not None:
+                results = pool.map(get_map_facts, changed, chunksize=1)
+            else:
+                results = map(get_map_facts, changed)
+            rooms.update(zip(changed, results))
+
+            new_fnames = []
+            for fname in fnames:
+                for fact in rooms[fname][0][2]:
+                    if fact[0] == "door":
+                        level_f = get_door_dest(fact[2], fname)[0]
+                        if level_f not in rooms and level_f not in new_fnames:
+                            new_fnames.append(level_f)
+            fnames = new_fnames
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return rooms
+
+
 def generate_map():
     print(_("Generating new map files; this may take some time."))
+    rooms = collect_map_facts(read_map_manifest())
     files_checked = set()
     files_remaining = {("0.json", 0, 0, None, None)}
     hlib.map_rooms = {}
     hlib.map_objects = {}
+    hlib.map_room_info = {}
     hlib.num_powerups = 0
     hlib.num_artifacts = 0
 
     while files_remaining:
         fname, rm_x, rm_y, origin_level, origin_spawn = files_remaining.pop()
         files_checked.add(fname)
-        room = Level.load(fname, True)
-        rm_w = int(math.ceil(room.width / hlib.SCREEN_SIZE[0]))
-        rm_h = int(math.ceil(room.height / hlib.SCREEN_SIZE[1]))
-
-        for obj in room.objects:
-            if isinstance(obj, Door):
-                if ":" in obj.dest:
-                    level_f, spawn = obj.dest.split(':', 1)
-                else:
-                    level_f = obj.dest
-                    spawn = fname
+        rm_w, rm_h, objects, room_ignore_regions = rooms[fname][0]
+
+        for fact in objects:
+            if fact[0] == "door":
+                kind, dest, spawn_id, x, y = fact[1:]
+                level_f, spawn = get_door_dest(dest, fname)
 
                 if level_f == origin_level and spawn == origin_spawn:
-                    if isinstance(obj, LeftDoor):
+                    if kind == "door_left":
                         rm_x += 1
-                    elif isinstance(obj, RightDoor):
+                    elif kind == "door_right":
                         rm_x -= 1
-                    elif isinstance(obj, UpDoor):
+                    elif kind == "door_top":
                         rm_y += 1
-                    elif isinstance(obj, DownDoor):
+                    elif kind == "door_bottom":
                         rm_y -= 1
 
-                    rm_x -= get_xregion(obj.image_xcenter)
-                    rm_y -= get_yregion(obj.image_ycenter)
-
-                    origin = None
+                    rm_x -= x
+                    rm_y -= y
                     break
 
         hlib.map_rooms[fname] = (rm_x, rm_y)
 
-        ignore_regions = set()
-        for obj in room.objects:
-            if isinstance(obj, IgnoreRegion):
-                rx1 = rm_x + get_xregion(obj.bbox_left)
-                rx2 = rm_x + get_xregion(obj.bbox_right - 1)
-                ry1 = rm_y + get_yregion(obj.bbox_top)
-                ry2 = rm_y + get_yregion(obj.bbox_bottom - 1)
-                for ry in range(ry1, ry2 + 1):
-                    for rx in range(rx1, rx2 + 1):
-                        ignore_regions.add((rx, ry))
-
-        for obj in room.objects:
-            if isinstance(obj, Door):
-                dx = rm_x + get_xregion(obj.image_xcenter)
-                dy = rm_y + get_yregion(obj.image_ycenter)
-
-                if ":" in obj.dest:
-                    level_f, spawn = obj.dest.split(':', 1)
-                else:
-                    level_f = obj.dest
-                    spawn = fname
+        room_ignored = set()
+        for x1, x2, y1, y2 in room_ignore_regions:
+            for ry in range(y1, y2 + 1):
+                for rx in range(x1, x2 + 1):
+                    room_ignored.add((rx, ry))
+        hlib.map_room_info[fname] = (rm_w, rm_h, room_ignored)
+        ignore_regions = {(rm_x + rx, rm_y + ry) for rx, ry in room_ignored}
+
+        for fact in objects:
+            if fact[0] == "door":
+                kind, dest, spawn_id, x, y = fact[1:]
+                dx = rm_x + x
+                dy = rm_y + y
+                level_f, spawn = get_door_dest(dest, fname)
 
                 if level_f not in files_checked:
-                    files_remaining.add((level_f, dx, dy, fname, obj.spawn_id))
+                    files_remaining.add((level_f, dx, dy, fname, spawn_id))
                     files_checked.add(level_f)
 
                 if (dx, dy) in ignore_regions:
                     continue
 
                 pos_objects = hlib.map_objects.setdefault((dx, dy), [])
-                if isinstance(obj, LeftDoor):
-                    pos_objects.append("door_left")
-                elif isinstance(obj, RightDoor):
-                    pos_objects.append("door_right")
-                elif isinstance(obj, UpDoor):
-                    pos_objects.append("door_top")
-                elif isinstance(obj, DownDoor):
-                    pos_objects.append("door_bottom")
-            elif isinstance(obj, WarpPad):
-                wx = rm_x + get_xregion(obj.image_xcenter)
-                wy = rm_y + get_yregion(obj.image_ycenter)
+                if kind is not None:
+                    pos_objects.append(kind)
+            elif fact[0] == "warp_pad":
+                wx = rm_x + fact[1]
+                wy = rm_y + fact[2]
                 if (wx, wy) in ignore_regions:
                     continue
                 hlib.map_objects.setdefault((wx, wy), []).append("warp_pad")
-            elif isinstance(obj, Powerup):
-                if isinstance(obj, Artifact):
+            elif fact[0] == "powerup":
+                is_artifact, x, y = fact[1:]
+                if is_artifact:
                     hlib.num_artifacts += 1
                 else:
                     hlib.num_powerups += 1
 
-                px = rm_x + get_xregion(obj.image_xcenter)
-                py = rm_y + get_yregion(obj.image_ycenter)
+                px = rm_x + x
+                py = rm_y + y
                 if (px, py) in ignore_regions:
                     continue
                 hlib.map_objects.setdefault((px, py), []).append("powerup")
-            elif isinstance(obj, MapLeftWall):
-                wx = rm_x + get_xregion(obj.bbox_left)
-                wy1 = rm_y + get_yregion(obj.bbox_top)
-                wy2 = rm_y + get_yregion(obj.bbox_bottom - 1)
-                for wy in range(wy1, wy2 + 1):
-                    if (wx, wy) not in ignore_regions:
-                        hlib.map_objects.setdefault((wx, wy), []).append(
-                            "wall_left")
-            elif isinstance(obj, MapRightWall):
-                wx = rm_x + get_xregion(obj.bbox_right - 1)
-                wy1 = rm_y + get_yregion(obj.bbox_top)
-                wy2 = rm_y + get_yregion(obj.bbox_bottom - 1)
-                for wy in range(wy1, wy2 + 1):
-                    if (wx, wy) not in ignore_regions:
-                        hlib.map_objects.setdefault((wx, wy), []).append(
-                            "wall_right")
-            elif isinstance(obj, MapTopWall):
-                wx1 = rm_x + get_xregion(obj.bbox_left)
-                wx2 = rm_x + get_xregion(obj.bbox_right - 1)
-                wy = rm_y + get_yregion(obj.bbox_top)
-                for wx in range(wx1, wx2 + 1):
-                    if (wx, wy) not in ignore_regions:
-                        hlib.map_objects.setdefault((wx, wy), []).append(
-                            "wall_top")
-            elif isinstance(obj, MapBottomWall):
-                wx1 = rm_x + get_xregion(obj.bbox_left)
-                wx2 = rm_x + get_xregion(obj.bbox_right - 1)
-                wy = rm_y + get_yregion(obj.bbox_bottom - 1)
-                for wx in range(wx1, wx2 + 1):
-                    if (wx, wy) not in ignore_regions:
-                        hlib.map_objects.setdefault((wx, wy), []).append(
-                            "wall_bottom")
-            elif isinstance(obj, MapLeftDoor):
-                wx = rm_x + get_xregion(obj.bbox_left)
-                wy1 = rm_y + get_yregion(obj.bbox_top)
-                wy2 = rm_y + get_yregion(obj.bbox_bottom - 1)
-                for wy in range(wy1, wy2 + 1):
-                    if (wx, wy) not in ignore_regions:
-                        hlib.map_objects.setdefault((wx, wy), []).append(
-                            "door_left")
-            elif isinstance(obj, MapRightDoor):
-                wx = rm_x + get_xregion(obj.bbox_right - 1)
-                wy1 = rm_y + get_yregion(obj.bbox_top)
-                wy2 = rm_y + get_yregion(obj.bbox_bottom - 1)
-                for wy in range(wy1, wy2 + 1):
-                    if (wx, wy) not in ignore_regions:
-                        hlib.map_objects.setdefault((wx, wy), []).append(
-                            "door_right")
-            elif isinstance(obj, MapTopDoor):
-                wx1 = rm_x + get_xregion(obj.bbox_left)
-                wx2 = rm_x + get_xregion(obj.bbox_right - 1)
-                wy = rm_y + get_yregion(obj.bbox_top)
-                for wx in range(wx1, wx2 + 1):
-                    if (wx, wy) not in ignore_regions:
-                        hlib.map_objects.setdefault((wx, wy), []).append(
-                            "door_top")
-            elif isinstance(obj, MapBottomDoor):
-                wx1 = rm_x + get_xregion(obj.bbox_left)
-                wx2 = rm_x + get_xregion(obj.bbox_right - 1)
-                wy = rm_y + get_yregion(obj.bbox_bottom - 1)
-                for wx in range(wx1, wx2 + 1):
-                    if (wx, wy) not in ignore_regions:
-                        hlib.map_objects.setdefault((wx, wy), []).append(
-                            "door_bottom")
+            elif fact[0] == "hint":
+                kind, x1, x2, y1, y2 = fact[1:]
+                for wy in range(rm_y + y1, rm_y + y2 + 1):
+                    for wx in range(rm_x + x1, rm_x + x2 + 1):
+                        if (wx, wy) not in ignore_regions:
+                            hlib.map_objects.setdefault((wx, wy), []).append(
+                                kind)
 
         for x in range(rm_x, rm_x + rm_w):
             y = rm_y
@@ -6329,6 +6916,11 @@ def generate_map():
 
     info = {"powerups": hlib.num_powerups, "artifacts": hlib.num_artifacts}
 
+    room_info = {}
+    for fname, (rm_w, rm_h, ignore_regions) in hlib.map_room_info.items():
+        room_info[fname] = {"size": [rm_w, rm_h],
+                            "ignore_regions": sorted(ignore_regions)}
+
     try:
         with open(os.path.join(hlib.datadir, "map", "rooms.json"), 'w') as f:
             json.dump(hlib.map_rooms, f, indent=4, sort_keys=True)
@@ -6338,93 +6930,14 @@ def generate_map():
 
         with open(os.path.join(hlib.datadir, "map", "info.json"), 'w') as f:
             json.dump(info, f, indent=4, sort_keys=True)
-    except PermissionError as e:
-        warnings.warn(f"Could not save generated map files - {e}")
-
 
-def draw_map(x=None, y=None, w=None, h=None, player_x=None, player_y=None):
-    if x is None or y is None or w is None or h is None:
-        left = 0
-        right = 0
-        top = 0
-        bottom = 0
-        for rx, ry in hlib.map_revealed | hlib.map_explored:
-            left = min(left, rx)
-            right = max(right, rx)
-            top = min(top, ry)
-            bottom = max(bottom, ry)
-
-        if x is None:
-            x = left
-        if y is None:
-            y = top
-        if w is None:
-            w = right - x + 1
-        if h is None:
-            h = bottom - y + 1
-
-    removed = []
-    for obj, fname, ox, oy in hlib.map_removed:
-        if fname in hlib.map_rooms:
-            rm_x, rm_y = hlib.map_rooms[fname]
-            removed.append((obj, rm_x + ox, rm_y + oy))
-    s_w = w * hlib.MAP_CELL_WIDTH
-    s_h = h * hlib.MAP_CELL_HEIGHT
-    map_sprite = sge.gfx.Sprite(width=s_w, height=s_h)
-    map_sprite.draw_rectangle(0, 0, s_w, s_h, fill=sge.gfx.Color("black"))
-
-    for ex, ey in hlib.map_explored:
-        dx = (ex - x) * hlib.MAP_CELL_WIDTH
-        dy = (ey - y) * hlib.MAP_CELL_HEIGHT
-        map_sprite.draw_rectangle(
-            dx, dy, hlib.MAP_CELL_WIDTH, hlib.MAP_CELL_HEIGHT,
-            fill=sge.gfx.Color((170, 68, 153)))
-
-    for ox, oy in (set(hlib.map_objects)
-                   & (hlib.map_revealed | hlib.map_explored)):
-        if x <= ox < x + w and y <= oy < y + h:
-            for obj in hlib.map_objects[(ox, oy)]:
-                if (obj, ox, oy) in removed:
-                    removed.remove((obj, ox, oy))
-                    continue
+        with open(os.path.join(hlib.datadir, "map", "room_info.json"),
+                  'w') as f:
+            json.dump(room_info, f, indent=4, sort_keys=True)
 
-                dx = (ox-x) * hlib.MAP_CELL_WIDTH
-                dy = (oy-y) * hlib.MAP_CELL_HEIGHT
-                if obj == "wall_left":
-                    map_sprite.draw_sprite(hlib.map_wall_left_sprite, 0,
-                                           dx, dy)
-                elif obj == "wall_right":
-                    map_sprite.draw_sprite(hlib.map_wall_right_sprite, 0,
-                                           dx, dy)
-                elif obj == "wall_top":
-                    map_sprite.draw_sprite(hlib.map_wall_top_sprite, 0, dx, dy)
-                elif obj == "wall_bottom":
-                    map_sprite.draw_sprite(hlib.map_wall_bottom_sprite, 0,
-                                           dx, dy)
-                elif obj == "door_left":
-                    map_sprite.draw_sprite(hlib.map_door_left_sprite, 0,
-                                           dx, dy)
-                elif obj == "door_right":
-                    map_sprite.draw_sprite(hlib.map_door_right_sprite, 0,
-                                           dx, dy)
-                elif obj == "door_top":
-                    map_sprite.draw_sprite(hlib.map_door_top_sprite, 0, dx, dy)
-                elif obj == "door_bottom":
-                    map_sprite.draw_sprite(hlib.map_door_bottom_sprite, 0,
-                                           dx, dy)
-                elif obj == "powerup":
-                    if "warp_pad" not in hlib.map_objects[(ox, oy)]:
-                        map_sprite.draw_sprite(hlib.map_powerup_sprite, 0,
-                                               dx, dy)
-                elif obj == "warp_pad":
-                    map_sprite.draw_sprite(hlib.map_warp_pad_sprite, 0, dx, dy)
-
-    if player_x is not None and player_y is not None:
-        dx = (player_x - x) * hlib.MAP_CELL_WIDTH
-        dy = (player_y - y) * hlib.MAP_CELL_HEIGHT
-        map_sprite.draw_sprite(hlib.map_player_sprite, 0, dx, dy)
-
-    return map_sprite
+        write_map_manifest(rooms)
+    except PermissionError as e:
+        warnings.warn(f"Could not save generated map files - {e}")
 
 
 TYPES = {
@@ -6478,6 +6991,11 @@ sge.game.scale = None
 print(_("Initializing GUI system…"))
 xsge_gui.init()
 gui_handler = xsge_gui.Handler()
+sound_engine = hlib.audio.SoundEngine(get_sound_listeners)
+map_surface = hlib.maps.MapSurface()
+profiler = hlib.profiler.FrameProfiler(dumpdir=PROFILE_DIR)
+if PROFILE_DIR:
+    profiler.enable()
 xsge_gui.default_font.size = 8
 xsge_gui.textbox_font.size = 8
 
@@ -7019,13 +7537,25 @@ if not GEN_MAP:
     else:
         hlib.num_powerups = d.get("powerups", 0)
         hlib.num_artifacts = d.get("artifacts", 0)
+
+    try:
+        with open(os.path.join(hlib.datadir, "map", "room_info.json")) as f:
+            d = json.load(f)
+    except (OSError, ValueError):
+        generate_map()
+    else:
+        for i in d:
+            rm_w, rm_h = d[i]["size"]
+            ignore_regions = set(map(tuple, d[i]["ignore_regions"]))
+            hlib.map_room_info[i] = (rm_w, rm_h, ignore_regions)
 else:
     generate_map()
 
 if SAVE_MAP:
     hlib.map_revealed = set(hlib.map_objects.keys())
     hlib.map_explored = hlib.map_revealed
-    draw_map().save("map.png")
+    hlib.maps.export_map("map.png", MAP_SCALE,
+                         hlib.font_small if MAP_LABELS else None)
     hlib.map_revealed = set()
     hlib.map_explored = set()
 
@@ -7044,6 +7574,7 @@ finally:
     hlib.sound_volume = cfg.get("sound_volume", hlib.sound_volume)
     hlib.music_volume = cfg.get("music_volume", hlib.music_volume)
     hlib.stereo_enabled = cfg.get("stereo_enabled", hlib.stereo_enabled)
+    hlib.sound_voices = cfg.get("sound_voices", hlib.sound_voices)
     hlib.fps_enabled = cfg.get("fps_enabled", hlib.fps_enabled)
     hlib.metroid_controls = cfg.get("metroid_controls", hlib.metroid_controls)
     hlib.joystick_threshold = cfg.get("joystick_threshold",
@@ -7086,12 +7617,22 @@ finally:
     set_gui_controls()
 
 try:
-    with open(os.path.join(hlib.localdir, "ai_data.json")) as f:
-        d = json.load(f)
+    with open(os.path.join(hlib.localdir, "ai_data.bin"), 'rb') as f:
+        ai_table.load(f)
 except (OSError, ValueError):
-    pass
-else:
-    ai_data.update(d)
+    # Fall back to the JSON file written by older versions.
+    try:
+        with open(os.path.join(hlib.localdir, "ai_data.json")) as f:
+            d = json.load(f)
+    except (OSError, ValueError):
+        pass
+    else:
+        ai_table.update_json(d)
+
+# Add the results the game didn't get to save last time, if it crashed.
+ai_journal = hlib.ai.ActionJournal(
+    ai_table, os.path.join(hlib.localdir, "ai_data.journal"), write_ai_data)
+ai_journal.recover()
 
 try:
     with open(os.path.join(hlib.localdir, "save_slots.json")) as f:
@@ -7115,4 +7656,6 @@ try:
     else:
         print(_("Successfully started Hexoshi. Quitting now as -q was passed."))
 finally:
+    profiler.set_room(None)
     write_to_disk()
+    ai_journal.close()
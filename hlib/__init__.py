@@ -17,11 +17,24 @@
 import math
 import os
 
+from . import ai
+from . import audio
 from . import game
+from . import lights
+from . import maps
+from . import occupancy
+from . import particles
+from . import png
+from . import pools
+from . import profiler
+from . import rooms
+from . import timeline
 
 
 SCREEN_SIZE = [400, 240]
 TILE_SIZE = 16
+TILE_CHUNK_SIZE = 256
+OCCUPANCY_CELL_SIZE = 8
 FPS = 60
 DELTA_MIN = FPS / 2
 DELTA_MAX = FPS * 4
@@ -120,24 +133,44 @@ LIFE_FORCE_CHANCE = 0.25
 LIFE_FORCE_SPEED = 1
 LIFE_FORCE_HEAL = 5
 
+AI_THINK_BUDGET = 12
+AI_JOURNAL_INTERVAL = 5
+AI_JOURNAL_LIMIT = 1024 * 1024
+
 LIGHT_RANGE = 300
+LIGHT_CELL_SIZE = 256
+
+PARTICLE_LIMIT = 1024
+POOL_LIMIT = 64
+SHARD_LIFE = 45
+SHARD_FALL_SPEED = 99
+SHARD_FRICTION = 0.99
+SHARD_BOUNCE = 0.5
+SHARD_FADE_TIME = FPS / 4
 
 SHAKE_FRAME_TIME = FPS / DELTA_MIN
 SHAKE_AMOUNT = 3
 
 MAP_CELL_WIDTH = 8
 MAP_CELL_HEIGHT = 8
+MAP_CHUNK_SIZE = 16
+MAP_ZOOM_LEVELS = 3
 
 TEXT_SPEED = 1000
 
 SAVE_NSLOTS = 10
 MENU_MAX_ITEMS = 14
 
+PROFILE_WINDOW = FPS * 10
+
 SOUND_MAX_RADIUS = 200
 SOUND_ZERO_RADIUS = 600
 SOUND_CENTERED_RADIUS = 75
 SOUND_TILTED_RADIUS = 500
 SOUND_TILT_LIMIT = 0.75
+SOUND_PRIORITY_WORLD = 0
+SOUND_PRIORITY_PLAYER = 1
+SOUND_PRIORITY_UI = 2
 
 datadir = "data"
 if os.name == "nt":
@@ -147,6 +180,10 @@ if os.name == "nt":
     localdir = os.path.join(
         os.getenv("APPDATA", os.path.join(os.path.expanduser("~"),
                                           "AppData", "Roaming")), "Hexoshi")
+    cachedir = os.path.join(
+        os.getenv("LOCALAPPDATA", os.path.join(os.path.expanduser("~"),
+                                               "AppData", "Local")), "Hexoshi",
+        "cache")
 else:
     configdir = os.path.join(
         os.getenv("XDG_CONFIG_HOME", os.path.join(os.path.expanduser("~"),
@@ -154,6 +191,9 @@ else:
     localdir = os.path.join(
         os.getenv("XDG_DATA_HOME", os.path.join(os.path.expanduser("~"),
                                                 ".local", "share")), "hexoshi")
+    cachedir = os.path.join(
+        os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"),
+                                                 ".cache")), "hexoshi")
 scale = 2
 fsscale = None
 no_hud = False
@@ -164,6 +204,7 @@ scale_method = None
 sound_volume = 1
 music_volume = 1
 stereo_enabled = True
+sound_voices = 8
 fps_enabled = False
 metroid_controls = False
 joystick_threshold = 0.5
@@ -221,5 +262,6 @@ loaded_music = {}
 
 map_rooms = {}
 map_objects = {}
+map_room_info = {}
 num_powerups = 0
 num_artifacts = 0
@@ -0,0 +1,549 @@
+# Hexoshi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import array
+import collections
+import json
+import re
+import struct
+import sys
+import threading
+import time
+import warnings
+
+import hlib
+
+
+# Format of the keys of the JSON AI data.
+KEY_FORMAT = "{}; {}: ({},{};{}+{})->({},{})|({},{})!{}"
+KEY_RE = re.compile(r"^([^;]*); (.*): \(([^,]*),([^;]*);([^+]*)\+([^)]*)\)"
+                    r"->\(([^,]*),([^)]*)\)\|\(([^,]*),([^)]*)\)!(.*)$")
+
+# Fields of the keys of an ActionTable.  Names (and the facing and
+# speed, kept as they are written in the JSON keys) are interned;
+# positions are the quantized coordinates, with NONE for None.
+KEY_FIELDS = ("class", "room", "x", "y", "facing", "speed", "target_x",
+              "target_y", "check_x", "check_y", "action")
+NAME_FIELDS = (0, 1, 4, 5, 10)
+NONE = -2**31
+
+BINARY_MAGIC = b"HXAI"
+BINARY_VERSION = 2
+BINARY_HEADER = struct.Struct("<4sIIIIQ")
+BINARY_HEADER_V1 = struct.Struct("<4sIIII")
+
+
+class ThinkScheduler:
+
+    """
+    Spreads the decisions of the AI-controlled objects in a room over
+    frames, so that the time spent on them each frame is capped no
+    matter how many of them there are.
+
+    Every object added has a ``think_cost`` attribute.  At the start
+    of every frame, :meth:`new_frame` goes around the objects in turn,
+    letting each of them think in that frame until the costs add up to
+    ``budget``; the next frame carries on from where it stopped.  If
+    the costs of all of the objects add up to no more than ``budget``,
+    every object thinks every frame.
+
+    Objects call :meth:`may_think` before making a decision, and keep
+    acting on the last decision they made when it returns False.
+    Movement and physics are not affected.
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget or hlib.AI_THINK_BUDGET
+        self.queue = collections.deque()
+        self.members = set()
+        self.thinking = set()
+
+    def add(self, obj):
+        if obj not in self.members:
+            self.members.add(obj)
+            self.queue.append(obj)
+
+    def remove(self, obj):
+        if obj in self.members:
+            self.members.remove(obj)
+            self.queue.remove(obj)
+            self.thinking.discard(obj)
+
+    def new_frame(self):
+        """Choose the objects which may think in this frame."""
+        self.thinking.clear()
+        budget = self.budget
+        for i in range(len(self.queue)):
+            obj = self.queue[0]
+            # The first object always gets to think, however much it
+            # costs, so that nothing can be held up forever.
+            if obj.think_cost > budget and self.thinking:
+                break
+
+            budget -= obj.think_cost
+            self.thinking.add(obj)
+            self.queue.rotate(-1)
+
+    def may_think(self, obj):
+        """
+        Return whether or not ``obj`` may make a decision in this
+        frame.  Objects not in the scheduler always may.
+        """
+        return obj in self.thinking or obj not in self.members
+
+
+class ActionTable:
+
+    """
+    The results of actions tried by the AI, as a table of how many
+    times each action succeeded and failed in a given situation.
+
+    Situations are keys made with :meth:`get_key`, tuples of the small
+    integers described in :data:`KEY_FIELDS`, which are mapped to rows
+    of the success and fail counters.  Looking up a key which has never
+    been used gives zero counts without adding a row.
+
+    The table is saved with :meth:`save` and loaded with :meth:`load`
+    in a compact binary format, and can also be converted to and from
+    the dictionary of ``"key string": [successes, fails]`` written to
+    ``ai_data.json`` with :meth:`to_json` and :meth:`update_json`.
+
+    :attr:`journal_seq` is the number of the last batch of an
+    :class:`ActionJournal` whose results are included in the table.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.name_ids = {}
+        self.value_ids = {}
+        self.rows = {}
+        self.keys = []
+        self.successes = array.array('i')
+        self.fails = array.array('i')
+
+        # Entries of the JSON data whose keys couldn't be understood,
+        # which are kept so that they are written back out.
+        self.extra = {}
+        self.journal_seq = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def intern(self, name):
+        """Return the ID of the string ``name``."""
+        i = self.name_ids.get(name)
+        if i is None:
+            i = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    def intern_value(self, value):
+        """
+        Return the ID of the string ``value`` is written as in the JSON
+        keys.
+        """
+        # Keyed by type as well, since e.g. 1 and 1.0 are equal but are
+        # written differently.
+        key = (value.__class__, value)
+        i = self.value_ids.get(key)
+        if i is None:
+            i = self.value_ids[key] = self.intern(str(value))
+        return i
+
+    def get_key(self, cls, room, x, y, facing, speed, target_x, target_y,
+                check_x, check_y, action):
+        """
+        Return the key of the given situation.  ``cls``, ``room`` and
+        ``action`` are names; ``facing`` and ``speed`` are numbers; the
+        rest are quantized coordinates, or None.
+        """
+        return (self.intern(cls), self.intern(room), NONE if x is None else x,
+                NONE if y is None else y, self.intern_value(facing),
+                self.intern_value(speed),
+                NONE if target_x is None else target_x,
+                NONE if target_y is None else target_y,
+                NONE if check_x is None else check_x,
+                NONE if check_y is None else check_y, self.intern(action))
+
+    def get(self, key):
+        """Return the successes and fails counted for ``key``."""
+        row = self.rows.get(key)
+        if row is None:
+            return 0, 0
+        return self.successes[row], self.fails[row]
+
+    def _get_row(self, key):
+        row = self.rows.get(key)
+        if row is None:
+            row = self.rows[key] = len(self.keys)
+            self.keys.append(key)
+            self.successes.append(0)
+            self.fails.append(0)
+        return row
+
+    def log(self, key, success):
+        """Count a success or a fail for ``key``."""
+        row = self._get_row(key)
+        if success:
+            self.successes[row] += 1
+        else:
+            self.fails[row] += 1
+
+    def set(self, key, successes, fails):
+        row = self._get_row(key)
+        self.successes[row] = successes
+        self.fails[row] = fails
+
+    def add(self, key, successes, fails):
+        row = self._get_row(key)
+        self.successes[row] += successes
+        self.fails[row] += fails
+
+    def copy(self):
+        """
+        Return a copy of the table which can be read from another
+        thread while this one keeps changing.
+        """
+        table = self.__class__()
+        table.names = self.names[:]
+        table.name_ids = self.name_ids.copy()
+        table.value_ids = self.value_ids.copy()
+        table.rows = self.rows.copy()
+        table.keys = self.keys[:]
+        table.successes = self.successes[:]
+        table.fails = self.fails[:]
+        table.extra = self.extra.copy()
+        table.journal_seq = self.journal_seq
+        return table
+
+    def key_to_str(self, key):
+        """Return ``key`` written as a key of the JSON data."""
+        fields = []
+        for i, v in enumerate(key):
+            if i in NAME_FIELDS:
+                fields.append(self.names[v])
+            else:
+                fields.append(None if v == NONE else v)
+        return KEY_FORMAT.format(*fields)
+
+    def str_to_key(self, s):
+        """
+        Return the key written as ``s`` in the JSON data, or None if
+        ``s`` can't be understood.
+        """
+        m = KEY_RE.match(s)
+        if m is None:
+            return None
+
+        key = []
+        for i, v in enumerate(m.groups()):
+            if i in NAME_FIELDS:
+                key.append(self.intern(v))
+            elif v == "None":
+                key.append(NONE)
+            else:
+                try:
+                    key.append(int(v))
+                except ValueError:
+                    return None
+
+        key = tuple(key)
+        if self.key_to_str(key) != s:
+            return None
+        return key
+
+    def to_json(self):
+        """
+        Return the table as a dictionary which can be written to
+        ``ai_data.json``.
+        """
+        data = dict(self.extra)
+        for row, key in enumerate(self.keys):
+            data[self.key_to_str(key)] = [self.successes[row],
+                                          self.fails[row]]
+        return data
+
+    def update_json(self, data, add=False):
+        """
+        Set the counts of the entries of ``data``, a dictionary read
+        from ``ai_data.json``, or add them to the counts already in the
+        table if ``add`` is true.
+        """
+        for s, (successes, fails) in data.items():
+            key = self.str_to_key(s)
+            if key is None:
+                if add:
+                    old = self.extra.get(s, [0, 0])
+                    successes += old[0]
+                    fails += old[1]
+                self.extra[s] = [successes, fails]
+            elif add:
+                self.add(key, successes, fails)
+            else:
+                self.set(key, successes, fails)
+
+    def save(self, f):
+        """Write the table to the binary file ``f``."""
+        names = [name.encode("utf-8") for name in self.names]
+        extra = json.dumps(self.extra).encode("utf-8")
+        f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(names),
+                                   len(self.keys), len(extra),
+                                   self.journal_seq))
+        for name in names:
+            f.write(struct.pack("<I", len(name)))
+            f.write(name)
+
+        keys = array.array('i')
+        for key in self.keys:
+            keys.extend(key)
+        for a in (keys, self.successes, self.fails):
+            if sys.byteorder != "little":
+                a = array.array(a.typecode, a)
+                a.byteswap()
+            f.write(a.tobytes())
+        f.write(extra)
+
+    def load(self, f):
+        """
+        Read a table written by :meth:`save` from the binary file
+        ``f``, setting the counts of every entry in it.  Raise
+        :class:`ValueError` if the file is not valid.
+        """
+        def read(n):
+            data = f.read(n)
+            if len(data) < n:
+                raise ValueError("AI data is truncated.")
+            return data
+
+        magic, version, nnames, nrows, nextra = BINARY_HEADER_V1.unpack(
+            read(BINARY_HEADER_V1.size))
+        if magic != BINARY_MAGIC or not 1 <= version <= BINARY_VERSION:
+            raise ValueError("Not a valid AI data file.")
+        journal_seq = 0
+        if version >= 2:
+            journal_seq, = struct.unpack(
+                "<Q", read(BINARY_HEADER.size - BINARY_HEADER_V1.size))
+
+        names = []
+        for i in range(nnames):
+            length, = struct.unpack("<I", read(4))
+            names.append(read(length).decode("utf-8"))
+
+        columns = []
+        for n in (nrows * len(KEY_FIELDS), nrows, nrows):
+            a = array.array('i')
+            a.frombytes(read(n * a.itemsize))
+            if sys.byteorder != "little":
+                a.byteswap()
+            columns.append(a)
+        keys, successes, fails = columns
+        extra = json.loads(read(nextra).decode("utf-8"))
+
+        # Names are numbered in the order they were interned, which
+        # can differ from this table's.
+        nfields = len(KEY_FIELDS)
+        for i in NAME_FIELDS:
+            if any(not 0 <= n < nnames for n in keys[i::nfields]):
+                raise ValueError("AI data refers to a name which isn't in it.")
+
+        ids = [self.intern(name) for name in names]
+        for row in range(nrows):
+            key = list(keys[row*nfields:(row+1)*nfields])
+            for i in NAME_FIELDS:
+                key[i] = ids[key[i]]
+            self.set(tuple(key), successes[row], fails[row])
+        self.extra.update(extra)
+        self.journal_seq = max(self.journal_seq, journal_seq)
+
+
+class ActionJournal:
+
+    """
+    Append-only journal of the results logged to an
+    :class:`ActionTable`, so that they can be kept safe as they come
+    in without writing out the whole table every time.
+
+    Results are logged with :meth:`log`, which counts them in the
+    table and holds on to them until :meth:`flush` hands them over to
+    a background thread as one numbered batch, appended to ``fname``
+    as a line of JSON.  This happens at least every
+    :data:`hlib.AI_JOURNAL_INTERVAL` seconds while results come in.
+
+    The journal is compacted when :meth:`close` is called and whenever
+    it grows past :data:`hlib.AI_JOURNAL_LIMIT` bytes: a copy of the
+    table is passed to ``write_snapshot`` in the background thread,
+    after which the journal is emptied.  ``write_snapshot`` must save
+    the table's :attr:`ActionTable.journal_seq` along with it, so that
+    :meth:`recover` can add only the batches the snapshot is missing
+    when the game is started after a crash.
+    """
+
+    def __init__(self, table, fname, write_snapshot, interval=None,
+                 limit=None):
+        self.table = table
+        self.fname = fname
+        self.write_snapshot = write_snapshot
+        self.interval = interval or hlib.AI_JOURNAL_INTERVAL
+        self.limit = limit or hlib.AI_JOURNAL_LIMIT
+        self.pending = {}
+        self.last_flush = time.monotonic()
+        self.size = 0
+        self.cond = threading.Condition()
+        self.tasks = []
+        self.busy = False
+        self.thread = None
+
+    def log(self, key, success):
+        """Count a success or a fail for ``key``."""
+        self.table.log(key, success)
+        counts = self.pending.get(key)
+        if counts is None:
+            counts = self.pending[key] = [0, 0]
+        counts[0 if success else 1] += 1
+
+        if time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the results logged since the last flush to the journal
+        in the background, compacting it if it has grown too big.
+        """
+        self._write_pending()
+        with self.cond:
+            full = self.size >= self.limit
+        if full:
+            self.compact()
+
+    def compact(self):
+        """
+        Write a snapshot of the table, including every result logged so
+        far, and empty the journal, in the background.
+        """
+        # The table already counts the pending results, so they have to
+        # go in a batch the snapshot includes; otherwise they would be
+        # journaled after it and counted twice by recover().
+        self._write_pending()
+        with self.cond:
+            self.size = 0
+        self._post("compact", self.table.copy())
+
+    def wait(self):
+        """Wait until everything handed over has been written."""
+        with self.cond:
+            while self.tasks or self.busy:
+                self.cond.wait()
+
+    def close(self):
+        """Compact the journal and wait until it's done."""
+        self.compact()
+        self.wait()
+
+    def recover(self):
+        """
+        Add the batches in the journal which the table doesn't include
+        yet to the table, then compact the journal if it wasn't empty.
+        Return the number of batches added.
+        """
+        try:
+            with open(self.fname, encoding="utf-8") as f:
+                lines = f.readlines()
+        except OSError:
+            return 0
+
+        n = 0
+        for line in lines:
+            try:
+                batch = json.loads(line)
+                seq = int(batch["seq"])
+                results = {s: (int(successes), int(fails))
+                           for s, (successes, fails)
+                           in batch["results"].items()}
+            except (ValueError, KeyError, TypeError, AttributeError):
+                # Most likely the last line, cut short by a crash.
+                continue
+
+            if seq > self.table.journal_seq:
+                self.table.update_json(results, add=True)
+                self.table.journal_seq = seq
+                n += 1
+
+        if lines:
+            self.compact()
+        return n
+
+    def _write_pending(self):
+        self.last_flush = time.monotonic()
+        if self.pending:
+            self.table.journal_seq += 1
+            self._post("write", self.table.journal_seq, self.pending)
+            self.pending = {}
+
+    def _post(self, *task):
+        with self.cond:
+            self.tasks.append(task)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.tasks:
+                    self.cond.wait()
+                task = self.tasks.pop(0)
+                self.busy = True
+
+            try:
+                if task[0] == "write":
+                    self._write(*task[1:])
+                else:
+                    self._compact(*task[1:])
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+    def _write(self, seq, results):
+        # Only names the main thread has already interned are looked
+        # up, so this is safe while it interns new ones.
+        data = {self.table.key_to_str(key): counts
+                for key, counts in results.items()}
+        line = json.dumps({"seq": seq, "results": data}) + "\n"
+        try:
+            with open(self.fname, 'a', encoding="utf-8") as f:
+                f.write(line)
+        except OSError as e:
+            warnings.warn(f"Could not write AI journal: {e}")
+        else:
+            with self.cond:
+                self.size += len(line)
+
+    def _compact(self, table):
+        try:
+            self.write_snapshot(table)
+        except OSError as e:
+            warnings.warn(f"Could not write AI data: {e}")
+            return
+
+        # Every batch written so far is in the snapshot, since batches
+        # are written in order.
+        try:
+            with open(self.fname, 'w', encoding="utf-8"):
+                pass
+        except OSError as e:
+            warnings.warn(f"Could not empty AI journal: {e}")
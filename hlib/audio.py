@@ -0,0 +1,164 @@
+# Hexoshi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import math
+import time
+
+import hlib
+
+
+class SoundEngine:
+
+    """
+    Plays sound effects, keeping track of what has been played in the
+    current frame.
+
+    ``get_listeners`` is a function returning a list of ``(x, y)``
+    positions that positional sounds are heard from.  It is called at
+    most once per frame, as marked by :meth:`new_frame`.
+
+    Within a frame, a sound played again is dropped unless it is louder
+    than it was the last time.  Since frames don't advance while modal
+    dialogs are shown, a frame also ends once a frame's worth of time
+    has passed since it started.
+
+    At most :data:`hlib.sound_voices` sounds play at once.  Every sound
+    started is counted as a voice until it ends or is stopped.  When
+    all of the voices are in use, the oldest voice of the lowest
+    priority is stopped to make room for a sound of a higher priority;
+    otherwise, the new sound is dropped.
+    """
+
+    def __init__(self, get_listeners):
+        self.get_listeners = get_listeners
+        self.frame = 0
+        self.listeners = []
+        self.listeners_frame = None
+        self.window_frame = None
+        self.window_start = 0
+        self.played = {}
+
+        # Voices playing, oldest first, as [end_time, priority, sound]
+        # lists.
+        self.voices = []
+
+    def new_frame(self):
+        """Mark the start of a new frame."""
+        self.frame += 1
+
+    def _start_window(self):
+        now = time.perf_counter()
+        if (self.window_frame != self.frame
+                or now - self.window_start >= 1 / hlib.FPS):
+            self.window_frame = self.frame
+            self.window_start = now
+            self.played.clear()
+
+    def get_nearest_listener(self, x, y):
+        """
+        Return the listener nearest to ``(x, y)`` and its distance as a
+        tuple ``(lx, ly, dist)``, or :const:`None` if there are no
+        listeners.
+        """
+        if self.listeners_frame != self.frame:
+            self.listeners = self.get_listeners()
+            self.listeners_frame = self.frame
+
+        nearest = None
+        for lx, ly in self.listeners:
+            dist = math.hypot(lx - x, ly - y)
+            if nearest is None or dist < nearest[2]:
+                nearest = (lx, ly, dist)
+
+        return nearest
+
+    def play(self, sound, x=None, y=None, force=True, priority=None):
+        """
+        Play ``sound``.  If ``x`` and ``y`` are given, the sound is
+        positioned there and gets quieter the further it is from the
+        nearest listener.  ``force`` is passed on to
+        :meth:`sge.snd.Sound.play`, and ``priority`` is the priority of
+        the sound for the voice limit.  By default, positioned sounds
+        have :data:`hlib.SOUND_PRIORITY_WORLD` and other sounds, which
+        are those of menus and dialogs, have
+        :data:`hlib.SOUND_PRIORITY_UI`.
+        """
+        if not hlib.sound_volume or not sound:
+            return
+
+        if priority is None:
+            if x is not None and y is not None:
+                priority = hlib.SOUND_PRIORITY_WORLD
+            else:
+                priority = hlib.SOUND_PRIORITY_UI
+
+        balance = 0
+        volume = 1
+        if x is not None and y is not None:
+            listener = self.get_nearest_listener(x, y)
+            if listener is None:
+                return
+
+            lx, ly, dist = listener
+            if dist >= hlib.SOUND_ZERO_RADIUS:
+                # No point in continuing; it's too far away
+                return
+            elif dist > hlib.SOUND_MAX_RADIUS:
+                rng = hlib.SOUND_ZERO_RADIUS - hlib.SOUND_MAX_RADIUS
+                reldist = rng - (dist-hlib.SOUND_MAX_RADIUS)
+                volume = min(1, abs(reldist / rng))
+
+            if hlib.stereo_enabled:
+                hdist = x - lx
+                if abs(hdist) >= hlib.SOUND_CENTERED_RADIUS:
+                    rng = (hlib.SOUND_TILTED_RADIUS
+                           - hlib.SOUND_CENTERED_RADIUS)
+                    balance = max(-hlib.SOUND_TILT_LIMIT,
+                                  min(hdist / rng, hlib.SOUND_TILT_LIMIT))
+
+        self._start_window()
+        if volume <= self.played.get(sound, 0):
+            return
+
+        now = time.perf_counter()
+        self.voices = [voice for voice in self.voices
+                       if voice[0] > now and voice[2].playing]
+
+        if sound.max_play:
+            # Sounds only have so many channels of their own; when all
+            # of them are busy, one is taken over if force is set.
+            own = [voice for voice in self.voices if voice[2] is sound]
+            if len(own) >= sound.max_play:
+                if not force:
+                    return
+                self.voices.remove(own[0])
+
+        if len(self.voices) >= hlib.sound_voices:
+            lowest = min(self.voices, key=lambda voice: voice[1],
+                         default=None)
+            if lowest is None or lowest[1] >= priority:
+                return
+
+            # Stopping a sound stops all of it, so every voice of it
+            # goes.
+            lowest[2].stop()
+            self.voices = [voice for voice in self.voices
+                           if voice[2] is not lowest[2]]
+
+        self.played[sound] = volume
+        sound.play(volume=(volume * hlib.sound_volume), balance=balance,
+                   force=force)
+        self.voices.append([now + sound.length/1000, priority, sound])
@@ -0,0 +1,119 @@
+# Hexoshi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import math
+
+import hlib
+
+
+class LightRegistry:
+
+    """
+    Set of the objects in a room which project light, bucketed by
+    position so that the ones near a view can be found without looking
+    at every object in the room.
+
+    Light sources can move freely; their buckets are brought up to
+    date whenever the registry is searched.
+    """
+
+    def __init__(self, cell_size=None):
+        self.cell_size = cell_size or hlib.LIGHT_CELL_SIZE
+        # Dictionaries are used as ordered sets so that lights are
+        # always projected in the same order.
+        self.cells = {}
+        self.objects = {}
+
+    def __len__(self):
+        return len(self.objects)
+
+    def __contains__(self, obj):
+        return obj in self.objects
+
+    def get_cell_range(self, x, y, w, h):
+        """
+        Return the range of cells overlapped by the given rectangle as
+        a tuple ``(imin, jmin, imax, jmax)``.  ``imax`` and ``jmax`` are
+        inclusive.
+        """
+        cs = self.cell_size
+        return (int(math.floor(x / cs)), int(math.floor(y / cs)),
+                int(math.floor((x+w) / cs)), int(math.floor((y+h) / cs)))
+
+    def _place(self, obj):
+        old = self.objects[obj]
+        new = self.get_cell_range(obj.bbox_left, obj.bbox_top,
+                                  obj.bbox_width, obj.bbox_height)
+        if new == old:
+            return
+
+        if old is not None:
+            self._unplace(obj, old)
+
+        imin, jmin, imax, jmax = new
+        for i in range(imin, imax + 1):
+            for j in range(jmin, jmax + 1):
+                self.cells.setdefault((i, j), {})[obj] = None
+        self.objects[obj] = new
+
+    def _unplace(self, obj, cell_range):
+        imin, jmin, imax, jmax = cell_range
+        for i in range(imin, imax + 1):
+            for j in range(jmin, jmax + 1):
+                cell = self.cells.get((i, j))
+                if cell is not None:
+                    cell.pop(obj, None)
+                    if not cell:
+                        del self.cells[(i, j)]
+
+    def add(self, obj):
+        """Add the light source ``obj`` to the registry."""
+        if obj not in self.objects:
+            self.objects[obj] = None
+            self._place(obj)
+
+    def remove(self, obj):
+        """Remove ``obj`` from the registry, if it's in it."""
+        if obj in self.objects:
+            cell_range = self.objects.pop(obj)
+            if cell_range is not None:
+                self._unplace(obj, cell_range)
+
+    def update(self):
+        """Move every light source into the buckets for its position."""
+        for obj in self.objects:
+            self._place(obj)
+
+    def get_objects_at(self, x, y, w, h):
+        """
+        Return a list of the light sources whose bounding boxes overlap
+        the given rectangle.
+        """
+        if not self.objects:
+            return []
+
+        self.update()
+        found = {}
+        imin, jmin, imax, jmax = self.get_cell_range(x, y, w, h)
+        for i in range(imin, imax + 1):
+            for j in range(jmin, jmax + 1):
+                cell = self.cells.get((i, j))
+                if cell:
+                    found.update(cell)
+
+        return [obj for obj in found
+                if (obj.bbox_left <= x + w and obj.bbox_right >= x
+                    and obj.bbox_top <= y + h and obj.bbox_bottom >= y)]
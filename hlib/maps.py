@@ -0,0 +1,766 @@
+# Hexoshi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import math
+import os
+
+import sge
+
+import hlib
+
+
+WALL = 1
+DOOR = 2
+POWERUP = 4
+WARP_PAD = 8
+REVEALED = 16
+EXPLORED = 32
+VISIBLE = REVEALED | EXPLORED
+
+OBJECT_FLAGS = {
+    "wall_left": WALL, "wall_right": WALL, "wall_top": WALL,
+    "wall_bottom": WALL, "door_left": DOOR, "door_right": DOOR,
+    "door_top": DOOR, "door_bottom": DOOR, "powerup": POWERUP,
+    "warp_pad": WARP_PAD}
+
+_mask_tables = {}
+_grid = None
+
+
+def get_map_state():
+    """
+    Return a value which changes whenever the map data in :mod:`hlib`
+    is replaced or has anything added to it.  Compare it with
+    :func:`is_map_state`.
+    """
+    return tuple((data, len(data)) for data in (
+        hlib.map_rooms, hlib.map_objects, hlib.map_revealed,
+        hlib.map_explored, hlib.map_removed))
+
+
+def is_map_state(state):
+    """
+    Return whether ``state``, a value returned by
+    :func:`get_map_state`, still describes the map data.
+    """
+    if state is None:
+        return False
+
+    for (data, length), (old_data, old_length) in zip(get_map_state(),
+                                                      state):
+        if data is not old_data or length != old_length:
+            return False
+
+    return True
+
+
+def _get_mask_table(mask):
+    # Translation table turning every flag byte into 1 if it has any
+    # of the flags in mask set and 0 otherwise.
+    table = _mask_tables.get(mask)
+    if table is None:
+        table = bytes(1 if i & mask else 0 for i in range(256))
+        _mask_tables[mask] = table
+
+    return table
+
+
+class MapGrid:
+
+    """
+    Dense grid of flags covering the bounding box of the map, one byte
+    per cell.  Each byte is a combination of :data:`WALL`,
+    :data:`DOOR`, :data:`POWERUP` and :data:`WARP_PAD` for the objects
+    in the cell, and :data:`REVEALED` and :data:`EXPLORED`.
+
+    ``cells`` is a :class:`bytearray` in row-major order, so queries
+    over the whole map run in C through :meth:`bytearray.translate`.
+    Setting a flag is constant time unless the grid has to grow.
+    """
+
+    def __init__(self, left=0, top=0, width=0, height=0):
+        self.left = left
+        self.top = top
+        self.width = width
+        self.height = height
+        self.cells = bytearray(width * height)
+        self.state = None
+
+    @classmethod
+    def from_map(cls):
+        """Return a new grid built from the map data in :mod:`hlib`."""
+        cells = set(hlib.map_objects) | hlib.map_revealed | hlib.map_explored
+        if cells:
+            left = min(x for x, y in cells)
+            top = min(y for x, y in cells)
+            width = max(x for x, y in cells) - left + 1
+            height = max(y for x, y in cells) - top + 1
+            grid = cls(left, top, width, height)
+        else:
+            grid = cls()
+
+        for pos, objects in hlib.map_objects.items():
+            flags = 0
+            for obj in objects:
+                flags |= OBJECT_FLAGS.get(obj, 0)
+            grid.set_flags(pos, flags)
+        for pos in hlib.map_revealed:
+            grid.set_flags(pos, REVEALED)
+        for pos in hlib.map_explored:
+            grid.set_flags(pos, EXPLORED)
+
+        grid.state = get_map_state()
+        return grid
+
+    def get_index(self, pos):
+        """
+        Return the index of ``pos`` in :attr:`cells`, or
+        :const:`None` if it is outside the grid.
+        """
+        x = pos[0] - self.left
+        y = pos[1] - self.top
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return y*self.width + x
+        return None
+
+    def get_flags(self, pos):
+        """Return the flags of ``pos``."""
+        i = self.get_index(pos)
+        return self.cells[i] if i is not None else 0
+
+    def set_flags(self, pos, flags):
+        """Set ``flags`` on ``pos``, growing the grid if necessary."""
+        if not flags:
+            return
+
+        i = self.get_index(pos)
+        if i is None:
+            x, y = pos
+            if self.width and self.height:
+                left = min(self.left, x)
+                top = min(self.top, y)
+                right = max(self.left + self.width, x + 1)
+                bottom = max(self.top + self.height, y + 1)
+                self.resize(left, top, right - left, bottom - top)
+            else:
+                self.resize(x, y, 1, 1)
+            i = self.get_index(pos)
+
+        self.cells[i] |= flags
+
+    def resize(self, left, top, width, height):
+        """
+        Change the area covered by the grid, keeping the flags of the
+        cells in both the old and the new area.
+        """
+        cells = bytearray(width * height)
+        x1 = max(left, self.left)
+        x2 = min(left + width, self.left + self.width)
+        if x1 < x2:
+            for y in range(max(top, self.top),
+                           min(top + height, self.top + self.height)):
+                src = (y-self.top)*self.width + x1 - self.left
+                dest = (y-top)*width + x1 - left
+                cells[dest:dest + x2 - x1] = self.cells[src:src + x2 - x1]
+
+        self.left = left
+        self.top = top
+        self.width = width
+        self.height = height
+        self.cells = cells
+
+    def count(self, mask):
+        """Return the number of cells with any of the flags in ``mask``."""
+        return self.cells.translate(_get_mask_table(mask)).count(1)
+
+    def find(self, mask, x=None, y=None, w=None, h=None):
+        """
+        Return a list of the positions with any of the flags in
+        ``mask``, in row-major order.  If ``x``, ``y``, ``w`` and ``h``
+        are given, only the cells in that rectangle are searched.
+        """
+        if x is None or y is None or w is None or h is None:
+            x = self.left
+            y = self.top
+            w = self.width
+            h = self.height
+
+        x1 = max(x, self.left)
+        x2 = min(x + w, self.left + self.width)
+        y1 = max(y, self.top)
+        y2 = min(y + h, self.top + self.height)
+        if x1 >= x2 or y1 >= y2:
+            return []
+
+        table = _get_mask_table(mask)
+        found = []
+        if x1 == self.left and x2 == self.left + self.width:
+            # Whole rows, so they can be searched in one go.
+            start = (y1-self.top) * self.width
+            block = self.cells[start:start + (y2-y1)*self.width]
+            block = block.translate(table)
+            i = block.find(1)
+            while i >= 0:
+                row, col = divmod(i, self.width)
+                found.append((x1 + col, y1 + row))
+                i = block.find(1, i + 1)
+        else:
+            for cy in range(y1, y2):
+                start = (cy-self.top)*self.width + x1 - self.left
+                row = self.cells[start:start + x2 - x1].translate(table)
+                i = row.find(1)
+                while i >= 0:
+                    found.append((x1 + i, cy))
+                    i = row.find(1, i + 1)
+
+        return found
+
+
+def get_grid():
+    """
+    Return a :class:`MapGrid` of the map data in :mod:`hlib`, which is
+    rebuilt if the data has been changed other than by the functions
+    in this module.
+    """
+    global _grid
+
+    if _grid is None or not is_map_state(_grid.state):
+        _grid = MapGrid.from_map()
+
+    return _grid
+
+
+def explore_cell(pos):
+    """
+    Mark ``pos`` as explored (and revealed), and return whether it
+    wasn't already.
+    """
+    grid = get_grid()
+    if pos in hlib.map_explored and pos in hlib.map_revealed:
+        return False
+
+    hlib.map_explored.add(pos)
+    hlib.map_revealed.add(pos)
+    grid.set_flags(pos, REVEALED | EXPLORED)
+    grid.state = get_map_state()
+    return True
+
+
+def reveal_cells(cells):
+    """
+    Mark every position in ``cells`` as revealed, and return a set of
+    the ones which weren't already.
+    """
+    grid = get_grid()
+    cells = set(cells) - hlib.map_revealed
+    if cells:
+        hlib.map_revealed |= cells
+        for pos in cells:
+            grid.set_flags(pos, REVEALED)
+        grid.state = get_map_state()
+
+    return cells
+
+
+def remove_object(obj, fname, x, y):
+    """
+    Remove ``obj`` from the map at the position ``(x, y)`` relative to
+    the room ``fname``, and return whether it wasn't already.
+    """
+    grid = get_grid()
+    entry = (obj, fname, x, y)
+    if entry in hlib.map_removed:
+        return False
+
+    hlib.map_removed.add(entry)
+    grid.state = get_map_state()
+    return True
+
+
+_cell_sprites = {}
+
+
+def get_cell_sprite(color):
+    """
+    Return a sprite the size of a map cell filled with the color
+    ``color``, given as an RGB tuple.
+
+    Drawing this is much cheaper than drawing a rectangle of the same
+    size onto a large sprite, which blends the whole sprite.
+    """
+    sprite = _cell_sprites.get(color)
+    if sprite is None:
+        sprite = sge.gfx.Sprite(width=hlib.MAP_CELL_WIDTH,
+                                height=hlib.MAP_CELL_HEIGHT)
+        sprite.draw_rectangle(0, 0, hlib.MAP_CELL_WIDTH,
+                              hlib.MAP_CELL_HEIGHT,
+                              fill=sge.gfx.Color(color))
+        _cell_sprites[color] = sprite
+
+    return sprite
+
+
+def get_object_sprites():
+    """
+    Return a dictionary mapping the names of map objects to the sprites
+    they are drawn with.
+    """
+    return {
+        "wall_left": hlib.map_wall_left_sprite,
+        "wall_right": hlib.map_wall_right_sprite,
+        "wall_top": hlib.map_wall_top_sprite,
+        "wall_bottom": hlib.map_wall_bottom_sprite,
+        "door_left": hlib.map_door_left_sprite,
+        "door_right": hlib.map_door_right_sprite,
+        "door_top": hlib.map_door_top_sprite,
+        "door_bottom": hlib.map_door_bottom_sprite,
+        "powerup": hlib.map_powerup_sprite,
+        "warp_pad": hlib.map_warp_pad_sprite}
+
+
+def get_removed():
+    """
+    Return a dictionary mapping map positions to a
+    :class:`collections.Counter` of the objects removed from them.
+    """
+    removed = {}
+    for obj, fname, ox, oy in hlib.map_removed:
+        if fname in hlib.map_rooms:
+            rm_x, rm_y = hlib.map_rooms[fname]
+            pos = (rm_x + ox, rm_y + oy)
+            removed.setdefault(pos, collections.Counter())[obj] += 1
+
+    return removed
+
+
+def get_drawn_objects(pos, removed):
+    """
+    Return a list of the names of the map objects at ``pos`` which are
+    drawn, in the order they are drawn.  ``removed`` is a dictionary as
+    returned by :func:`get_removed`.
+    """
+    objects = hlib.map_objects.get(pos)
+    if not objects:
+        return []
+
+    cell_removed = removed.get(pos)
+    if cell_removed:
+        cell_removed = cell_removed.copy()
+
+    drawn = []
+    for obj in objects:
+        if cell_removed and cell_removed[obj]:
+            cell_removed[obj] -= 1
+            continue
+
+        if obj == "powerup" and "warp_pad" in objects:
+            continue
+
+        drawn.append(obj)
+
+    return drawn
+
+
+def draw_objects(sprite, pos, dx, dy, sprites, removed):
+    """
+    Draw the map objects at ``pos`` onto ``sprite`` at ``(dx, dy)``.
+    ``sprites`` is a dictionary as returned by
+    :func:`get_object_sprites`, and ``removed`` is a dictionary as
+    returned by :func:`get_removed`.
+    """
+    for obj in get_drawn_objects(pos, removed):
+        obj_sprite = sprites.get(obj)
+        if obj_sprite is not None:
+            sprite.draw_sprite(obj_sprite, 0, dx, dy)
+
+
+def get_bounds():
+    """
+    Return the area of the map which contains every revealed or
+    explored cell, and the origin, as a tuple ``(x, y, w, h)``.
+    """
+    visible = get_grid().find(VISIBLE)
+    left = min(0, min((rx for rx, ry in visible), default=0))
+    right = max(0, max((rx for rx, ry in visible), default=0))
+    top = min(0, min((ry for rx, ry in visible), default=0))
+    bottom = max(0, max((ry for rx, ry in visible), default=0))
+    return (left, top, right - left + 1, bottom - top + 1)
+
+
+def draw_map(x=None, y=None, w=None, h=None, player_x=None, player_y=None):
+    """
+    Return a new sprite showing the ``w`` by ``h`` cells of the map
+    starting at ``(x, y)``, with the player marker drawn at
+    ``(player_x, player_y)`` if those are given.  Any of ``x``, ``y``,
+    ``w`` and ``h`` which are not given are chosen so that the whole
+    revealed map is shown.
+    """
+    grid = get_grid()
+    if x is None or y is None or w is None or h is None:
+        left, top, width, height = get_bounds()
+        if x is None:
+            x = left
+        if y is None:
+            y = top
+        if w is None:
+            w = left + width - x
+        if h is None:
+            h = top + height - y
+
+    s_w = w * hlib.MAP_CELL_WIDTH
+    s_h = h * hlib.MAP_CELL_HEIGHT
+    map_sprite = sge.gfx.Sprite(width=s_w, height=s_h)
+    map_sprite.draw_lock()
+    map_sprite.draw_rectangle(0, 0, s_w, s_h, fill=sge.gfx.Color("black"))
+
+    explored_sprite = get_cell_sprite((170, 68, 153))
+    for pos in grid.find(EXPLORED, x, y, w, h):
+        map_sprite.draw_sprite(explored_sprite, 0,
+                               (pos[0]-x) * hlib.MAP_CELL_WIDTH,
+                               (pos[1]-y) * hlib.MAP_CELL_HEIGHT)
+
+    removed = get_removed()
+    sprites = get_object_sprites()
+    for pos in grid.find(VISIBLE, x, y, w, h):
+        if grid.get_flags(pos) & ~VISIBLE:
+            draw_objects(map_sprite, pos, (pos[0]-x) * hlib.MAP_CELL_WIDTH,
+                         (pos[1]-y) * hlib.MAP_CELL_HEIGHT, sprites,
+                         removed)
+
+    if player_x is not None and player_y is not None:
+        dx = (player_x - x) * hlib.MAP_CELL_WIDTH
+        dy = (player_y - y) * hlib.MAP_CELL_HEIGHT
+        map_sprite.draw_sprite(hlib.map_player_sprite, 0, dx, dy)
+
+    map_sprite.draw_unlock()
+    return map_sprite
+
+
+class MapSurface:
+
+    """
+    Image of the whole map, kept up to date one cell at a time as the
+    map is revealed and explored, so that parts of it can be shown
+    without drawing the map again.
+
+    The image is split into square chunks of
+    :data:`hlib.MAP_CHUNK_SIZE` cells, since drawing a sprite copies
+    all of it first.  Chunks with nothing visible in them are not
+    created.
+
+    Changes to the map should be made with :meth:`explore`,
+    :meth:`reveal_cells` and :meth:`remove`.  If the map data is
+    changed any other way, the image is rebuilt the next time it is
+    used.
+    """
+
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size or hlib.MAP_CHUNK_SIZE
+        self.chunks = {}
+        self.zoomed = {}
+        self.window = None
+        self.state = None
+        self.removed = {}
+
+    def is_current(self):
+        """Return whether the image reflects the current map data."""
+        return is_map_state(self.state)
+
+    def get_chunk(self, i, j):
+        """
+        Return the sprite of the chunk ``(i, j)``, creating it if it
+        doesn't exist.
+        """
+        chunk = self.chunks.get((i, j))
+        if chunk is None:
+            s_w = self.chunk_size * hlib.MAP_CELL_WIDTH
+            s_h = self.chunk_size * hlib.MAP_CELL_HEIGHT
+            chunk = sge.gfx.Sprite(width=s_w, height=s_h)
+            chunk.draw_rectangle(0, 0, s_w, s_h, fill=sge.gfx.Color("black"))
+            self.chunks[(i, j)] = chunk
+
+        return chunk
+
+    def rebuild(self):
+        """Draw the whole map from scratch."""
+        grid = get_grid()
+        self.chunks = {}
+        self.zoomed = {}
+        self.removed = get_removed()
+        sprites = get_object_sprites()
+
+        by_chunk = {}
+        for x, y in grid.find(VISIBLE):
+            key = (x // self.chunk_size, y // self.chunk_size)
+            by_chunk.setdefault(key, []).append((x, y))
+
+        for (i, j), cells in by_chunk.items():
+            chunk = self.get_chunk(i, j)
+            chunk.draw_lock()
+            for pos in cells:
+                self.draw_cell(pos, sprites)
+            chunk.draw_unlock()
+
+        self.state = get_map_state()
+
+    def update(self):
+        """Rebuild the image if the map data has changed."""
+        if not self.is_current():
+            self.rebuild()
+
+    def draw_cell(self, pos, sprites=None):
+        if sprites is None:
+            sprites = get_object_sprites()
+
+        x, y = pos
+        i = x // self.chunk_size
+        j = y // self.chunk_size
+        chunk = self.get_chunk(i, j)
+        dx = (x - i*self.chunk_size) * hlib.MAP_CELL_WIDTH
+        dy = (y - j*self.chunk_size) * hlib.MAP_CELL_HEIGHT
+        for zoom in range(1, hlib.MAP_ZOOM_LEVELS):
+            self.zoomed.pop((i, j, zoom), None)
+
+        flags = get_grid().get_flags(pos)
+        if flags & EXPLORED:
+            color = (170, 68, 153)
+        else:
+            color = (0, 0, 0)
+        chunk.draw_sprite(get_cell_sprite(color), 0, dx, dy)
+
+        if flags & VISIBLE and flags & ~VISIBLE:
+            draw_objects(chunk, pos, dx, dy, sprites, self.removed)
+
+    def explore(self, pos):
+        """Mark ``pos`` as explored (and revealed)."""
+        current = self.is_current()
+        if explore_cell(pos) and current:
+            self.state = get_map_state()
+            self.draw_cell(pos)
+
+    def reveal_cells(self, cells):
+        """Mark every position in ``cells`` as revealed."""
+        current = self.is_current()
+        cells = reveal_cells(cells)
+        if cells and current:
+            self.state = get_map_state()
+            sprites = get_object_sprites()
+            for pos in cells:
+                self.draw_cell(pos, sprites)
+
+    def remove(self, obj, fname, x, y):
+        """
+        Remove ``obj`` from the map at the position ``(x, y)`` relative
+        to the room ``fname``.
+        """
+        current = self.is_current()
+        if remove_object(obj, fname, x, y) and current:
+            self.state = get_map_state()
+            if fname in hlib.map_rooms:
+                rm_x, rm_y = hlib.map_rooms[fname]
+                pos = (rm_x + x, rm_y + y)
+                self.removed.setdefault(
+                    pos, collections.Counter())[obj] += 1
+                if get_grid().get_flags(pos) & VISIBLE:
+                    self.draw_cell(pos)
+
+    def get_zoomed(self, sprite, key, zoom):
+        # Return sprite shrunk by half zoom times, caching it as key.
+        if not zoom:
+            return sprite
+
+        zoomed = self.zoomed.get(key)
+        if zoomed is None:
+            scale = 2 ** -zoom
+            zoomed = sprite.copy()
+            zoomed.scale(scale, scale)
+            zoomed.resize_canvas(max(1, int(sprite.width * scale)),
+                                 max(1, int(sprite.height * scale)))
+            self.zoomed[key] = zoomed
+
+        return zoomed
+
+    def draw_view(self, sprite, x, y, zoom=0, player_x=None, player_y=None):
+        """
+        Draw the part of the map with the cell ``(x, y)`` at its top
+        left onto ``sprite``, filling it, and with the player marker
+        drawn at ``(player_x, player_y)`` if those are given.
+
+        ``zoom`` is the zoom level, each of which halves the size of
+        the cells.  Zoomed out chunks are cached, so this only costs as
+        much as the number of chunks which fit on ``sprite``.
+        """
+        self.update()
+
+        cell_w = hlib.MAP_CELL_WIDTH / 2**zoom
+        cell_h = hlib.MAP_CELL_HEIGHT / 2**zoom
+        w = math.ceil(sprite.width / cell_w)
+        h = math.ceil(sprite.height / cell_h)
+
+        sprite.draw_lock()
+        sprite.draw_rectangle(0, 0, sprite.width, sprite.height,
+                              fill=sge.gfx.Color("black"))
+
+        cs = self.chunk_size
+        for j in range(y // cs, (y+h-1) // cs + 1):
+            for i in range(x // cs, (x+w-1) // cs + 1):
+                chunk = self.chunks.get((i, j))
+                if chunk is not None:
+                    chunk = self.get_zoomed(chunk, (i, j, zoom), zoom)
+                    sprite.draw_sprite(chunk, 0, (i*cs - x) * cell_w,
+                                       (j*cs - y) * cell_h)
+
+        if player_x is not None and player_y is not None:
+            marker = self.get_zoomed(hlib.map_player_sprite,
+                                     ("player", zoom), zoom)
+            sprite.draw_sprite(marker, 0, (player_x - x) * cell_w,
+                               (player_y - y) * cell_h)
+
+        sprite.draw_unlock()
+
+    def draw_window(self, x, y, w, h, player_x=None, player_y=None):
+        """
+        Return a sprite showing the ``w`` by ``h`` cells of the map
+        starting at ``(x, y)``, with the player marker drawn at
+        ``(player_x, player_y)`` if those are given.  This looks the
+        same as the sprite returned by :func:`draw_map`, but the sprite
+        is reused by the next call.
+        """
+        s_w = w * hlib.MAP_CELL_WIDTH
+        s_h = h * hlib.MAP_CELL_HEIGHT
+        if (self.window is None or self.window.width != s_w
+                or self.window.height != s_h):
+            self.window = sge.gfx.Sprite(width=s_w, height=s_h)
+
+        self.draw_view(self.window, x, y, 0, player_x, player_y)
+        return self.window
+
+
+def _get_pixel_rows(sprite, scale):
+    # Return the pixels of sprite as a list of RGB rows, each pixel
+    # repeated scale times in both directions.
+    rows = []
+    for y in range(sprite.height):
+        row = bytearray()
+        for x in range(sprite.width):
+            color = sprite.get_pixel(x, y)
+            row.extend(bytes((color.red, color.green, color.blue)) * scale)
+        rows.extend([bytes(row)] * scale)
+
+    return rows
+
+
+def _get_label(font, text):
+    # Return the pixels of text drawn in font that aren't transparent
+    # as a list of (x, y, red, green, blue, alpha) tuples, along with
+    # the size of the text.
+    sprite = sge.gfx.Sprite.from_text(
+        font, text, color=sge.gfx.Color("white"),
+        outline=sge.gfx.Color("black"), outline_thickness=1)
+    label = []
+    for x in range(sprite.width):
+        for y in range(sprite.height):
+            color = sprite.get_pixel(x, y)
+            if color.alpha:
+                label.append((x, y, color.red, color.green, color.blue,
+                              color.alpha))
+
+    return label, sprite.width, sprite.height
+
+
+def export_map(fname, scale=1, font=None):
+    """
+    Save an image of the whole revealed map as the PNG file ``fname``,
+    looking the same as the sprite returned by :func:`draw_map` with
+    each pixel scaled up ``scale`` times.  If ``font`` is given, each
+    room is labeled with its file name in that font.
+
+    The image is made and written one row of cells at a time, so only
+    that much of it is ever in memory.  Cells which look the same are
+    only drawn once.
+    """
+    grid = get_grid()
+    removed = get_removed()
+    sprites = get_object_sprites()
+    explored_sprite = get_cell_sprite((170, 68, 153))
+    x, y, w, h = get_bounds()
+    cell_w = hlib.MAP_CELL_WIDTH * scale
+    cell_h = hlib.MAP_CELL_HEIGHT * scale
+
+    labels = []
+    if font is not None:
+        for room, (rm_x, rm_y) in sorted(hlib.map_rooms.items()):
+            text = os.path.splitext(os.path.basename(room))[0]
+            label, l_w, l_h = _get_label(font, text)
+            labels.append(((rm_x-x)*cell_w + 2, (rm_y-y)*cell_h + 2, l_w,
+                           l_h, label))
+
+    blocks = {}
+    cell = sge.gfx.Sprite(width=hlib.MAP_CELL_WIDTH,
+                          height=hlib.MAP_CELL_HEIGHT)
+
+    def get_block(pos):
+        flags = grid.get_flags(pos)
+        if flags & VISIBLE:
+            key = (flags & EXPLORED, tuple(get_drawn_objects(pos, removed)))
+        else:
+            key = (0, ())
+
+        block = blocks.get(key)
+        if block is None:
+            cell.draw_rectangle(0, 0, cell.width, cell.height,
+                                fill=sge.gfx.Color("black"))
+            if key[0]:
+                cell.draw_sprite(explored_sprite, 0, 0, 0)
+            for obj in key[1]:
+                obj_sprite = sprites.get(obj)
+                if obj_sprite is not None:
+                    cell.draw_sprite(obj_sprite, 0, 0, 0)
+            block = _get_pixel_rows(cell, scale)
+            blocks[key] = block
+
+        return block
+
+    with open(fname, "wb") as f:
+        writer = hlib.png.PNGWriter(f, w * cell_w, h * cell_h)
+        for j in range(h):
+            row_blocks = [get_block((x + i, y + j)) for i in range(w)]
+            band = [b"".join(block[r] for block in row_blocks)
+                    for r in range(cell_h)]
+
+            top = j * cell_h
+            for l_x, l_y, l_w, l_h, label in labels:
+                if l_y >= top + cell_h or l_y + l_h <= top:
+                    continue
+
+                for dx, dy, red, green, blue, alpha in label:
+                    px = l_x + dx
+                    r = l_y + dy - top
+                    if 0 <= r < cell_h and 0 <= px < w * cell_w:
+                        if not isinstance(band[r], bytearray):
+                            band[r] = bytearray(band[r])
+                        row = band[r]
+                        i = px * 3
+                        for k, src in enumerate((red, green, blue)):
+                            dest = row[i + k]
+                            row[i + k] = ((src*alpha + dest*(255-alpha) + 127)
+                                          // 255)
+
+            for row in band:
+                writer.write_row(row)
+
+        writer.close()
@@ -0,0 +1,238 @@
+# Hexoshi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import math
+
+import xsge_physics
+
+import hlib
+
+
+LEFT = 1
+RIGHT = 2
+TOP = 4
+BOTTOM = 8
+SLOPE_TOP_LEFT = 16
+SLOPE_TOP_RIGHT = 32
+SLOPE_BOTTOM_LEFT = 64
+SLOPE_BOTTOM_RIGHT = 128
+SLOPES = (SLOPE_TOP_LEFT | SLOPE_TOP_RIGHT | SLOPE_BOTTOM_LEFT
+          | SLOPE_BOTTOM_RIGHT)
+ALL = LEFT | RIGHT | TOP | BOTTOM | SLOPES
+
+_wall_flags = [
+    (xsge_physics.SolidLeft, LEFT), (xsge_physics.SolidRight, RIGHT),
+    (xsge_physics.SolidTop, TOP), (xsge_physics.SolidBottom, BOTTOM),
+    (xsge_physics.SlopeTopLeft, SLOPE_TOP_LEFT),
+    (xsge_physics.SlopeTopRight, SLOPE_TOP_RIGHT),
+    (xsge_physics.SlopeBottomLeft, SLOPE_BOTTOM_LEFT),
+    (xsge_physics.SlopeBottomRight, SLOPE_BOTTOM_RIGHT)]
+
+
+def get_flags(obj):
+    """Return the occupancy flags for the wall ``obj``."""
+    flags = 0
+    for cls, flag in _wall_flags:
+        if isinstance(obj, cls):
+            flags |= flag
+    return flags
+
+
+class OccupancyGrid:
+
+    """
+    Coarse map of which kinds of walls are in each part of a room.
+
+    Each cell of the grid is :data:`hlib.OCCUPANCY_CELL_SIZE` pixels
+    square and holds the flags of every static wall overlapping it.  A
+    cell with no flags is guaranteed to have no walls in it, but a cell
+    with flags only might, so queries are meant to rule out expensive
+    collision checks rather than replace them.
+
+    Walls which can move or change (e.g. moving platforms) should be
+    added with ``static=False``; these are kept in a separate list and
+    checked individually by every query.
+    """
+
+    def __init__(self, width, height, cell_size=None):
+        self.cell_size = cell_size or hlib.OCCUPANCY_CELL_SIZE
+        self.columns = max(1, math.ceil(width / self.cell_size))
+        self.rows = max(1, math.ceil(height / self.cell_size))
+        self.cells = bytearray(self.columns * self.rows)
+        self.walls = {}
+        self.dynamic = {}
+
+        # Static walls overlapping each cell, and reaching outside of
+        # the grid, for finding the walls themselves.
+        self.cell_walls = {}
+        self.outside_walls = {}
+
+        # Flags of walls reaching outside of the grid, which apply to
+        # everything outside of the grid.
+        self.outside = 0
+
+    def get_cell_range(self, x, y, w, h):
+        """
+        Return the range of cells overlapped by the given rectangle as
+        a tuple ``(imin, jmin, imax, jmax)``, clamped to the grid.
+        ``imax`` and ``jmax`` are exclusive.  Edges falling exactly on
+        a cell boundary include the next cell, to stay on the safe
+        side.
+        """
+        cs = self.cell_size
+        imin = max(0, int(math.floor(x / cs)))
+        jmin = max(0, int(math.floor(y / cs)))
+        imax = min(self.columns, int(math.floor((x+w) / cs)) + 1)
+        jmax = min(self.rows, int(math.floor((y+h) / cs)) + 1)
+        return imin, jmin, imax, jmax
+
+    def is_outside(self, x, y, w, h):
+        """
+        Return whether or not the given rectangle reaches outside of the
+        grid.
+        """
+        cs = self.cell_size
+        return (x < 0 or y < 0 or x + w > self.columns*cs
+                or y + h > self.rows*cs)
+
+    def _paint(self, imin, jmin, imax, jmax):
+        # Recalculate the given cells from the static walls.
+        for j in range(jmin, jmax):
+            row = j * self.columns
+            for i in range(imin, imax):
+                self.cells[row + i] = 0
+
+        self.outside = 0
+        for flags, rect in self.walls.values():
+            self._paint_wall(flags, rect, imin, jmin, imax, jmax)
+
+    def _paint_wall(self, flags, rect, imin=0, jmin=0, imax=None, jmax=None):
+        if self.is_outside(*rect):
+            self.outside |= flags
+
+        wimin, wjmin, wimax, wjmax = self.get_cell_range(*rect)
+        imin = max(imin, wimin)
+        jmin = max(jmin, wjmin)
+        imax = wimax if imax is None else min(imax, wimax)
+        jmax = wjmax if jmax is None else min(jmax, wjmax)
+        cells = self.cells
+        for j in range(jmin, jmax):
+            row = j * self.columns
+            for i in range(imin, imax):
+                cells[row + i] |= flags
+
+    def add(self, obj, static=True):
+        """Add the wall ``obj`` to the grid."""
+        flags = get_flags(obj)
+        if not flags:
+            return
+
+        if static:
+            rect = (obj.bbox_left, obj.bbox_top, obj.bbox_width,
+                    obj.bbox_height)
+            self.walls[obj] = (flags, rect)
+            self._paint_wall(flags, rect)
+            self._index_wall(obj, flags, rect)
+        else:
+            self.dynamic[obj] = flags
+
+    def remove(self, obj):
+        """Remove the wall ``obj`` from the grid, if it's in it."""
+        if obj in self.walls:
+            flags, rect = self.walls.pop(obj)
+            self._paint(*self.get_cell_range(*rect))
+            self._index_wall(obj, flags, rect, remove=True)
+        else:
+            self.dynamic.pop(obj, None)
+
+    def _index_wall(self, obj, flags, rect, remove=False):
+        if self.is_outside(*rect):
+            if remove:
+                self.outside_walls.pop(obj, None)
+            else:
+                self.outside_walls[obj] = flags
+
+        imin, jmin, imax, jmax = self.get_cell_range(*rect)
+        for j in range(jmin, jmax):
+            row = j * self.columns
+            for i in range(imin, imax):
+                if remove:
+                    walls = self.cell_walls.get(row + i)
+                    if walls is not None:
+                        walls.pop(obj, None)
+                        if not walls:
+                            del self.cell_walls[row + i]
+                else:
+                    self.cell_walls.setdefault(row + i, {})[obj] = flags
+
+    def _dynamic_rect(self, x, y, w, h):
+        flags = 0
+        for obj, obj_flags in self.dynamic.items():
+            if (obj.bbox_left < x + w and obj.bbox_right > x
+                    and obj.bbox_top < y + h and obj.bbox_bottom > y):
+                flags |= obj_flags
+        return flags
+
+    def point(self, x, y):
+        """Return the flags of walls which might be at ``(x, y)``."""
+        return self.rect(x, y, 1, 1)
+
+    def rect(self, x, y, w, h):
+        """
+        Return the combined flags of all walls which might overlap the
+        given rectangle.
+        """
+        flags = self._dynamic_rect(x, y, w, h) if self.dynamic else 0
+        if self.outside and self.is_outside(x, y, w, h):
+            flags |= self.outside
+        imin, jmin, imax, jmax = self.get_cell_range(x, y, w, h)
+        cells = self.cells
+        for j in range(jmin, jmax):
+            row = j * self.columns
+            for i in range(imin, imax):
+                flags |= cells[row + i]
+        return flags
+
+    def get_walls(self, x, y, w, h, mask=ALL):
+        """
+        Return a dictionary mapping the walls with any of the flags in
+        ``mask`` which might overlap the given rectangle to their
+        flags.  Like the other queries, this is conservative; the
+        walls found still have to be checked.
+        """
+        found = {}
+        for obj, flags in self.dynamic.items():
+            if (flags & mask and obj.bbox_left < x + w and obj.bbox_right > x
+                    and obj.bbox_top < y + h and obj.bbox_bottom > y):
+                found[obj] = flags
+
+        if self.outside_walls and self.is_outside(x, y, w, h):
+            for obj, flags in self.outside_walls.items():
+                if flags & mask:
+                    found[obj] = flags
+
+        imin, jmin, imax, jmax = self.get_cell_range(x, y, w, h)
+        cells = self.cells
+        for j in range(jmin, jmax):
+            row = j * self.columns
+            for i in range(imin, imax):
+                if cells[row + i] & mask:
+                    for obj, flags in self.cell_walls.get(row + i,
+                                                          {}).items():
+                        if flags & mask:
+                            found[obj] = flags
+
+        return found
@@ -0,0 +1,339 @@
+# Hexoshi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import array
+import math
+
+import sge
+
+import hlib
+
+
+# Kinds of particles.  Debris falls, bounces off walls and fades out
+# at the end of its life; sparks fly in a straight line and vanish.
+DEBRIS = 0
+SPARK = 1
+FADING = 2
+
+SLOPES_TOP = hlib.occupancy.SLOPE_TOP_LEFT | hlib.occupancy.SLOPE_TOP_RIGHT
+FLOORS = hlib.occupancy.TOP | SLOPES_TOP
+SLOPES_BOTTOM = (hlib.occupancy.SLOPE_BOTTOM_LEFT
+                 | hlib.occupancy.SLOPE_BOTTOM_RIGHT)
+CEILINGS = hlib.occupancy.BOTTOM | SLOPES_BOTTOM
+
+_fade_sprites = {}
+
+
+def _find_floor(walls, left, w, lo, hi, slopes_only=False):
+    # Return the highest floor surface between lo and hi under the span
+    # from left to left + w, or None.  walls maps the walls to check to
+    # their occupancy flags.
+    floor = None
+    right = left + w
+    cx = left + w/2
+    for obj, flags in walls.items():
+        if (not flags & FLOORS or obj.bbox_left >= right
+                or obj.bbox_right <= left):
+            continue
+        if flags & SLOPES_TOP:
+            surface = obj.get_slope_y(cx)
+        elif flags & hlib.occupancy.TOP and not slopes_only:
+            surface = obj.bbox_top
+        else:
+            continue
+
+        if lo <= surface <= hi and (floor is None or surface < floor):
+            floor = surface
+
+    return floor
+
+
+def _find_ceiling(walls, left, w, lo, hi):
+    # Return the lowest ceiling surface between lo and hi over the span
+    # from left to left + w, or None.
+    ceiling = None
+    right = left + w
+    cx = left + w/2
+    for obj, flags in walls.items():
+        if (not flags & CEILINGS or obj.bbox_left >= right
+                or obj.bbox_right <= left):
+            continue
+        if flags & SLOPES_BOTTOM:
+            surface = obj.get_slope_y(cx)
+        elif flags & hlib.occupancy.BOTTOM:
+            surface = obj.bbox_bottom
+        else:
+            continue
+
+        if lo <= surface <= hi and (ceiling is None or surface > ceiling):
+            ceiling = surface
+
+    return ceiling
+
+
+def get_fade_sprite(sprite, image_index):
+    """
+    Return a sprite showing frame ``image_index`` of ``sprite`` fading
+    out over :data:`hlib.SHARD_FADE_TIME` frames.
+    """
+    key = (sprite, image_index)
+    fade = _fade_sprites.get(key)
+    if fade is None:
+        blend = sge.gfx.Color((255, 255, 255, 0))
+        base_sprite = sge.gfx.Sprite(width=sprite.width, height=sprite.height,
+                                     origin_x=sprite.origin_x,
+                                     origin_y=sprite.origin_y)
+        base_sprite.draw_sprite(sprite, image_index, sprite.origin_x,
+                                sprite.origin_y)
+        fade = sge.gfx.Sprite.from_tween(
+            base_sprite, int(hlib.SHARD_FADE_TIME), fps=hlib.FPS,
+            blend=blend, blend_mode=sge.BLEND_RGBA_MULTIPLY)
+        _fade_sprites[key] = fade
+
+    return fade
+
+
+class ParticlePool:
+
+    """
+    Fixed-size pool of simple particles, stored as parallel arrays
+    rather than as room objects so that they cost nothing to create or
+    destroy, don't take part in collision detection between objects,
+    and are all moved in one pass by :meth:`update` and drawn in one
+    pass by :meth:`draw`.
+
+    Particles are kept packed at the start of the arrays; when one
+    dies, the last one is moved into its place.  Once ``capacity``
+    particles exist, new ones are dropped.
+    """
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity or hlib.PARTICLE_LIMIT
+        self.n = 0
+        self.x = array.array('d', bytes(8 * self.capacity))
+        self.y = array.array('d', self.x)
+        self.xv = array.array('d', self.x)
+        self.yv = array.array('d', self.x)
+        self.life = array.array('d', self.x)
+        self.frame = array.array('d', self.x)
+        self.fps = array.array('d', self.x)
+        self.z = array.array('d', self.x)
+        self.kind = array.array('b', bytes(self.capacity))
+        self.on_floor = array.array('b', self.kind)
+        self.sprites = [None] * self.capacity
+
+    def __len__(self):
+        return self.n
+
+    def clear(self):
+        """Remove every particle."""
+        for i in range(self.n):
+            self.sprites[i] = None
+        self.n = 0
+
+    def add(self, kind, x, y, z, sprite, speed=0, direction=0, life=0,
+            image_index=0, image_fps=None):
+        """
+        Add a particle of the given kind, moving at ``speed`` in
+        ``direction`` (in degrees, as for
+        :attr:`sge.dsp.Object.move_direction`) and living for ``life``
+        frames.  ``image_fps`` is the animation
+        speed, defaulting to that of ``sprite``.  Return whether the
+        particle was added.
+        """
+        i = self.n
+        if i >= self.capacity:
+            return False
+
+        self.n += 1
+        self.kind[i] = kind
+        self.x[i] = x
+        self.y[i] = y
+        self.z[i] = z
+        self.xv[i] = math.cos(math.radians(direction)) * speed
+        self.yv[i] = math.sin(math.radians(direction)) * speed
+        self.life[i] = life
+        self.frame[i] = image_index
+        self.fps[i] = sprite.fps if image_fps is None else image_fps
+        self.on_floor[i] = 0
+        self.sprites[i] = sprite
+        return True
+
+    def add_debris(self, x, y, z, sprite, speed, direction, image_index=0,
+                   image_fps=None):
+        """
+        Add a piece of debris, which falls and bounces around for
+        :data:`hlib.SHARD_LIFE` frames before fading out.
+        """
+        return self.add(DEBRIS, x, y, z, sprite, speed, direction,
+                        hlib.SHARD_LIFE, image_index, image_fps)
+
+    def add_spark(self, x, y, z, sprite, speed, direction, life,
+                  image_index=0):
+        """
+        Add a spark, which flies in a straight line for ``life`` frames.
+        """
+        return self.add(SPARK, x, y, z, sprite, speed, direction, life,
+                        image_index)
+
+    def _kill(self, i):
+        # Move the last particle into slot i.
+        j = self.n - 1
+        if i != j:
+            for a in (self.x, self.y, self.xv, self.yv, self.life,
+                      self.frame, self.fps, self.z, self.kind, self.on_floor,
+                      self.sprites):
+                a[i] = a[j]
+        self.sprites[j] = None
+        self.n = j
+
+    def update(self, time_passed, delta_mult, walls=None):
+        """
+        Move every particle by one frame.  ``walls`` is the
+        :class:`hlib.occupancy.OccupancyGrid` of the room which debris
+        bounces off of, if any.
+        """
+        i = 0
+        while i < self.n:
+            sprite = self.sprites[i]
+            kind = self.kind[i]
+
+            # Alarms come before movement, as for objects.
+            self.life[i] -= delta_mult
+            if self.life[i] <= 0:
+                if kind == DEBRIS:
+                    image_index = int(self.frame[i]) % sprite.frames
+                    self.sprites[i] = get_fade_sprite(sprite, image_index)
+                    self.kind[i] = kind = FADING
+                    self.frame[i] = 0
+                    self.fps[i] = hlib.FPS
+                    self.life[i] = math.inf
+                else:
+                    self._kill(i)
+                    continue
+
+            if self.fps[i]:
+                self.frame[i] += time_passed * self.fps[i] / 1000
+                if kind == FADING and self.frame[i] >= self.sprites[i].frames:
+                    self._kill(i)
+                    continue
+
+            if kind == DEBRIS:
+                self._move_debris(i, delta_mult, walls)
+            else:
+                self.x[i] += self.xv[i] * delta_mult
+                self.y[i] += self.yv[i] * delta_mult
+
+            i += 1
+
+    def _move_debris(self, i, delta_mult, walls):
+        sprite = self.sprites[i]
+        x = self.x[i]
+        y = self.y[i]
+        xv = self.xv[i]
+        yv = self.yv[i]
+        left = x + sprite.bbox_x
+        top = y + sprite.bbox_y
+        w = sprite.bbox_width
+        h = sprite.bbox_height
+
+        if walls is not None:
+            # Every wall this particle could touch in this frame, found
+            # at once.  Slopes can lift it by up to twice the distance
+            # it moves horizontally.
+            reach_x = abs(xv * delta_mult) + 1
+            reach_y = ((abs(yv) + hlib.GRAVITY) * delta_mult + reach_x * 2
+                       + 1)
+            walls = walls.get_walls(left - reach_x, top - reach_y,
+                                    w + reach_x*2, h + reach_y*2)
+
+        # Falling, as FallingObject.move does it.
+        on_floor = bool(walls) and _find_floor(
+            walls, left, w, top + h - 1, top + h) is not None
+        if self.on_floor[i] and on_floor and yv >= 0:
+            yaccel = 0
+            yv = 0
+        elif yv < hlib.SHARD_FALL_SPEED:
+            yaccel = hlib.GRAVITY
+        else:
+            yv = hlib.SHARD_FALL_SPEED
+            yaccel = 0
+        self.on_floor[i] = on_floor
+
+        xv *= hlib.SHARD_FRICTION
+        yv *= hlib.SHARD_FRICTION
+
+        dx = xv * delta_mult
+        if dx and walls:
+            bottom = top + h
+            if dx > 0:
+                limit = min(
+                    (obj.bbox_left for obj, flags in walls.items()
+                     if flags & hlib.occupancy.LEFT
+                     and obj.bbox_left >= left + w
+                     and obj.bbox_top < bottom and obj.bbox_bottom > top),
+                    default=None)
+                if limit is not None and left + w + dx > limit:
+                    dx = limit - left - w
+                    xv *= -hlib.SHARD_BOUNCE
+            else:
+                limit = max(
+                    (obj.bbox_right for obj, flags in walls.items()
+                     if flags & hlib.occupancy.RIGHT
+                     and obj.bbox_right <= left
+                     and obj.bbox_top < bottom and obj.bbox_bottom > top),
+                    default=None)
+                if limit is not None and left + dx < limit:
+                    dx = limit - left
+                    xv *= -hlib.SHARD_BOUNCE
+            left += dx
+
+            # Climb up slopes moved into.
+            surface = _find_floor(walls, left, w, bottom - 2*abs(dx) - 1,
+                                  bottom, slopes_only=True)
+            if surface is not None and surface < bottom:
+                y -= bottom - surface
+                top -= bottom - surface
+        x += dx
+
+        vi = yv
+        yv = vi + yaccel*delta_mult
+        dy = (vi+yv) / 2 * delta_mult
+        if dy and walls:
+            if dy > 0:
+                limit = _find_floor(walls, left, w, top + h - 1, top + h + dy)
+                if limit is not None and top + h + dy > limit:
+                    dy = limit - top - h
+                    yv *= -hlib.SHARD_BOUNCE
+            else:
+                limit = _find_ceiling(walls, left, w, top + dy, top + 1)
+                if limit is not None and top + dy < limit:
+                    dy = limit - top
+                    yv *= -hlib.SHARD_BOUNCE
+        y += dy
+
+        self.x[i] = x
+        self.y[i] = y
+        self.xv[i] = xv
+        self.yv[i] = yv
+
+    def draw(self, room):
+        """Project every particle onto ``room``."""
+        project = room.project_sprite
+        for i in range(self.n):
+            sprite = self.sprites[i]
+            project(sprite, int(self.frame[i]) % sprite.frames, self.x[i],
+                    self.y[i], self.z[i])
@@ -0,0 +1,92 @@
+# Hexoshi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import struct
+import zlib
+
+
+SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Amount of compressed data collected before it is written out as an
+# IDAT chunk.
+IDAT_SIZE = 1 << 16
+
+
+class PNGWriter:
+
+    """
+    Writes an 8-bit RGB PNG image to the binary file ``f`` one row at a
+    time, so that the whole image never has to be in memory.
+
+    Rows are given to :meth:`write_row` from top to bottom as
+    :class:`bytes` with three bytes per pixel.  :meth:`close` must be
+    called once all ``height`` rows have been written.
+    """
+
+    def __init__(self, f, width, height, level=6):
+        self.f = f
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self.compressor = zlib.compressobj(level)
+        self.pending = []
+        self.pending_size = 0
+
+        f.write(SIGNATURE)
+        self.write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8,
+                                              2, 0, 0, 0))
+
+    def write_chunk(self, kind, data):
+        self.f.write(struct.pack(">I", len(data)))
+        self.f.write(kind)
+        self.f.write(data)
+        self.f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def _add_data(self, data):
+        if data:
+            self.pending.append(data)
+            self.pending_size += len(data)
+            if self.pending_size >= IDAT_SIZE:
+                self._flush()
+
+    def _flush(self):
+        if self.pending:
+            self.write_chunk(b"IDAT", b"".join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def write_row(self, row):
+        """Add the next row of pixels to the image."""
+        if len(row) != self.width * 3:
+            raise ValueError(f"Row is {len(row)} bytes long, but should be "
+                             f"{self.width * 3}.")
+        if self.rows >= self.height:
+            raise ValueError("All of the rows have already been written.")
+
+        # Each row starts with its filter type, which is always none.
+        self._add_data(self.compressor.compress(b"\0"))
+        self._add_data(self.compressor.compress(row))
+        self.rows += 1
+
+    def close(self):
+        """Finish the image.  The file itself is left open."""
+        if self.rows != self.height:
+            raise ValueError(f"Only {self.rows} of {self.height} rows have "
+                             "been written.")
+
+        self._add_data(self.compressor.flush())
+        self._flush()
+        self.write_chunk(b"IEND", b"")
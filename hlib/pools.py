@@ -0,0 +1,165 @@
+# Hexoshi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import sge
+
+import hlib
+
+
+_pools = []
+_classes = {}
+
+
+class ObjectPool:
+
+    """
+    Objects of one class which have been destroyed and can be used
+    again, up to ``limit`` of them.
+
+    An object given back with :meth:`put` isn't handed out by
+    :meth:`get` until :func:`new_frame` has been called, because sge
+    keeps running the events of objects destroyed during a frame until
+    that frame is over.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = hlib.POOL_LIMIT if limit is None else limit
+        self.free = []
+        self.dead = []
+        self.created = 0
+        self.reused = 0
+        _pools.append(self)
+
+    def get(self):
+        """Return a free object, or None if there are none."""
+        if self.free:
+            self.reused += 1
+            return self.free.pop()
+        return None
+
+    def put(self, obj):
+        """Give back ``obj``, which has just been destroyed."""
+        # Objects can be destroyed more than once, but must only be
+        # handed out once.
+        if (len(self.free) + len(self.dead) < self.limit
+                and obj not in self.dead and obj not in self.free):
+            self.dead.append(obj)
+
+    def collect(self):
+        """Make the objects given back so far available."""
+        self.free.extend(self.dead)
+        self.dead.clear()
+
+    def clear(self):
+        self.free.clear()
+        self.dead.clear()
+
+
+def new_frame():
+    """
+    Make the objects destroyed in the last frame available in every
+    pool.  Must be called at the start of every frame.
+    """
+    for pool in _pools:
+        pool.collect()
+
+
+def get_stats():
+    """
+    Return a dictionary mapping the name of each pooled class to the
+    number of its objects which have been created and reused.
+    """
+    return {name: (pool.created, pool.reused)
+            for name, pool in sorted(_classes.items())}
+
+
+class Pooled:
+
+    """
+    Mixin for :class:`sge.dsp.Object` subclasses whose objects are
+    reused after they are destroyed rather than created anew.  It must
+    come before :class:`sge.dsp.Object` in the bases of the class.
+
+    :meth:`create` takes an object from the pool of the class if one
+    is free, calling :meth:`reset` on it with the arguments it was
+    given, and :meth:`event_destroy` gives the object back.  This
+    means references to an object must not be kept after it is
+    destroyed, since it may have become another object since.
+    """
+
+    pool = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Every class gets its own pool, so subclasses of a pooled
+        # class never get objects of the wrong type.
+        cls.pool = ObjectPool()
+        _classes[cls.__name__] = cls.pool
+
+    @classmethod
+    def create(cls, *args, **kwargs):
+        obj = cls.pool.get()
+        if obj is None:
+            cls.pool.created += 1
+            obj = cls(*args, **kwargs)
+        else:
+            obj.reset(*args, **kwargs)
+
+        sge.game.current_room.add(obj)
+        return obj
+
+    def reset(self, *args, **kwargs):
+        """
+        Prepare the object to be used again, as if it had just been
+        created with the given arguments.  Every pooled class must
+        define this, setting only the attributes which the arguments
+        or the object's own events can change, so that reusing an
+        object costs less than creating a new one.
+        """
+        raise NotImplementedError(
+            "{} does not define reset()".format(self.__class__.__name__))
+
+    def reset_object(self, x, y, z, sprite):
+        """
+        Reset the state every object has: move it to the given
+        position, give it the given sprite, remove its alarms and
+        restart its animation.
+        """
+        if sprite is not self.sprite:
+            self.sprite = sprite
+            # Like a new object, take the bounding box and animation
+            # speed from the new sprite.
+            self.bbox_x = None
+            self.bbox_y = None
+            self.bbox_width = None
+            self.bbox_height = None
+            self.image_fps = None
+
+        self.x = x
+        self.y = y
+        self.z = z
+        self.xstart = self.xprevious = x
+        self.ystart = self.yprevious = y
+        self.alarms.clear()
+
+        # Setting the image index only restarts the timing of the
+        # frame if the index changes.
+        self.image_index = None
+        self.image_index = 0
+
+    def event_destroy(self):
+        super().event_destroy()
+        self.pool.put(self)
@@ -0,0 +1,275 @@
+# Hexoshi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import contextlib
+import functools
+import json
+import os
+import time
+import warnings
+
+import hlib
+
+
+PHASES = ("input", "wait", "other", "begin_step", "physics", "step",
+          "collision", "end_step", "lighting", "timeline", "hud", "draw")
+
+# Object events which are timed, and the phases they are counted in.
+OBJECT_PHASES = {
+    "event_begin_step": "begin_step", "event_update_position": "physics",
+    "event_step": "step", "event_collision": "collision",
+    "event_end_step": "end_step"}
+
+PERCENTILES = (50, 95, 99)
+
+_null_section = contextlib.nullcontext()
+
+
+class _Section:
+
+    def __init__(self, profiler, phase):
+        self.profiler = profiler
+        self.phase = phase
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = self.profiler.current
+        self.profiler.switch(self.phase)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.switch(self.previous)
+
+
+class FrameProfiler:
+
+    """
+    Measures how long each phase of a frame takes, keeping the last
+    ``window`` frames so that percentiles can be found.
+
+    Time is split into slices, each counted in one phase only:
+    :meth:`switch` starts a new phase, and :meth:`section` runs a block
+    of code in a phase and then goes back to the phase it was in.
+    While the profiler is enabled, the object events in
+    :data:`OBJECT_PHASES` of every object class seen are wrapped so
+    that they are timed too, both by phase and by class.  Nothing is
+    measured while it is disabled.
+
+    :meth:`end_frame` must be called at the end of every frame.  If
+    ``dumpdir`` is set, a report of every room is written there as
+    JSON when the next room starts.
+    """
+
+    def __init__(self, window=None, dumpdir=None):
+        self.window = window or hlib.PROFILE_WINDOW
+        self.dumpdir = dumpdir
+        self.enabled = False
+        self.current = "other"
+        self.current_class = None
+        self.last = None
+        self.times = dict.fromkeys(PHASES, 0)
+        self.samples = {}
+        self.class_times = collections.Counter()
+        self.class_totals = collections.Counter()
+        self.class_peaks = collections.Counter()
+        self.counts = collections.Counter()
+        self.frames = 0
+        self.room = None
+        self.nrooms = 0
+        self.instrumented = {}
+        self.reset()
+
+    def enable(self):
+        if not self.enabled:
+            self.enabled = True
+            self.last = time.perf_counter()
+
+    def disable(self):
+        if self.enabled:
+            self.enabled = False
+            for cls, originals in self.instrumented.items():
+                for name, method in reversed(originals):
+                    if method is None:
+                        delattr(cls, name)
+                    else:
+                        setattr(cls, name, method)
+            self.instrumented = {}
+
+    def reset(self):
+        """Forget everything measured so far."""
+        self.times = dict.fromkeys(PHASES, 0)
+        self.samples = {phase: collections.deque(maxlen=self.window)
+                        for phase in PHASES + ("total",)}
+        self.class_times.clear()
+        self.class_totals.clear()
+        self.class_peaks.clear()
+        self.counts.clear()
+        self.frames = 0
+
+    def switch(self, phase, cls=None):
+        """
+        Count the time since the last switch in the phase it was in,
+        and start counting time in ``phase``, also counting it for the
+        object class named ``cls`` if that is given.
+        """
+        if not self.enabled:
+            return
+
+        now = time.perf_counter()
+        elapsed = now - self.last
+        self.times[self.current] += elapsed
+        if self.current_class is not None:
+            self.class_times[self.current_class] += elapsed
+        self.last = now
+        self.current = phase
+        self.current_class = cls
+
+    def section(self, phase):
+        """
+        Return a context manager which counts the time spent in it in
+        ``phase``.
+        """
+        if not self.enabled:
+            return _null_section
+        return _Section(self, phase)
+
+    def _wrap(self, method, phase):
+        @functools.wraps(method)
+        def timed(obj, *args, **kwargs):
+            previous = (self.current, self.current_class)
+            self.switch(phase, type(obj).__name__)
+            try:
+                return method(obj, *args, **kwargs)
+            finally:
+                self.switch(*previous)
+
+        return timed
+
+    def instrument(self, cls):
+        """Time the events in :data:`OBJECT_PHASES` of ``cls``."""
+        if cls in self.instrumented:
+            return
+
+        originals = []
+        for name, phase in OBJECT_PHASES.items():
+            method = getattr(cls, name, None)
+            if method is not None:
+                originals.append((name, cls.__dict__.get(name)))
+                setattr(cls, name, self._wrap(method, phase))
+        self.instrumented[cls] = originals
+
+    def end_frame(self, objects=()):
+        """
+        Record the frame which has just ended.  ``objects`` is the list
+        of objects in the room, which are counted by class.
+        """
+        if not self.enabled:
+            return
+
+        self.switch(self.current, self.current_class)
+        total = 0
+        for phase, t in self.times.items():
+            self.samples[phase].append(t * 1000)
+            total += t
+            self.times[phase] = 0
+        self.samples["total"].append(total * 1000)
+
+        self.class_totals.update(self.class_times)
+        self.class_times.clear()
+
+        self.counts = collections.Counter()
+        for obj in objects:
+            cls = type(obj)
+            self.counts[cls.__name__] += 1
+            self.instrument(cls)
+        for name, count in self.counts.items():
+            self.class_peaks[name] = max(self.class_peaks[name], count)
+
+        self.frames += 1
+
+    def get_percentiles(self, phase):
+        """
+        Return the percentiles in :data:`PERCENTILES` of the time taken
+        by ``phase``, in milliseconds, over the recorded frames.
+        """
+        data = sorted(self.samples[phase])
+        if not data:
+            return tuple(0 for p in PERCENTILES)
+
+        return tuple(data[min(len(data) - 1, len(data) * p // 100)]
+                     for p in PERCENTILES)
+
+    def get_report(self):
+        """Return a dictionary summarizing the recorded frames."""
+        phases = {}
+        for phase in PHASES + ("total",):
+            samples = self.samples[phase]
+            percentiles = self.get_percentiles(phase)
+            phases[phase] = {f"p{p}": round(v, 3)
+                             for p, v in zip(PERCENTILES, percentiles)}
+            phases[phase]["mean"] = round(
+                sum(samples) / len(samples) if samples else 0, 3)
+
+        classes = {}
+        for name in sorted(self.class_peaks.keys() | self.class_totals.keys()):
+            classes[name] = {
+                "count": self.counts[name], "peak": self.class_peaks[name],
+                "ms_per_frame": round(
+                    self.class_totals[name] * 1000 / max(self.frames, 1), 4)}
+
+        return {"room": self.room, "frames": self.frames,
+                "window": self.window, "phases": phases, "classes": classes}
+
+    def get_overlay_text(self, nclasses=5):
+        """
+        Return text listing the percentiles of each phase and the most
+        numerous object classes, for showing on screen.
+        """
+        lines = ["{:<10} {:>6} {:>6} {:>6}".format(
+            "ms", *(f"p{p}" for p in PERCENTILES))]
+        for phase in PHASES + ("total",):
+            percentiles = self.get_percentiles(phase)
+            if phase == "total" or percentiles[-1] >= 0.01:
+                lines.append("{:<10} {:>6.2f} {:>6.2f} {:>6.2f}".format(
+                    phase, *percentiles))
+
+        for name, count in self.counts.most_common(nclasses):
+            lines.append(f"{name} x{count}")
+
+        return "\n".join(lines)
+
+    def dump(self, fname):
+        """Write the report to the JSON file ``fname``."""
+        try:
+            os.makedirs(os.path.dirname(fname) or os.curdir, exist_ok=True)
+            with open(fname, 'w') as f:
+                json.dump(self.get_report(), f, indent=4)
+        except OSError as e:
+            warnings.warn(f"Could not write profile to {fname}: {e}")
+
+    def set_room(self, room):
+        """
+        Start recording the room named ``room``, writing the report of
+        the previous room to :attr:`dumpdir` first if it is set.
+        """
+        if self.enabled and self.dumpdir and self.frames:
+            name = os.path.splitext(os.path.basename(str(self.room)))[0]
+            self.dump(os.path.join(self.dumpdir,
+                                   f"{self.nrooms:04d}-{name}.json"))
+            self.nrooms += 1
+
+        self.reset()
+        self.room = room
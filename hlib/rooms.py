@@ -0,0 +1,456 @@
+# Hexoshi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import array
+import hashlib
+import json
+import marshal
+import math
+import os
+import threading
+import warnings
+
+import sge
+import xsge_tiled
+
+import hlib
+
+
+CACHE_VERSION = 1
+
+_tilesets = {}
+
+prefetch_hits = 0
+prefetch_misses = 0
+_prefetch_cond = threading.Condition()
+_prefetch_queue = []
+_prefetch_current = None
+_prefetched = {}
+_prefetch_thread = None
+
+
+def get_cache_fname(fname):
+    h = hashlib.sha1(os.path.abspath(fname).encode("utf-8")).hexdigest()
+    return os.path.join(hlib.cachedir, "rooms", f"{h}.bin")
+
+
+def hash_file(fname):
+    with open(fname, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _rebase(path, old_dir, new_dir):
+    return os.path.relpath(os.path.join(old_dir, path), new_dir)
+
+
+def _get_tile_chunks(layers):
+    for layer in layers:
+        if layer.get("type") == "group":
+            yield from _get_tile_chunks(layer.get("layers", []))
+        elif layer.get("type") == "tilelayer":
+            for chunk in [layer] + layer.get("chunks", []):
+                if "data" in chunk:
+                    yield layer, chunk
+
+
+def _decode_layers(layers):
+    chunks = list(_get_tile_chunks(layers))
+    for layer, chunk in chunks:
+        data = xsge_tiled.t_data_decode(
+            chunk["data"], layer.get("encoding", "csv"),
+            layer.get("compression"))
+        chunk["data"] = array.array("I", data)
+
+    for layer, chunk in chunks:
+        layer.pop("encoding", None)
+        layer.pop("compression", None)
+
+
+def _pack_layers(layers, pack):
+    # Tile data is kept as raw integer arrays, which marshal can only
+    # store as bytes.
+    for layer, chunk in _get_tile_chunks(layers):
+        if pack:
+            chunk["data"] = chunk["data"].tobytes()
+        else:
+            data = array.array("I")
+            data.frombytes(chunk["data"])
+            chunk["data"] = data
+
+
+def compile_room(fname):
+    """
+    Parse the Tiled JSON room ``fname`` into a self-contained tilemap,
+    with external tilesets inlined and tile layers decoded, and return
+    a tuple containing the tilemap and a list of ``(fname, hash)``
+    tuples for every file the tilemap was built from.
+    """
+    with open(fname, "rb") as f:
+        raw = f.read()
+    tilemap = json.loads(raw)
+    deps = [(fname, hashlib.sha1(raw).hexdigest())]
+    tmdir = os.path.dirname(fname)
+
+    tilesets = tilemap.get("tilesets", [])
+    for i in range(len(tilesets)):
+        source = tilesets[i].get("source")
+        if not source:
+            continue
+
+        ts_fname = os.path.join(tmdir, source)
+        with open(ts_fname, "rb") as f:
+            raw = f.read()
+        tileset = json.loads(raw)
+        deps.append((ts_fname, hashlib.sha1(raw).hexdigest()))
+
+        # The tileset is moving into the room file, so any image paths
+        # it has need to become relative to the room's directory.
+        ts_dir = os.path.dirname(ts_fname)
+        if tileset.get("image"):
+            tileset["image"] = _rebase(tileset["image"], ts_dir, tmdir)
+        for tile in tileset.get("tiles", []):
+            if tile.get("image"):
+                tile["image"] = _rebase(tile["image"], ts_dir, tmdir)
+
+        tileset["firstgid"] = tilesets[i].get("firstgid", 1)
+        tilesets[i] = tileset
+
+    _decode_layers(tilemap.get("layers", []))
+
+    return tilemap, deps
+
+
+def check_deps(deps):
+    """
+    Return whether every file in ``deps``, a list of ``(fname, hash)``
+    tuples as returned by :func:`compile_room`, still has the same
+    contents.
+    """
+    for dep_fname, dep_hash in deps:
+        try:
+            if hash_file(dep_fname) != dep_hash:
+                return False
+        except OSError:
+            return False
+
+    return True
+
+
+def read_cache(fname):
+    """
+    Return the cached tilemap for the room ``fname`` and the files it
+    was built from as a tuple ``(tilemap, deps)``, or :const:`None` if
+    there is no cache for it or the cache is stale.
+    """
+    try:
+        with open(get_cache_fname(fname), "rb") as f:
+            version, deps, tilemap = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+    if version != CACHE_VERSION or not check_deps(deps):
+        return None
+
+    _pack_layers(tilemap.get("layers", []), False)
+    return tilemap, deps
+
+
+def write_cache(fname, tilemap, deps):
+    cache_fname = get_cache_fname(fname)
+    try:
+        os.makedirs(os.path.dirname(cache_fname), exist_ok=True)
+        tmp_fname = f"{cache_fname}.tmp"
+        _pack_layers(tilemap.get("layers", []), True)
+        try:
+            with open(tmp_fname, "wb") as f:
+                marshal.dump((CACHE_VERSION, deps, tilemap), f)
+        finally:
+            _pack_layers(tilemap.get("layers", []), False)
+        os.replace(tmp_fname, cache_fname)
+    except OSError as e:
+        warnings.warn(f"Could not write room cache for {fname}: {e}")
+
+
+def get_tilemap_deps(fname):
+    """
+    Return the compiled tilemap for the room ``fname`` and the files it
+    was built from as a tuple ``(tilemap, deps)``, compiling it and
+    updating the cache if necessary.
+    """
+    cached = read_cache(fname)
+    if cached is None:
+        tilemap, deps = compile_room(fname)
+        write_cache(fname, tilemap, deps)
+        return tilemap, deps
+
+    return cached
+
+
+def get_tilemap(fname):
+    """
+    Return the compiled tilemap for the room ``fname``, compiling it
+    and updating the cache if necessary.
+
+    The tilemap returned is always a fresh object, since
+    :mod:`xsge_tiled` modifies tilemaps as it parses them.
+    """
+    return get_tilemap_deps(fname)[0]
+
+
+def prefetch(fnames):
+    """
+    Compile the rooms in the list ``fnames`` in a background thread so
+    that a following :func:`load` of any of them only has to build the
+    room's objects.  Rooms are prefetched in the order given, and
+    prefetched rooms not in ``fnames`` are discarded.
+    """
+    global _prefetch_queue
+    global _prefetch_thread
+
+    with _prefetch_cond:
+        for fname in list(_prefetched):
+            if fname not in fnames:
+                del _prefetched[fname]
+
+        _prefetch_queue = [fname for fname in fnames
+                           if fname not in _prefetched
+                           and fname != _prefetch_current]
+
+        if _prefetch_thread is None and _prefetch_queue:
+            _prefetch_thread = threading.Thread(target=_prefetch_run,
+                                                daemon=True)
+            _prefetch_thread.start()
+
+        _prefetch_cond.notify_all()
+
+
+def _prefetch_run():
+    global _prefetch_current
+
+    while True:
+        with _prefetch_cond:
+            while not _prefetch_queue:
+                _prefetch_cond.wait()
+            fname = _prefetch_queue.pop(0)
+            _prefetch_current = fname
+
+        try:
+            tilemap = get_tilemap(fname)
+        except Exception:
+            # Leave it to the main thread to fail loudly.
+            tilemap = None
+
+        with _prefetch_cond:
+            _prefetch_current = None
+            if tilemap is not None:
+                _prefetched[fname] = tilemap
+            _prefetch_cond.notify_all()
+
+
+def _take_prefetched(fname):
+    global prefetch_hits
+    global prefetch_misses
+
+    with _prefetch_cond:
+        if fname in _prefetch_queue:
+            _prefetch_queue.remove(fname)
+        while fname == _prefetch_current:
+            _prefetch_cond.wait()
+
+        tilemap = _prefetched.pop(fname, None)
+        if tilemap is not None:
+            prefetch_hits += 1
+        else:
+            prefetch_misses += 1
+
+        return tilemap
+
+
+def load(fname, cls=sge.dsp.Room, types=None, z=0):
+    """
+    Equivalent of :func:`xsge_tiled.load`, but takes the tilemap from
+    the prefetched rooms or the compiled room cache.
+    """
+    tilemap = _take_prefetched(fname)
+    if tilemap is None:
+        tilemap = get_tilemap(fname)
+
+    return load_tilemap(tilemap, fname, cls, types, z)
+
+
+def bake_tiles(objects, chunk_size=None):
+    """
+    Return a copy of the list ``objects`` with every plain orthogonal
+    tile grid replaced by decorations of pre-rendered chunks of at most
+    ``chunk_size`` by ``chunk_size`` pixels.  Chunks with no tiles in
+    them are left out.
+    """
+    if chunk_size is None:
+        chunk_size = hlib.TILE_CHUNK_SIZE
+
+    baked = []
+    for obj in objects:
+        grid = obj.sprite
+        if (type(obj) is not xsge_tiled.Decoration
+                or not isinstance(grid, sge.gfx.TileGrid)
+                or grid.render_method != "orthogonal"):
+            baked.append(obj)
+            continue
+
+        columns = grid.section_length
+        rows = len(grid.tiles) // columns
+        width = columns * grid.tile_width
+        height = rows * grid.tile_height
+        for cy in range(0, height, chunk_size):
+            jmin = cy // grid.tile_height
+            jmax = min(rows, math.ceil((cy+chunk_size) / grid.tile_height))
+            for cx in range(0, width, chunk_size):
+                imin = cx // grid.tile_width
+                imax = min(columns,
+                           math.ceil((cx+chunk_size) / grid.tile_width))
+                if not any(grid.tiles[i + j*columns]
+                           for j in range(jmin, jmax)
+                           for i in range(imin, imax)):
+                    continue
+
+                sprite = sge.gfx.Sprite(width=min(chunk_size, width - cx),
+                                        height=min(chunk_size, height - cy))
+                sprite.draw_lock()
+                sprite.draw_sprite(grid, 0, -cx, -cy)
+                sprite.draw_unlock()
+                baked.append(xsge_tiled.Decoration(
+                    obj.x + cx, obj.y + cy, obj.z, sprite=sprite))
+
+    return baked
+
+
+def get_room_size(tilemap):
+    """
+    Return the size of the room described by ``tilemap`` as a tuple
+    ``(width, height)``, following the same rules as
+    :func:`xsge_tiled.load`.
+    """
+    room_width = (tilemap.setdefault("width", 1)
+                  * tilemap.setdefault("tilewidth", 32))
+    room_height = (tilemap.setdefault("height", 1)
+                   * tilemap.setdefault("tileheight", 32))
+    tilemap.setdefault("renderorder", "right-down")
+    tilemap.setdefault("orientation", "orthogonal")
+    tilemap.setdefault("staggeraxis", "y")
+    tilemap.setdefault("staggerindex", "odd")
+    tilemap.setdefault("hexsidelength", 12)
+
+    if tilemap["orientation"] == "staggered":
+        if tilemap["staggeraxis"] == "x":
+            room_width = room_width/2 + tilemap["tilewidth"]/2
+        else:
+            room_height = room_height/2 + tilemap["tileheight"]/2
+    elif tilemap["orientation"] == "hexagonal":
+        if tilemap["staggeraxis"] == "x":
+            room_width = (room_width/2 + tilemap["tilewidth"]/2
+                          + tilemap["width"]*tilemap["hexsidelength"])
+        else:
+            room_height = (room_height/2 + tilemap["tileheight"]/2
+                           + tilemap["height"]*tilemap["hexsidelength"])
+
+    return room_width, room_height
+
+
+def get_tilesets(tilemap, tmdir, types):
+    """
+    Return the result of :func:`xsge_tiled.t_get_tilesets` for
+    ``tilemap``, reusing the result from an earlier room with the same
+    tilesets if possible.
+    """
+    # Most rooms share the same tilesets, so their sprites only need to
+    # be loaded once.
+    key = (tmdir, id(types), marshal.dumps(tilemap.get("tilesets", [])))
+    tilesets = _tilesets.get(key)
+    if tilesets is None:
+        tilesets = xsge_tiled.t_get_tilesets(tilemap, tmdir, types)
+        _tilesets[key] = tilesets
+    return tilesets
+
+
+def load_objects(fname, types=None, z=0):
+    """
+    Return the size of the room ``fname``, the objects in its object
+    layers and the files it was built from as a tuple
+    ``(width, height, objects, deps)``.  This is much cheaper than
+    loading the room, since tile and image layers are skipped and no
+    room is created.
+    """
+    if types is None:
+        types = {}
+
+    tilemap, deps = get_tilemap_deps(fname)
+    room_width, room_height = get_room_size(tilemap)
+    tmdir = os.path.dirname(fname)
+    tile_cls, tile_sprites, tile_kwargs, tile_objectalignment = (
+        get_tilesets(tilemap, tmdir, types))
+
+    objects = []
+    for layer in tilemap.get("layers", []):
+        if layer.get("type") not in {"objectgroup", "group"}:
+            continue
+
+        new_objects, new_views, z = xsge_tiled.t_parse_layer(
+            layer, tilemap, tmdir, tile_cls, tile_sprites, tile_kwargs,
+            tile_objectalignment, types, z)
+        objects.extend(new_objects)
+
+    return room_width, room_height, objects, deps
+
+
+def load_tilemap(tilemap, fname, cls=sge.dsp.Room, types=None, z=0):
+    """
+    Build a room of the class ``cls`` out of the compiled ``tilemap``
+    of the room ``fname``, following the same rules as
+    :func:`xsge_tiled.load`.
+    """
+    if types is None:
+        types = {}
+
+    room_width, room_height = get_room_size(tilemap)
+
+    c = tilemap.get("backgroundcolor")
+    if c:
+        background = sge.gfx.Background([], xsge_tiled.t_get_color(c))
+    else:
+        background = None
+
+    tmdir = os.path.dirname(fname)
+
+    tile_cls, tile_sprites, tile_kwargs, tile_objectalignment = (
+        get_tilesets(tilemap, tmdir, types))
+
+    objects = []
+    views = []
+    for layer in tilemap.get("layers", []):
+        new_objects, new_views, z = xsge_tiled.t_parse_layer(
+            layer, tilemap, tmdir, tile_cls, tile_sprites, tile_kwargs,
+            tile_objectalignment, types, z)
+        objects.extend(new_objects)
+        views.extend(new_views)
+
+    room_kwargs = {
+        "objects": bake_tiles(objects), "width": room_width,
+        "height": room_height,
+        "views": views if views else None, "background": background}
+    room_kwargs.update(
+        xsge_tiled.t_get_properties(tilemap.get("properties", [])))
+
+    return cls(**room_kwargs)
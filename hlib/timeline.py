@@ -0,0 +1,153 @@
+# Hexoshi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import json
+import marshal
+import os
+import sys
+import warnings
+
+import hlib
+
+
+# Code objects can only be loaded by the same version of Python which
+# compiled them, so the cache is tied to it.
+CACHE_VERSION = (1, sys.implementation.cache_tag)
+
+
+def get_cache_fname(fname):
+    h = hashlib.sha1(os.path.abspath(fname).encode("utf-8")).hexdigest()
+    return os.path.join(hlib.cachedir, "timelines", f"{h}.bin")
+
+
+def _compile(source, mode, fname):
+    try:
+        return compile(source, fname, mode)
+    except SyntaxError:
+        # Leave it as source, so that the error is raised and reported
+        # when the command runs, the same as any other error in it.
+        return source
+
+
+def compile_command(command, fname="<timeline>"):
+    """
+    Return the compiled form of the timeline command string
+    ``command`` as a tuple whose first item is the name of the
+    command, or :const:`None` if the command does nothing.
+    Expressions and statements in the command are compiled into code
+    objects, which can be passed to :func:`eval` and :func:`exec`.
+    """
+    command = command.split(None, 1)
+    if not command:
+        return None
+
+    if len(command) >= 2:
+        command, arg = command[:2]
+    else:
+        command = command[0]
+        arg = ""
+
+    if command == "setattr":
+        args = arg.split(None, 2)
+        if len(args) >= 3:
+            obj, name, value = args[:3]
+            return (command, obj, name, _compile(value, "eval", fname))
+    elif command == "call":
+        args = arg.split()
+        if len(args) >= 2:
+            obj, method = args[:2]
+            fa = tuple(_compile(s, "eval", fname) for s in args[2:])
+            return (command, obj, method, fa)
+    elif command in {"dialog", "play_music", "timeline"}:
+        return (command, arg)
+    elif command == "skip_to":
+        try:
+            return (command, float(arg))
+        except ValueError:
+            pass
+    elif command == "exec":
+        return (command, _compile(arg, "exec", fname))
+    elif command in {"if", "while"}:
+        return (command, _compile(arg, "eval", fname))
+    elif command in {"if_watched", "if_not_watched"}:
+        return (command,)
+
+    # Comments and unknown commands do nothing.
+    return None
+
+
+def compile_timeline(jt, fname="<timeline>"):
+    """
+    Compile the decoded JSON timeline ``jt`` and return it as a list of
+    ``(step, commands)`` tuples sorted by step, where ``commands`` is a
+    tuple of commands as returned by :func:`compile_command`.
+    """
+    timeline = []
+    for step, commands in jt.items():
+        commands = (compile_command(command, fname) for command in commands)
+        timeline.append((float(step),
+                         tuple(c for c in commands if c is not None)))
+
+    timeline.sort(key=lambda entry: entry[0])
+    return timeline
+
+
+def read_cache(fname, h):
+    """
+    Return the cached compiled timeline for ``fname``, or :const:`None`
+    if there is no cache for it or the cache is stale.  ``h`` is the
+    hash of the timeline file's current contents.
+    """
+    try:
+        with open(get_cache_fname(fname), "rb") as f:
+            version, cache_hash, timeline = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+    if version != CACHE_VERSION or cache_hash != h:
+        return None
+
+    return timeline
+
+
+def write_cache(fname, h, timeline):
+    cache_fname = get_cache_fname(fname)
+    try:
+        os.makedirs(os.path.dirname(cache_fname), exist_ok=True)
+        tmp_fname = f"{cache_fname}.tmp"
+        with open(tmp_fname, "wb") as f:
+            marshal.dump((CACHE_VERSION, h, timeline), f)
+        os.replace(tmp_fname, cache_fname)
+    except OSError as e:
+        warnings.warn(f"Could not write timeline cache for {fname}: {e}")
+
+
+def load(fname):
+    """
+    Return the compiled timeline of the timeline file ``fname``, taking
+    it from the cache if possible.
+    """
+    with open(fname, "rb") as f:
+        raw = f.read()
+    h = hashlib.sha1(raw).hexdigest()
+
+    timeline = read_cache(fname, h)
+    if timeline is None:
+        timeline = compile_timeline(json.loads(raw), fname)
+        write_cache(fname, h, timeline)
+
+    return timeline